@@ -0,0 +1,59 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import *
+
+
+def load_chunks(start: int, stop: int, make_entries, write, chunk_size: int, depth: int):
+    '''
+    Write the entries of keys start..stop-1, `chunk_size` keys per MSET and
+    `depth` MSETs per round trip, yielding the number of keys written after each
+    round trip. Only one round trip's worth of entries is in memory at a time.
+    '''
+    for offset in range(start, stop, chunk_size * depth):
+        chunks = [make_entries(low, min(low + chunk_size, stop))
+                  for low in range(offset, min(offset + chunk_size * depth, stop), chunk_size)]
+        write(chunks)
+        yield sum(len(chunk) for chunk in chunks)
+
+
+def bulk_load(n: int, make_entries, write, logger=None, chunk_size: int = BATCH_INIT_CHUNK,
+              depth: int = BATCH_INIT_PIPELINE, workers: int = BATCH_INIT_WORKERS) -> int:
+    '''
+    Stream keys 0..n-1 into Redis: make_entries(low, high) builds the entries of
+    keys low..high-1 and write(chunks) sends a list of them in one round trip.
+    With more than one worker the key range is split in contiguous slices
+    written in parallel. Progress is logged every BATCH_INIT_LOG_EVERY keys.
+    Returns the number of keys written.
+    '''
+    n = int(n)
+    lock = threading.Lock()
+    done = [0, 0]
+
+    def run(start: int, stop: int):
+        for written in load_chunks(start, stop, make_entries, write, chunk_size, depth):
+            with lock:
+                done[0] += written
+                if logger is not None and done[0] - done[1] >= BATCH_INIT_LOG_EVERY:
+                    done[1] = done[0]
+                    logger.info("[batch_init] %s/%s keys written", done[0], n)
+
+    workers = max(1, min(workers, -(-n // chunk_size)))
+    if workers == 1:
+        run(0, n)
+    else:
+        step = -(-n // workers)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch-init") as executor:
+            for future in [executor.submit(run, low, min(low + step, n)) for low in range(0, n, step)]:
+                future.result()
+    if logger is not None:
+        logger.info("[batch_init] %s/%s keys written", done[0], n)
+    return done[0]
+
+
+def pipelined_mset(client, chunks: list[dict]):
+    # One MSET per chunk, all sent in one non-transactional pipeline
+    with client.pipeline(transaction=False) as pipe:
+        for chunk in chunks:
+            pipe.mset(chunk)
+        pipe.execute()
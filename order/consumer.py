@@ -1,90 +1,365 @@
 import pika
 import time
+import msgspec
 from msgspec import msgpack
 import os
-from exceptions import RedisDBError, InsufficientCreditError, RabbitMQError
-from services import create_order_db, get_order_by_id_db, batch_init_users_db, add_item_db, confirm_order
+from exceptions import RedisDBError, InsufficientCreditError, OrderNotFoundError, OrderChangedError, RabbitMQError
+from services import create_order_db, get_order_by_id_db, batch_init_users_db, add_item_db, confirm_order, execute_batch, db_stats
+from model import OrderValue
+from messages import (ORDER_MESSAGES, MessageDecoder, Message, encode, DbStats, CreateOrder, BatchInitUsers, FindOrder,
+                      AddItem, Checkout, ConfirmOrder, CheckoutStats, PriceCacheStats, FindItem, FindItemBulk)
 from config import *
+from logs import configure_logger, LogSampler, log_sampled
+from metrics import registry, serve as serve_metrics
+import tracing
+from worker_pool import KeyedWorkerPool
+from batching import MessageBatcher
+from saga import CheckoutOrchestrator
+from service_calls import ServiceCalls, message_deadline
+from price_cache import PriceCache
 import logging
+import threading
+import uuid
+from functools import partial
+
+# Actions the micro-batching mode collects, everything else is handled one by one
+BATCH_ACTIONS = {FindOrder, ConfirmOrder}
+
+# Actions that update an entity, announced on ENTITY_EVENTS_EXCHANGE
+WRITE_ACTIONS = {AddItem, ConfirmOrder, Checkout}
+
+# Actions that wait on another service; their messages are acked once they complete
+ASYNC_ACTIONS = {Checkout, AddItem}
+
+decoder = MessageDecoder(ORDER_MESSAGES)
+
+# Served on METRICS_PORT; latencies run from the delivery to the reply, for checkouts across the whole saga
+MESSAGE_SECONDS = registry.histogram("consumer_message_seconds", "Time from delivery to reply, by action", ("action",))
+IN_FLIGHT = registry.gauge("consumer_in_flight", "Messages delivered and not answered yet")
+EXPIRED = registry.counter("consumer_expired_total", "Messages dropped past their deadline")
+REJECTED = registry.counter("consumer_rejected_total", "Messages refused as malformed")
+QUEUE_DEPTH = registry.gauge("broker_queue_depth", "Messages ready in the broker queue", ("queue",))
+QUEUE_CONSUMERS = registry.gauge("broker_queue_consumers", "Consumers attached to the broker queue", ("queue",))
 
 def generate_response(status, data={}):
     return {"status":status, "data":data}
 
+def is_expired(properties):
+    deadline = (properties.headers or {}).get(DEADLINE_HEADER)
+    return deadline is not None and time.time() * 1000 > deadline
+
+def success_data(msg, entry):
+    # Reply payload of a batchable action, shared by the single and the batched path
+    if isinstance(msg, FindOrder):
+        return {
+            "order_id": msg.order_id,
+            "paid": entry.paid,
+            "items": list(entry.items.items()),
+            "user_id": entry.user_id,
+            "total_cost": entry.total_cost
+        }
+    return "Checkout successful"
+
+def error_response(e):
+    if isinstance(e, RedisDBError):
+        return generate_response(STATUS_SERVER_ERROR, DB_ERROR_STR)
+    elif isinstance(e, (InsufficientCreditError, OrderNotFoundError, OrderChangedError)):
+        return generate_response(STATUS_CLIENT_ERROR, REQ_ERROR_STR)
+    return generate_response(STATUS_SERVER_ERROR, SERV_ERROR_STR)
+
+def message_keys(msg):
+    order_id = getattr(msg, 'order_id', None)
+    return [order_id] if order_id is not None else []
+
+def prefixed(stats, prefix, skip=()):
+    # Counters named prefix + label, as metric samples keyed by that label
+    return {(name[len(prefix):],): value for name, value in stats.items()
+            if name.startswith(prefix) and name not in skip}
+
 class RabbitMQConsumer:
 
     def declare_queues(self):
         self.channel.queue_declare(ORDER_QUEUE)
+        self.channel.exchange_declare(exchange=ENTITY_EVENTS_EXCHANGE, exchange_type='topic')
+        self.channel.queue_declare(STOCK_QUEUE)
+        self.channel.queue_declare(PAYMENT_QUEUE)
+        self.channel.exchange_declare(exchange=ITEM_EVENTS_EXCHANGE, exchange_type='fanout')
+        # Every replica needs every item event, each gets its own exclusive queue
+        events = self.channel.queue_declare(queue='', exclusive=True)
+        self.channel.queue_bind(queue=events.method.queue, exchange=ITEM_EVENTS_EXCHANGE)
+        self.channel.basic_consume(queue=events.method.queue, on_message_callback=self.on_item_event, auto_ack=True)
 
     def setup_logger(self):
-        self.logger = logging.getLogger("OrderService")
-        self.logger.setLevel(logging.INFO)
-        handler = logging.StreamHandler()
-        handler.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-        self.logger.addHandler(handler)
+        self.logger = configure_logger(logging.getLogger("OrderService"), LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE,
+                                       background=LOG_BACKGROUND)
+        self.sampler = LogSampler(LOG_SAMPLE)
 
     def connect(self):
         try:
             connection = pika.BlockingConnection(pika.URLParameters(os.environ['RABBITMQ_BROKER_URL']))
             channel = connection.channel()
+            self.connection = connection
             self.channel = channel
+            if self.batcher is not None:
+                # Unacked messages of the dropped connection come back as new deliveries
+                IN_FLIGHT.dec(amount=len(self.batcher.items))
+                self.batcher.reset()
+            self.calls.reset()
+            self.saga.reset()
+            with self.held_lock:
+                IN_FLIGHT.dec(amount=len(self.held))
+                self.held = {}
             self.declare_queues()
+            # Item events sent while the exclusive event queue was gone are lost, so no cached price can be trusted
+            self.prices.invalidate()
+            # Replies to service calls, direct reply-to is consumed in no-ack mode on the publishing channel
+            self.channel.basic_consume(queue=DIRECT_REPLY_QUEUE, on_message_callback=self.on_reply, auto_ack=True)
         except Exception as e:
             raise RabbitMQError
 
     def __init__(self) -> None:
+        self.connection = None
         self.channel = None
         self.setup_logger()
+        self.batcher = MessageBatcher(CONSUMER_BATCH_SIZE, CONSUMER_BATCH_WAIT_MS, self.handle_batch) if CONSUMER_BATCH_SIZE > 1 else None
+        self.pool = None
+        if self.batcher is None and CONSUMER_WORKERS > 1:
+            self.pool = KeyedWorkerPool(CONSUMER_WORKERS, self.logger)
+        self.calls = ServiceCalls(self, self.logger)
+        self.saga = CheckoutOrchestrator(self, self.calls, self.logger)
+        self.prices = PriceCache(PRICE_CACHE_SIZE)
+        # Deliveries of ASYNC_ACTIONS that are not acked yet: delivery tag -> (channel, action, received, span)
+        self.held = {}
+        self.held_lock = threading.Lock()
+        # Message type -> handler(properties, msg), returning the data of the success reply
+        self.handlers = {
+            FindOrder: lambda properties, msg: success_data(msg, get_order_by_id_db(msg.order_id)),
+            CreateOrder: lambda properties, msg: {"order_id": create_order_db(msg.user_id)},
+            BatchInitUsers: self.batch_init_users,
+            DbStats: lambda properties, msg: db_stats(),
+            CheckoutStats: lambda properties, msg: self.saga.stats(),
+            PriceCacheStats: lambda properties, msg: self.prices.stats(),
+            ConfirmOrder: self.confirm_order,
+        }
+        # Handlers of ASYNC_ACTIONS, (ch, method, properties, msg); they reply through complete()
+        self.async_handlers = {Checkout: self.saga.start, AddItem: self.add_item}
+        self.register_metrics()
+
+    def register_metrics(self):
+        # The saga and the price cache keep their own counters, these are read at scrape time
+        registry.collect("order_checkouts_total", "Finished checkouts by outcome", ("outcome",),
+                         lambda: prefixed(self.saga.stats(), "checkouts_"), "counter")
+        registry.collect("order_compensations_total", "Compensating calls sent by checkouts, by step", ("step",),
+                         lambda: prefixed(self.saga.stats(), "compensations_",
+                                          {"compensations_failed", "compensations_retried"}), "counter")
+        registry.collect("order_compensation_retries_total", "Compensating calls sent again after a failure or timeout", (),
+                         lambda: {(): self.saga.stats().get("compensations_retried", 0)}, "counter")
+        registry.collect("order_compensation_failures_total", "Compensations given up on after COMPENSATION_ATTEMPTS", (),
+                         lambda: {(): self.saga.stats().get("compensations_failed", 0)}, "counter")
+        registry.collect("order_checkouts_in_flight", "Checkout sagas running", (),
+                         lambda: {(): self.saga.stats()["in_flight"]})
+        registry.collect("order_price_cache_requests_total", "Price lookups by result", ("result",),
+                         lambda: {("hit",): self.prices.stats()["hits"], ("miss",): self.prices.stats()["misses"]},
+                         "counter")
+        registry.collect("order_price_cache_size", "Prices cached", (), lambda: {(): self.prices.stats()["size"]})
+
+    def threadsafe(self, fn):
+        # pika channels are not thread-safe, workers hand publishes and acks over to the I/O thread
+        if self.pool is None:
+            fn()
+        else:
+            self.connection.add_callback_threadsafe(fn)
+
+    def dispatch(self, keys, fn, *args):
+        if self.pool is None:
+            fn(*args)
+        else:
+            self.pool.submit(keys, fn, *args)
+
+    def call_later(self, delay, fn):
+        connection = self.connection
+        self.threadsafe(lambda: connection.call_later(delay, fn) if connection.is_open else None)
+
+    def ack(self, ch, delivery_tag):
+        def basic_ack():
+            # Deliveries from a connection that has since dropped get redelivered by the broker
+            if ch.is_open:
+                ch.basic_ack(delivery_tag=delivery_tag)
+        self.threadsafe(basic_ack)
 
     def callback(self, ch, method, properties, body):
-        msg = msgpack.decode(body)
-        self.logger.info(f"[{properties.reply_to}] : {msg}")
+        if is_expired(properties):
+            # The caller has already given up, don't spend a Redis round trip on it
+            self.logger.warning("[%s] Dropping expired message %s", properties.reply_to, properties.correlation_id)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            EXPIRED.inc()
+            return
         try:
-            if msg['action'] == "find_order":
-                entry = get_order_by_id_db(msg['order_id'])
-                response = {
-                    "order_id": msg['order_id'],
-                    "paid": entry.paid,
-                    "items": entry.items,
-                    "user_id": entry.user_id,
-                    "total_cost": entry.total_cost
-                }
-                self.publish_message(properties, generate_response(STATUS_SUCCESS, response))
-
-            elif msg['action'] == "create_order":
-                key = create_order_db(msg['user_id'])
-                self.publish_message(properties, generate_response(STATUS_SUCCESS, {"order_id": key}))
-
-            elif msg['action'] == "batch_init_users":
-                batch_init_users_db(msg['kv_pairs'])
-                self.publish_message(properties, generate_response(STATUS_SUCCESS, {"msg": "Batch init for orders successful"}))
-
-            elif msg['action'] == "add_item":
-                add_item_db(msg['order_id'], msg['order_entry'],properties.correlation_id)
-                response = {
-                    "order_id": msg['order_id'],
-                }
-                self.publish_message(properties, generate_response(STATUS_SUCCESS, response))
-
-            elif msg['action'] == "confirm_order":
-                confirm_order(msg['order_id'], msg['order_entry'],properties.correlation_id)
-                self.publish_message(properties, generate_response(STATUS_SUCCESS, "Checkout successful"))
-
-
-        except RedisDBError as e:
-            self.logger.error(f"[{properties.reply_to}] { msg['action']} : {msg} {e}")
-            self.publish_message(properties, generate_response(STATUS_SERVER_ERROR, DB_ERROR_STR))
-        except InsufficientCreditError as e:
-            self.logger.error(f"[{properties.reply_to}] { msg['action']} : {msg} {e}")
+            msg = decoder.decode(body)
+        except msgspec.DecodeError as e:
+            self.reject(ch, method, properties, e)
+            return
+        received = time.perf_counter()
+        IN_FLIGHT.inc()
+        if self.batcher is not None:
+            if type(msg) in BATCH_ACTIONS:
+                self.batcher.add(self.connection, (ch, method, properties, msg, received))
+                return
+            # Keep arrival order, whatever is already waiting goes first
+            self.batcher.flush()
+        if type(msg) in ASYNC_ACTIONS:
+            # Acked once complete, a redelivered message replays its steps
+            span = tracing.start_span(f"consume {msg.action}", tracing.extract(properties.headers), "consumer")
+            with self.held_lock:
+                self.held[method.delivery_tag] = (ch, msg.action, received, span)
+            handler = self.async_handlers[type(msg)]
+            # The span lasts until complete(), the service calls made on the way are its children
+            self.dispatch(message_keys(msg), tracing.bind(span.context, handler), ch, method, properties, msg)
+        else:
+            self.dispatch(message_keys(msg), self.handle, ch, method, properties, msg, received)
+
+    def on_reply(self, ch, method, properties, body):
+        self.calls.resolve(properties.correlation_id, msgpack.decode(body))
+
+    def on_item_event(self, ch, method, properties, body):
+        event = msgpack.decode(body)
+        self.logger.info("Item event: %s", event)
+        if event['event'] == "batch_init":
+            # Items 0..n-1 were re-created, probably with another price; reload them in bulk
+            self.prices.invalidate()
+            self.warm_prices([str(i) for i in range(min(event['n'], self.prices.capacity))])
+        else:
+            self.prices.invalidate(event['item_ids'])
+
+    def warm_prices(self, item_ids: list):
+        generation = self.prices.generation
+        for start in range(0, len(item_ids), PRICE_WARM_CHUNK):
+            chunk = item_ids[start:start + PRICE_WARM_CHUNK]
+            self.calls.call(STOCK_QUEUE, FindItemBulk(chunk),
+                            f"warm:{uuid.uuid4()}", time.time() + SAGA_TIMEOUT, [],
+                            partial(self.on_prices, generation))
+
+    def on_prices(self, generation, response):
+        if response['status'] == STATUS_SUCCESS:
+            self.prices.put_many(response['data']['prices'], generation)
+
+    def add_item(self, ch, method, properties, msg: AddItem):
+        # The price comes from the cache or else the stock service, the order is updated once it is known
+        log_sampled(self.logger, self.sampler, msg.action, "[%s] : %s", properties.reply_to, msg)
+        price = self.prices.get(msg.item_id)
+        if price is not None:
+            self.on_price(ch, method, properties, msg, None, generate_response(STATUS_SUCCESS, {"price": price}))
+            return
+        self.calls.call(STOCK_QUEUE, FindItem(msg.item_id),
+                        f"{properties.correlation_id}:price", message_deadline(properties), message_keys(msg),
+                        partial(self.on_price, ch, method, properties, msg, self.prices.generation))
+
+    def on_price(self, ch, method, properties, msg: AddItem, generation, response):
+        if response['status'] == STATUS_SUCCESS:
+            if generation is not None:
+                self.prices.put(msg.item_id, response['data']['price'], generation)
+            try:
+                total_cost = add_item_db(msg.order_id, msg.item_id, msg.quantity,
+                                         response['data']['price'], properties.correlation_id)
+                response = generate_response(STATUS_SUCCESS, f"Item: {msg.item_id} added to: {msg.order_id} price updated to: {total_cost}")
+            except Exception as e:
+                self.logger.error("[%s] %s : %s %s", properties.reply_to, msg.action, msg, e)
+                response = error_response(e)
+        self.complete(ch, method, properties, msg.order_id, response)
+
+    def reject(self, ch, method, properties, error):
+        # Malformed or of another queue: nothing a retry could fix, answered and dropped before any Redis work
+        self.logger.warning("[%s] Rejecting message %s: %s", properties.reply_to, properties.correlation_id, error)
+        REJECTED.inc()
+        if properties.reply_to:
             self.publish_message(properties, generate_response(STATUS_CLIENT_ERROR, REQ_ERROR_STR))
+        self.ack(ch, method.delivery_tag)
+
+    def handle(self, ch, method, properties, msg, received):
+        with tracing.start_span(f"consume {msg.action}", tracing.extract(properties.headers), "consumer"):
+            self.process(ch, method, properties, msg)
+        self.observe(msg.action, received)
+
+    def process(self, ch, method, properties, msg):
+        log_sampled(self.logger, self.sampler, msg.action, "[%s] : %s", properties.reply_to, msg)
+        try:
+            data = self.handlers[type(msg)](properties, msg)
+            self.publish_message(properties, generate_response(STATUS_SUCCESS, data))
+            if type(msg) in WRITE_ACTIONS:
+                self.publish_changes(message_keys(msg))
+
         except Exception as e:
-            self.logger.error(f"[{properties.reply_to}] { msg['action']} : {msg} {e}")
-            self.publish_message(properties, generate_response(STATUS_SERVER_ERROR, SERV_ERROR_STR))
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+            self.logger.error("[%s] %s : %s %s", properties.reply_to, msg.action, msg, e)
+            self.publish_message(properties, error_response(e))
+        self.ack(ch, method.delivery_tag)
+
+    def batch_init_users(self, properties, msg: BatchInitUsers):
+        batch_init_users_db(msg.n, msg.n_items, msg.n_users, msg.item_price, self.logger)
+        self.publish_changes(None)
+        return {"msg": "Batch init for orders successful"}
+
+    def confirm_order(self, properties, msg: ConfirmOrder):
+        confirm_order(msg.order_id, msgspec.convert(msg.order_entry, OrderValue), properties.correlation_id)
+        return success_data(msg, None)
+
+    def handle_batch(self, batch):
+        """
+        Process a batch collected by the MessageBatcher with a single pipelined
+        read and write, then publish all replies and ack the whole batch at once.
+        """
+        spans = [tracing.start_span(f"consume {msg.action}", tracing.extract(properties.headers), "consumer",
+                                    batch=len(batch)) for _, _, properties, msg, _ in batch]
+        # The shared Redis round trips are traced under the first recorded message of the batch
+        traced = next((span.context for span in spans if span.context is not None and span.context.sampled), None)
+        messages = [(msg, properties.correlation_id) for _, _, properties, msg, _ in batch]
+        try:
+            results = tracing.bind(traced, execute_batch)(messages)
+        except Exception as e:
+            results = [e] * len(batch)
+        changed = []
+        for (_, _, properties, msg, received), result, span in zip(batch, results, spans):
+            with span:
+                try:
+                    if isinstance(result, Exception):
+                        raise result
+                    response = generate_response(STATUS_SUCCESS, success_data(msg, result))
+                    if type(msg) in WRITE_ACTIONS:
+                        changed.extend(message_keys(msg))
+                except Exception as e:
+                    self.logger.error("[%s] %s : %s %s", properties.reply_to, msg.action, msg, e)
+                    response = error_response(e)
+                self.publish_message(properties, response)
+            self.observe(msg.action, received)
+        if changed:
+            self.publish_changes(changed)
+        ch, method = batch[-1][0], batch[-1][1]
+        if not ch.is_open:
+            return
+        if self.held:
+            # A multiple ack would also ack the checkouts and additions still running
+            for ch, method, _, _, _ in batch:
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+        else:
+            ch.basic_ack(delivery_tag=method.delivery_tag, multiple=True)
+
+    def observe(self, action, received):
+        MESSAGE_SECONDS.observe(time.perf_counter() - received, action)
+        IN_FLIGHT.dec()
+
+    def poll_queue(self):
+        # Runs on the I/O thread every METRICS_QUEUE_POLL seconds for as long as the connection lasts
+        try:
+            frame = self.channel.queue_declare(ORDER_QUEUE, passive=True)
+        except Exception as e:
+            self.logger.warning("Queue depth poll failed: %s", e)
+            return
+        QUEUE_DEPTH.set(frame.method.message_count, ORDER_QUEUE)
+        QUEUE_CONSUMERS.set(frame.method.consumer_count, ORDER_QUEUE)
+        self.connection.call_later(METRICS_QUEUE_POLL, self.poll_queue)
 
     def start_consuming(self):
-        self.channel.basic_qos(prefetch_count=1)
+        self.poll_queue()
+        self.channel.basic_qos(prefetch_count=CONSUMER_PREFETCH)
         self.channel.basic_consume(queue=ORDER_QUEUE, on_message_callback=self.callback)
         try:   
             self.logger.info("Starting conumer...")
@@ -93,19 +368,77 @@ class RabbitMQConsumer:
             raise RabbitMQError
         
 
+    def send(self, queue, msg: Message, corr_id, deadline, trace=None):
+        # Saga step, its reply comes back through on_reply; trace is the span context of the call
+        if deadline is None:
+            properties = pika.BasicProperties(reply_to=DIRECT_REPLY_QUEUE, correlation_id=corr_id,
+                                              headers=tracing.inject(None, trace))
+        else:
+            remaining = int((deadline - time.time()) * 1000)
+            if remaining <= 0:
+                # The saga times out on its own
+                return
+            properties = pika.BasicProperties(
+                reply_to=DIRECT_REPLY_QUEUE,
+                correlation_id=corr_id,
+                expiration=str(remaining),
+                headers=tracing.inject({DEADLINE_HEADER: int(deadline * 1000)}, trace),
+            )
+        body = encode(msg)
+        self.threadsafe(lambda: self.channel.basic_publish(exchange='', routing_key=queue, properties=properties, body=body))
+
+    def reply(self, ch, method, properties, order_id, result):
+        # Outcome of a checkout saga: None on success, else the exception or error response that ended it
+        if result is None:
+            response = generate_response(STATUS_SUCCESS, "Checkout successful")
+        elif isinstance(result, Exception):
+            response = error_response(result)
+        else:
+            response = result
+        self.complete(ch, method, properties, order_id, response)
+
+    def complete(self, ch, method, properties, order_id, response):
+        # Reply to and ack a held delivery of an ASYNC_ACTIONS message
+        with self.held_lock:
+            # Deliveries of a dropped channel were forgotten on reconnect, its tags are reused by the new one
+            entry = self.held.get(method.delivery_tag)
+            if entry is not None and entry[0] is ch:
+                del self.held[method.delivery_tag]
+            else:
+                entry = None
+        span = entry[3] if entry is not None else tracing.NO_SPAN
+        tracing.bind(span.context, self.publish_message)(properties, response)
+        self.ack(ch, method.delivery_tag)
+        if response['status'] == STATUS_SUCCESS:
+            self.publish_changes([order_id])
+        if entry is not None:
+            span.set("status", response['status'])
+            span.end()
+            self.observe(entry[1], entry[2])
+
+    def publish_changes(self, ids):
+        # Written entities, for the gateway read caches; None stands for all of them
+        body = msgpack.encode({'ids': ids})
+        self.threadsafe(lambda: self.channel.basic_publish(exchange=ENTITY_EVENTS_EXCHANGE, routing_key=ENTITY_EVENTS_KEY, body=body))
+
     def publish_message(self, properties, response):
-        self.logger.info(f"[{properties.reply_to}] Response: {response}")
-        self.channel.basic_publish(
+        log_sampled(self.logger, self.sampler, "response", "[%s] Response: %s", properties.reply_to, response)
+        body = msgpack.encode(response)
+        # Trace context of the span handling the request, read here rather than on the I/O thread
+        headers = tracing.inject()
+        self.threadsafe(lambda: self.channel.basic_publish(
             exchange='',
             routing_key=properties.reply_to,
             properties=pika.BasicProperties(
-                correlation_id=properties.correlation_id
+                correlation_id=properties.correlation_id,
+                headers=headers
             ),
-            body=msgpack.encode(response)
-        )
+            body=body
+        ))
 
 
 if __name__ == "__main__":
+    serve_metrics(METRICS_PORT)
     consumer = RabbitMQConsumer()
     while True:
         try:
@@ -4,5 +4,11 @@ class RedisDBError(Exception):
 class InsufficientCreditError(Exception):
     pass
 
+class OrderNotFoundError(Exception):
+    pass
+
+class OrderChangedError(Exception):
+    pass
+
 class RabbitMQError(Exception):
     pass
\ No newline at end of file
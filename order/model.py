@@ -1,9 +1,70 @@
-from msgspec import Struct
+from msgspec import Struct, msgpack
 from typing import Optional
 
 class OrderValue(Struct):
+    paid: bool
+    # Quantity per distinct item
+    items: dict[str, int]
+    user_id: str
+    total_cost: int
+
+
+# Stored records are msgpack arrays tagged with RECORD_VERSION, [2, paid, items, user_id,
+# total_cost], instead of maps repeating the field names. Records of earlier versions are
+# still decoded and rewritten as the current one on their next write or by migrate.py:
+# maps (extra fields such as last_upd are ignored) and version 1 arrays, both holding
+# items as a list of (item id, quantity) lines.
+RECORD_VERSION = 2
+
+
+class OrderRecord(Struct, array_like=True, tag=RECORD_VERSION):
+    paid: bool
+    items: dict[str, int]
+    user_id: str
+    total_cost: int
+
+
+class OrderRecordV1(Struct, array_like=True, tag=1):
+    paid: bool
+    items: list[tuple[str, int]]
+    user_id: str
+    total_cost: int
+
+
+class LegacyOrderValue(Struct):
     paid: bool
     items: list[tuple[str, int]]
     user_id: str
     total_cost: int
-    last_upd: str = "admin"
\ No newline at end of file
+
+
+record_encoder = msgpack.Encoder()
+record_decoder = msgpack.Decoder(OrderRecord | OrderRecordV1)
+legacy_decoder = msgpack.Decoder(LegacyOrderValue)
+
+
+def merge_items(lines: list[tuple[str, int]]) -> dict[str, int]:
+    items = {}
+    for item_id, quantity in lines:
+        items[item_id] = items.get(item_id, 0) + quantity
+    return items
+
+
+def is_compact(raw: bytes) -> bool:
+    # fixarray or array 16/32 header, as opposed to the map of the old encoding
+    return (raw[0] & 0xf0) == 0x90 or raw[0] in (0xdc, 0xdd)
+
+
+def is_current(raw: bytes) -> bool:
+    # Records have fewer than 16 fields, so the version tag follows a one byte fixarray header
+    return (raw[0] & 0xf0) == 0x90 and raw[1] == RECORD_VERSION
+
+
+def encode_record(value: OrderValue) -> bytes:
+    return record_encoder.encode(OrderRecord(value.paid, value.items, value.user_id, value.total_cost))
+
+
+def decode_record(raw: bytes) -> OrderValue:
+    record = record_decoder.decode(raw) if is_compact(raw) else legacy_decoder.decode(raw)
+    items = record.items if isinstance(record, OrderRecord) else merge_items(record.items)
+    return OrderValue(record.paid, items, record.user_id, record.total_cost)
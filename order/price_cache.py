@@ -0,0 +1,60 @@
+import threading
+from collections import OrderedDict
+
+
+class PriceCache:
+    '''
+    Bounded LRU cache of item prices.
+
+    Prices never change once an item exists, so entries are only dropped when
+    the stock service announces that items were created or re-initialized, and
+    all of them when the consumer (re)connects, as events may have been missed.
+    Every invalidation bumps the generation; a price looked up before it is not
+    stored, so a reply racing with an invalidation cannot bring a stale price
+    back.
+    '''
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, item_id: str) -> int | None:
+        with self.lock:
+            price = self.entries.get(item_id)
+            if price is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(item_id)
+            self.hits += 1
+            return price
+
+    def put_many(self, prices: dict[str, int], generation: int):
+        with self.lock:
+            if generation != self.generation:
+                return
+            for item_id, price in prices.items():
+                self.entries[item_id] = price
+                self.entries.move_to_end(item_id)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def put(self, item_id: str, price: int, generation: int):
+        self.put_many({item_id: price}, generation)
+
+    def invalidate(self, item_ids=None):
+        # Drops the given items, or everything
+        with self.lock:
+            self.generation += 1
+            if item_ids is None:
+                self.entries.clear()
+            else:
+                for item_id in item_ids:
+                    self.entries.pop(item_id, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,223 @@
+import threading
+import time
+from collections import Counter
+from functools import partial
+
+from config import *
+from exceptions import OrderNotFoundError
+from messages import Message, Checkout, RemoveStockBulk, RemoveCredit, AddStockBulk, AddFunds
+from services import get_order_by_id_db, mark_order_paid
+from service_calls import ServiceCalls, message_deadline
+
+STOCK_STEP = "stock"
+PAYMENT_STEP = "payment"
+STEPS = [STOCK_STEP, PAYMENT_STEP]
+
+
+def step_id(saga_id: str, step: str) -> str:
+    # Doubles as the operation id the stock and payment services deduplicate on
+    return f"{saga_id}:{step}"
+
+
+class CheckoutSaga:
+    '''
+    State of one checkout. Every checkout message for the same order that arrives
+    while it runs waits for it and gets its outcome.
+    '''
+
+    def __init__(self, saga_id: str, order_id: str, deadline: float):
+        self.saga_id = saga_id
+        self.order_id = order_id
+        self.deadline = deadline
+        self.order = None
+        self.items: dict[str, int] = {}
+        self.waiters = []
+        self.todo = list(STEPS)
+        self.pending: set[str] = set()
+        self.completed: set[str] = set()
+        self.unknown: set[str] = set()
+        # Steps being compensated -> attempts made, and the outcome to reply once they are
+        self.compensating: dict[str, int] = {}
+        self.error = None
+        self.result = None
+        self.done = False
+
+
+class CheckoutOrchestrator:
+    '''
+    Runs checkout sagas inside the order service.
+
+    Steps are sent to the stock and payment services as ServiceCalls, so no
+    thread waits on a reply and any number of checkouts can be in flight; a step
+    still unanswered at the checkout's deadline counts as failed with an unknown
+    outcome. Step messages carry
+    correlation ids derived from the saga id, which the services use as operation
+    ids: a redelivered checkout replays its steps without applying them twice, and
+    a compensation only undoes a step that actually ran.
+
+    With CHECKOUT_PARALLEL the stock and payment steps are sent together and the
+    saga waits for both; if either fails, whatever went through is compensated.
+    A failed checkout is only answered once its compensations are, so a client
+    reading right after it sees the stock and credit back. A compensation is
+    retried until it succeeds, up to COMPENSATION_ATTEMPTS times; one that never
+    does is counted in compensations_failed and logged.
+
+    State changes of a saga are dispatched under the order id, so they never run
+    concurrently with each other or with other writes to the same order.
+    '''
+
+    def __init__(self, transport, calls: ServiceCalls, logger):
+        # transport: the consumer, which replies to and acks the checkout messages
+        self.transport = transport
+        self.calls = calls
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.sagas: dict[str, CheckoutSaga] = {}
+        # Checkouts by outcome and compensations by step, since the service started
+        self.counters = Counter()
+
+    @property
+    def active(self) -> bool:
+        return bool(self.sagas)
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counters, in_flight=len(self.sagas))
+
+    def reset(self):
+        # Checkouts of a dropped connection are redelivered unacked and replayed
+        with self.lock:
+            self.sagas.clear()
+
+    def start(self, ch, method, properties, msg: Checkout):
+        order_id = msg.order_id
+        with self.lock:
+            saga = self.sagas.get(order_id)
+            if saga is not None:
+                saga.waiters.append((ch, method, properties))
+                return
+            saga = CheckoutSaga(properties.correlation_id, order_id, message_deadline(properties))
+            saga.waiters.append((ch, method, properties))
+            self.sagas[order_id] = saga
+        try:
+            order = get_order_by_id_db(order_id)
+            if order is None:
+                raise OrderNotFoundError
+        except Exception as e:
+            self.finish(saga, e)
+            return
+        if order.paid:
+            self.finish(saga, None)
+            return
+        saga.order = order
+        saga.items = dict(order.items)
+        self.advance(saga)
+
+    def step_message(self, saga: CheckoutSaga, step: str) -> tuple[str, Message]:
+        if step == STOCK_STEP:
+            return STOCK_QUEUE, RemoveStockBulk(saga.items, saga.order_id)
+        return PAYMENT_QUEUE, RemoveCredit(saga.order.user_id, saga.order.total_cost, saga.order_id)
+
+    def compensation_message(self, saga: CheckoutSaga, step: str) -> tuple[str, Message]:
+        undo = step_id(saga.saga_id, step)
+        if step == STOCK_STEP:
+            return STOCK_QUEUE, AddStockBulk(saga.items, saga.order_id, undo)
+        return PAYMENT_QUEUE, AddFunds(saga.order.user_id, saga.order.total_cost, saga.order_id, undo)
+
+    def launch(self, saga: CheckoutSaga, step: str):
+        saga.pending.add(step)
+        queue, msg = self.step_message(saga, step)
+        self.calls.call(queue, msg, step_id(saga.saga_id, step), saga.deadline, [saga.order_id],
+                        partial(self.on_step, saga, step))
+
+    def advance(self, saga: CheckoutSaga):
+        if saga.pending:
+            return
+        if saga.error is not None:
+            self.compensate(saga, saga.error)
+        elif saga.todo:
+            steps = saga.todo if CHECKOUT_PARALLEL else saga.todo[:1]
+            saga.todo = saga.todo[len(steps):]
+            for step in steps:
+                self.launch(saga, step)
+        else:
+            try:
+                # Fails if an item was added since the order was read, that item was neither reserved nor charged
+                mark_order_paid(saga.order_id, saga.order, step_id(saga.saga_id, "confirm"))
+            except Exception as e:
+                # Both reservations went through but the order could not be marked paid
+                self.logger.error("[checkout] %s confirm failed: %s", saga.order_id, e)
+                self.compensate(saga, e)
+                return
+            self.finish(saga, None)
+
+    def on_step(self, saga: CheckoutSaga, step: str, response: dict):
+        if saga.done or step not in saga.pending:
+            return
+        saga.pending.discard(step)
+        if response['status'] == STATUS_SUCCESS:
+            saga.completed.add(step)
+        else:
+            if response['status'] != STATUS_CLIENT_ERROR:
+                # The step may or may not have been applied
+                saga.unknown.add(step)
+            if saga.error is None:
+                saga.error = response
+        self.advance(saga)
+
+    def compensate(self, saga: CheckoutSaga, result):
+        # Undoes whatever may have gone through, then finishes with result
+        saga.result = result
+        for step in STEPS:
+            if step in saga.completed or step in saga.unknown:
+                saga.compensating[step] = 0
+                self.count(f"compensations_{step}")
+        if not saga.compensating:
+            self.finish(saga, result)
+            return
+        for step in list(saga.compensating):
+            self.send_compensation(saga, step)
+
+    def send_compensation(self, saga: CheckoutSaga, step: str):
+        saga.compensating[step] += 1
+        queue, msg = self.compensation_message(saga, step)
+        # Every attempt has the same operation id, the service applies the undo at most once
+        self.calls.call(queue, msg, step_id(saga.saga_id, f"{step}:undo"), time.time() + COMPENSATION_TIMEOUT,
+                        [saga.order_id], partial(self.on_compensated, saga, step))
+
+    def on_compensated(self, saga: CheckoutSaga, step: str, response: dict):
+        attempts = saga.compensating.get(step)
+        if attempts is None:
+            return
+        if response['status'] != STATUS_SUCCESS:
+            if attempts < COMPENSATION_ATTEMPTS:
+                self.logger.warning("[checkout] %s compensation of %s failed, retrying: %s",
+                                    saga.order_id, step, response)
+                self.count("compensations_retried")
+                self.transport.call_later(COMPENSATION_RETRY_DELAY, lambda: self.transport.dispatch(
+                    [saga.order_id], self.send_compensation, saga, step))
+                return
+            self.logger.error("[checkout] %s compensation of %s failed: %s", saga.order_id, step, response)
+            self.count("compensations_failed")
+        del saga.compensating[step]
+        if not saga.compensating:
+            self.finish(saga, saga.result)
+
+    def finish(self, saga: CheckoutSaga, result):
+        with self.lock:
+            saga.done = True
+            if self.sagas.get(saga.order_id) is saga:
+                del self.sagas[saga.order_id]
+            waiters = saga.waiters
+            if result is None:
+                self.counters["checkouts_succeeded"] += 1
+            elif isinstance(result, dict) and result['status'] == STATUS_GATEWAY_TIMEOUT:
+                self.counters["checkouts_timed_out"] += 1
+            else:
+                self.counters["checkouts_failed"] += 1
+        for ch, method, properties in waiters:
+            self.transport.reply(ch, method, properties, saga.order_id, result)
@@ -0,0 +1,137 @@
+# Server-side scripts, registered once and run with EVALSHA (redis-py falls back to
+# EVAL when the script cache was flushed).
+
+# Write an order unless the operation that produced it was applied before.
+#
+# KEYS[1]: order id
+# KEYS[2]: idempotency key of the operation
+# ARGV[1]: encoded order
+# ARGV[2]: TTL of the idempotency key in seconds
+#
+# Returns 1 = written, 0 = duplicate operation (nothing changed).
+SET_ONCE = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[2], 1, 'EX', ARGV[2])
+return 1
+"""
+
+# Orders are stored as [version, paid, items, user_id, total_cost] arrays with items
+# a map of item id to quantity (see model.py); maps and version 1 arrays, with items
+# as a list of (item id, quantity) lines, are still read, and rewritten as the
+# current version.
+ORDER_CODEC = """
+local function merge_items(lines)
+    local items = {}
+    for _, line in ipairs(lines) do
+        items[line[1]] = (items[line[1]] or 0) + line[2]
+    end
+    return items
+end
+
+local function decode_order(raw)
+    local value = cmsgpack.unpack(raw)
+    if value[1] == 2 then
+        return {paid = value[2], items = value[3], user_id = value[4], total_cost = value[5]}
+    elseif value[1] == 1 then
+        return {paid = value[2], items = merge_items(value[3]), user_id = value[4], total_cost = value[5]}
+    end
+    value.items = merge_items(value.items)
+    return value
+end
+
+local function encode_order(order)
+    return cmsgpack.pack({2, order.paid, order.items, order.user_id, order.total_cost})
+end
+"""
+
+# Add an item to an order unless the operation was applied before.
+#
+# KEYS[1]: order id
+# KEYS[2]: idempotency key of the operation
+# ARGV[1]: item id
+# ARGV[2]: quantity
+# ARGV[3]: unit price
+# ARGV[4]: TTL of the idempotency key in seconds
+#
+# Returns the order's total cost, or -1 if the order does not exist.
+ADD_ITEM = ORDER_CODEC + """
+local raw = redis.call('GET', KEYS[1])
+if not raw then
+    return -1
+end
+local order = decode_order(raw)
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return order.total_cost
+end
+order.items[ARGV[1]] = (order.items[ARGV[1]] or 0) + tonumber(ARGV[2])
+order.total_cost = order.total_cost + tonumber(ARGV[2]) * tonumber(ARGV[3])
+redis.call('SET', KEYS[1], encode_order(order))
+redis.call('SET', KEYS[2], 1, 'EX', ARGV[4])
+return order.total_cost
+"""
+
+
+# Mark an order paid unless the operation was applied before, provided it still holds
+# the items and total cost a checkout reserved and charged: an item added while the
+# checkout ran must not end up paid for without having been.
+#
+# KEYS[1]: order id
+# KEYS[2]: idempotency key of the operation
+# ARGV[1]: encoded order, the checked one with paid set
+# ARGV[2]: TTL of the idempotency key in seconds
+# ARGV[3]: total cost checked out
+# ARGV[4..]: item id, quantity, ... checked out
+#
+# Returns 1 = confirmed, 0 = duplicate operation, -1 = no such order, -2 = the order
+# changed since it was checked out (nothing changed).
+CONFIRM_ORDER = ORDER_CODEC + """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+local raw = redis.call('GET', KEYS[1])
+if not raw then
+    return -1
+end
+local order = decode_order(raw)
+if order.total_cost ~= tonumber(ARGV[3]) then
+    return -2
+end
+local lines = 0
+for _ in pairs(order.items) do
+    lines = lines + 1
+end
+if 2 * lines ~= #ARGV - 3 then
+    return -2
+end
+for i = 4, #ARGV, 2 do
+    if order.items[ARGV[i]] ~= tonumber(ARGV[i + 1]) then
+        return -2
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[2], 1, 'EX', ARGV[2])
+return 1
+"""
+
+
+# Replace records that still hold the value they were read with.
+#
+# KEYS:  record keys
+# ARGV:  per key, the value read and its replacement
+#
+# Used by migrate.py to rewrite records while the service keeps running: a record
+# written in between is left alone (it is written compact anyway). Returns the
+# number of records replaced.
+REPLACE_IF_UNCHANGED = """
+local replaced = 0
+for i = 1, #KEYS do
+    if redis.call('GET', KEYS[i]) == ARGV[2 * i - 1] then
+        redis.call('SET', KEYS[i], ARGV[2 * i], 'KEEPTTL')
+        replaced = replaced + 1
+    end
+end
+return replaced
+"""
@@ -0,0 +1,61 @@
+import threading
+import time
+
+import tracing
+from config import *
+from messages import Message
+
+
+def message_deadline(properties) -> float:
+    # Absolute deadline (epoch seconds) of an incoming message, SAGA_TIMEOUT from now if it has none
+    deadline = (properties.headers or {}).get(DEADLINE_HEADER)
+    return deadline / 1000 if deadline is not None else time.time() + SAGA_TIMEOUT
+
+
+def timeout_response():
+    return {"status": STATUS_GATEWAY_TIMEOUT, "data": TIMEOUT_ERROR_STR}
+
+
+class ServiceCalls:
+    '''
+    Requests the order service sends to the stock and payment services.
+
+    Replies come back on the consumer's direct reply-to and are matched on the
+    correlation id. Each reply is handed to the callback of its call, dispatched
+    under the call's keys like any other message, so the caller's thread never
+    waits. A call still unanswered at its deadline resolves to a 504 instead, and
+    a reply that arrives after that is ignored. Each call is a client span, and
+    its callback runs under the span that was current when the call was made.
+    '''
+
+    def __init__(self, transport, logger):
+        # transport: the consumer, which owns the channel (send, dispatch, call_later)
+        self.transport = transport
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.pending: dict[str, tuple[list, object, object]] = {}
+
+    def reset(self):
+        # Replies to calls made on a dropped connection are lost with it
+        with self.lock:
+            self.pending.clear()
+
+    def call(self, queue: str, msg: Message, corr_id: str, deadline: float | None, keys: list, callback):
+        span = tracing.start_span(f"call {msg.action}", kind="client", queue=queue)
+        callback = tracing.bind(tracing.current.get(), callback)
+        with self.lock:
+            self.pending[corr_id] = (keys, callback, span)
+        self.transport.send(queue, msg, corr_id, deadline, span.context)
+        if deadline is not None:
+            self.transport.call_later(max(deadline - time.time(), 0),
+                                      lambda: self.resolve(corr_id, timeout_response()))
+
+    def resolve(self, corr_id: str, response: dict):
+        with self.lock:
+            entry = self.pending.pop(corr_id, None)
+        if entry is None:
+            return
+        keys, callback, span = entry
+        span.set("status", response['status'])
+        span.end()
+        self.transport.dispatch(keys, callback, response)
@@ -1,94 +1,179 @@
 import atexit
 import os
-import time
 import uuid
 import redis
+import random
 import socket
-from msgspec import msgpack
-from model import OrderValue
+import msgspec
+from model import OrderValue, encode_record, decode_record
+from scripts import SET_ONCE, ADD_ITEM, CONFIRM_ORDER
+from idempotency import idempotency
+from bulk_load import bulk_load, pipelined_mset
+from redis_client import RedisClient, create_client
 from config import *
 
-from exceptions import RedisDBError
+from exceptions import RedisDBError, OrderNotFoundError, OrderChangedError
+from messages import Message, FindOrder, ConfirmOrder
 
 
 def connect_redis():
-    db_conn: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST'],
-                              port=int(os.environ['REDIS_PORT']),
-                              password=os.environ['REDIS_PASSWORD'],
-                              db=int(os.environ['REDIS_DB']))
+    db_conn: RedisClient = create_client(os.environ['REDIS_HOST'], int(os.environ['REDIS_PORT']),
+                                         int(os.environ['REDIS_DB']), os.environ['REDIS_PASSWORD'])
     return db_conn
 
-def retry_connection():
-    global db 
-    for attempt in range(1, MAX_RETRIES):
-        try: 
-            db = connect_redis()
-            db.ping()
-        except redis.exceptions.ConnectionError:
-            if attempt < MAX_RETRIES:
-                time.sleep(SLEEP_TIME)
-            else:
-                raise RedisDBError
-                
 
 def close_db_connection():
     db.close()
 
 
+
+def db_stats() -> dict:
+    # Circuit breaker state and per-command latencies of this replica's Redis client
+    return db.stats()
+
+
 db = connect_redis()
 atexit.register(close_db_connection)
+set_once_script = db.register_script(SET_ONCE)
+add_item_script = db.register_script(ADD_ITEM)
+confirm_order_script = db.register_script(CONFIRM_ORDER)
+
 
 def get_order_by_id_db(order_id: str) :
     try:
         entry: bytes = db.get(order_id)
-    except redis.exceptions.ConnectionError:
-        retry_connection()
-        entry: bytes = db.get(order_id)
     except redis.exceptions.RedisError:
         raise RedisDBError(Exception)
-    entry: OrderValue | None = msgpack.decode(entry, type=OrderValue) if entry else None
+    entry: OrderValue | None = decode_record(entry) if entry else None
     return entry
 
 def create_order_db(user_id: str):
     key = str(uuid.uuid4())
-    value = msgpack.encode(OrderValue(paid=False, items=[], user_id=user_id, total_cost=0))
+    value = encode_record(OrderValue(paid=False, items={}, user_id=user_id, total_cost=0))
     try:
         db.set(key, value)
-    except redis.exceptions.ConnectionError:
-        retry_connection()
-        db.set(key, value)
     except redis.exceptions.RedisError:
         raise RedisDBError(Exception)
     return key
 
-def batch_init_users_db(kv_pairs):
+def generate_orders(low: int, high: int, n_items: int, n_users: int, item_price: int) -> dict[str, bytes]:
+    # Orders low..high-1, each for two random items of a random user
+    entries = {}
+    for i in range(low, high):
+        user_id = random.randint(0, n_users - 1)
+        item1_id = random.randint(0, n_items - 1)
+        item2_id = random.randint(0, n_items - 1)
+        items = {f"{item1_id}": 1}
+        items[f"{item2_id}"] = items.get(f"{item2_id}", 0) + 1
+        entries[f"{i}"] = encode_record(OrderValue(paid=False,
+                                                    items=items,
+                                                    user_id=f"{user_id}",
+                                                    total_cost=2 * item_price))
+    return entries
+
+
+def batch_init_users_db(n: int, n_items: int, n_users: int, item_price: int, logger=None) -> int:
+    n_items, n_users, item_price = int(n_items), int(n_users), int(item_price)
     try:
-        db.mset(kv_pairs)
-    except redis.exceptions.ConnectionError:
-        retry_connection()
-        db.mset(kv_pairs)
+        return bulk_load(n, lambda low, high: generate_orders(low, high, n_items, n_users, item_price),
+                         lambda chunks: pipelined_mset(db, chunks), logger)
+    except redis.exceptions.RedisError:
+        raise RedisDBError(Exception)
+
+
+def set_order_once(order_id, order_entry, new_upd):
+    # One EVALSHA: the order is written and the operation recorded together
+    keys = [order_id, idempotency.key(new_upd)]
+    args = [encode_record(order_entry), idempotency.ttl]
+    try:
+        set_once_script(keys=keys, args=args, client=db)
     except redis.exceptions.RedisError:
         raise RedisDBError(Exception)
-    
-def add_item_db(order_id, order_entry, new_upd):
-    order = get_order_by_id_db(order_id)
-    if order.last_upd != new_upd:
-        try:
-            db.set(order_id, msgpack.encode(order_entry))
-        except redis.exceptions.ConnectionError:
-            retry_connection()
-            db.set(order_id, msgpack.encode(order_entry))
-        except redis.exceptions.RedisError:
-            raise RedisDBError(Exception)
-    
+
+
+def add_item_db(order_id: str, item_id: str, quantity: int, price: int, new_upd: str) -> int:
+    # One EVALSHA: concurrent additions to the same order cannot overwrite each other
+    keys = [order_id, idempotency.key(new_upd)]
+    args = [item_id, quantity, price, idempotency.ttl]
+    try:
+        total_cost = add_item_script(keys=keys, args=args, client=db)
+    except redis.exceptions.RedisError:
+        raise RedisDBError(Exception)
+    if total_cost == -1:
+        raise OrderNotFoundError
+    return total_cost
+
 
 def confirm_order(order_id, order_entry, new_upd):
-    order = get_order_by_id_db(order_id)
-    if order.last_upd != new_upd:
+    set_order_once(order_id, order_entry, new_upd)
+
+
+def mark_order_paid(order_id: str, order: OrderValue, new_upd: str):
+    # One EVALSHA: only paid changes, and only if the order still is the one checked out
+    keys = [order_id, idempotency.key(new_upd)]
+    args = [encode_record(msgspec.structs.replace(order, paid=True)), idempotency.ttl, order.total_cost]
+    for item_id, quantity in order.items.items():
+        args += [item_id, quantity]
+    try:
+        result = confirm_order_script(keys=keys, args=args, client=db)
+    except redis.exceptions.RedisError:
+        raise RedisDBError(Exception)
+    if result == -1:
+        raise OrderNotFoundError
+    if result == -2:
+        raise OrderChangedError
+
+def apply_batch_op(orders: dict, dirty: set, markers: dict, msg: Message, new_upd: str) -> OrderValue | None:
+    order_id = msg.order_id
+    order: OrderValue | None = orders.get(order_id)
+    if isinstance(msg, FindOrder):
+        # Later messages of the batch may still change the in-memory entry
+        return msgspec.structs.replace(order, items=dict(order.items)) if order else None
+    elif isinstance(msg, ConfirmOrder):
+        if new_upd not in markers:
+            orders[order_id] = msgspec.convert(msg.order_entry, OrderValue)
+            dirty.add(order_id)
+            markers[new_upd] = True
+    else:
+        raise ValueError(f"{msg.action} can't be batched")
+
+
+def execute_batch(ops: list[tuple[Message, str]]) -> list:
+    '''
+    Execute a batch of (message, operation id) pairs with one MGET and one MULTI.
+
+    Messages are applied in order on in-memory entries, later messages see the
+    effect of earlier ones. The orders and the idempotency keys are WATCHed and a
+    concurrent write from another replica restarts the batch from fresh reads. Returns, per message,
+    its result or the exception it raised.
+    '''
+    order_ids = sorted({msg.order_id for msg, _ in ops})
+    op_keys = [idempotency.key(new_upd) for _, new_upd in ops]
+    for attempt in range(BATCH_MAX_RETRIES):
         try:
-            db.set(order_id, msgpack.encode(order_entry))   
-        except redis.exceptions.ConnectionError:
-            retry_connection()
-            db.set(order_id, msgpack.encode(order_entry))
+            with db.pipeline() as pipe:
+                pipe.watch(*order_ids, *op_keys)
+                entries = pipe.mget(order_ids)
+                orders = {order_id: decode_record(entry) if entry else None
+                          for order_id, entry in zip(order_ids, entries)}
+                seen = idempotency.seen(pipe, [new_upd for _, new_upd in ops])
+                markers = dict(seen)
+                dirty = set()
+                results = []
+                for msg, new_upd in ops:
+                    try:
+                        results.append(apply_batch_op(orders, dirty, markers, msg, new_upd))
+                    except Exception as e:
+                        results.append(e)
+                pipe.multi()
+                if dirty:
+                    pipe.mset({order_id: encode_record(orders[order_id]) for order_id in dirty})
+                for op_id in markers.keys() - seen.keys():
+                    idempotency.record(pipe, op_id)
+                pipe.execute()
+            return results
+        except redis.exceptions.WatchError:
+            continue
         except redis.exceptions.RedisError:
-            raise RedisDBError(Exception)
\ No newline at end of file
+            raise RedisDBError(Exception)
+    raise RedisDBError(Exception)
@@ -1,125 +1,72 @@
+import asyncio
+import functools
 import logging
-import uuid
-import random
-import pika
-import os
-from threading import Thread
-from msgspec import msgpack, Struct
-from flask import Flask, jsonify, abort, Response, request
+import time
+from quart import Quart, jsonify, abort, request
 from config import *
+from rpc_client import RabbitMQClient, request_deadline
+from read_cache import ReadCache
+from logs import configure_logger, LogSampler, log_sampled
+from metrics import registry, CONTENT_TYPE
+from messages import (DbStats, CreateOrder, BatchInitUsers, FindOrder, AddItem, Checkout, CheckoutStats,
+                      PriceCacheStats)
+import tracing
 from datetime import datetime
-import time 
 
-app = Flask("order-gateway")
+app = Quart("order-gateway")
 
-class OrderValue(Struct):
-    paid: bool
-    items: list[tuple[str, int]]
-    user_id: str
-    total_cost: int
+rabbitmq_client = RabbitMQClient(app.logger)
+read_cache = ReadCache("order", app.logger)
 
-class RabbitMQClient:
+inflight = asyncio.Semaphore(GATEWAY_MAX_INFLIGHT)
+log_sampler = LogSampler(LOG_SAMPLE)
 
-    def connect(self):
-        app.logger.info("Connecting to broker...")
-        self.connection = pika.BlockingConnection(pika.URLParameters(os.environ['RABBITMQ_BROKER_URL']))
-        self.channel = self.connection.channel()
-        self.channel.queue_declare(queue=ORDER_QUEUE)
-        self.channel.queue_declare(queue=STOCK_QUEUE)
-        self.channel.queue_declare(queue=PAYMENT_QUEUE)
+# Metrics of this worker process, served at /metrics
+REQUEST_SECONDS = registry.histogram("gateway_request_seconds", "Time to answer a request, by endpoint and status",
+                                     ("endpoint", "status"))
+IN_FLIGHT = registry.gauge("gateway_requests_in_flight", "Requests being served")
+registry.collect("gateway_read_cache_requests_total", "Read cache lookups by result", ("result",),
+                 lambda: {("hit",): read_cache.stats()["hits"], ("miss",): read_cache.stats()["misses"]}, "counter")
 
-    def __init__(self):
-        self.connect()
 
+def rpc_route(fn):
+    '''
+    Run a route as a coroutine on the event loop.
 
-    def call(self, message, queue, is_message_sent = False, retry_queue = None, retry_corr_id = None):
-        corr_id = None
-        response_queue = None
-        try:
-            if is_message_sent:
-                corr_id = retry_corr_id
-                response_queue = retry_queue
-            else:
-                corr_id = str(uuid.uuid4())
-                response_queue = self.channel.queue_declare(queue='', exclusive=True).method.queue
-            
-            def on_response(ch, method, props, body):
-                if corr_id == props.correlation_id:
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
-                    self.response = msgpack.decode(body)
-                    ch.stop_consuming()
-
-            self.channel.basic_consume(queue=response_queue, on_message_callback=on_response, auto_ack=False)
-            self.response = None
-            if not is_message_sent:
-                self.channel.basic_publish(
-                    exchange='',
-                    routing_key=queue,
-                    properties=pika.BasicProperties(
-                        reply_to=response_queue,
-                        correlation_id=corr_id,
-                    ),
-                    body=msgpack.encode(message)
-                )
-                is_message_sent = True
-
-            while self.response is None:
-                self.connection.process_data_events(time_limit=None)
-
-            return self.response
-        except Exception as e:
-            app.logger.error(e)
-            while True:
-                try:
-                    self.connect()
-                    if is_message_sent:
-                        return self.call(message, queue, is_message_sent, response_queue, corr_id)
-                    else:
-                        return self.call(message, queue)
-                except Exception as e:
-                    time.sleep(5)
-                    app.logger.error("Reconnecting...")
-
-rabbitmq_client = RabbitMQClient()
-
-class ThreadWithReturnValue(Thread):
-    
-    def __init__(self, group=None, target=None, name=None,
-                 args=(), kwargs={}, Verbose=None):
-        Thread.__init__(self, group, target, name, args, kwargs)
-        self._return = None
-
-    def run(self):
-        if self._target is not None:
-            self._return = self._target(*self._args,
-                                                **self._kwargs)
-    def join(self, *args):
-        Thread.join(self, *args)
-        return self._return
-
-
-def threaded(fn):
-    def wrapper(*args, **kwargs):
+    At most GATEWAY_MAX_INFLIGHT requests per process wait on the broker at once,
+    the rest queue on the semaphore. Every RPC made by the route shares one
+    deadline, RPC_TIMEOUT seconds after the request arrived, and a missed deadline
+    comes back as a 504. The RPC response dict is mapped onto jsonify/abort exactly
+    like the old thread-per-request wrapper did. Each request is timed in the
+    metrics and is the server span of its trace.
+    '''
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
         endpoint = request.endpoint
-        request_data = request.get_json() if request.is_json else request.get_data()
-        timestamp = datetime.now()
-        app.logger.info(f"[{timestamp}] API: {endpoint} | {request_data}")        
-        
-        def callback():
-            try:
-                # endpoint = request.endpoint
-                # request_data = request.get_json() if request.is_json else request.values.to_dict()
-                # timestamp = datetime.utcnow().isoformat()
-                # app.logger.info(f"[{timestamp}] API: {endpoint} | {request_data}")
-                return fn(*args, **kwargs)
-            except Exception as e:
-                app.logger.error(f"Error in thread: {e}")
-                return {"status":500, "data":f"{e}"}
-        
-        thread = ThreadWithReturnValue(target=callback)
-        thread.start()
-        response = thread.join()
-        app.logger.info(f"Response: {response}")
+        if app.logger.isEnabledFor(logging.INFO) and log_sampler.keep(endpoint):
+            # The body is only read for the log line
+            request_data = await request.get_json() if request.is_json else await request.get_data()
+            app.logger.info("[%s] API: %s | %s", datetime.now(), endpoint, request_data, extra={"action": endpoint})
+
+        start = time.perf_counter()
+        IN_FLIGHT.inc()
+        request_deadline.set(time.time() + RPC_TIMEOUT)
+        try:
+            # A trace started by the client or the proxy is continued, else this is the root span
+            with tracing.start_span(endpoint, tracing.extract(request.headers), "server") as span:
+                async with inflight:
+                    try:
+                        response = await fn(*args, **kwargs)
+                    except Exception as e:
+                        app.logger.error("Error in request: %s", e)
+                        response = {"status":500, "data":f"{e}"}
+                status = response['status'] if response is not None else 500
+                span.set("status", status)
+        finally:
+            # Also when the client goes away and the request is cancelled
+            IN_FLIGHT.dec()
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint, status)
+        log_sampled(app.logger, log_sampler, "response", "Response: %s", response)
         if response is not None:
             if response['status'] == STATUS_SUCCESS:
                 return jsonify(response['data'])
@@ -128,109 +75,82 @@ def threaded(fn):
         else:
             return abort(500, SERV_ERROR_STR)
 
-
-    wrapper.__name__ = f"{fn.__name__}_wrapper"
     return wrapper
 
 
 @app.post('/create/<user_id>')
-@threaded
-def create_order(user_id: str):
-    response = rabbitmq_client.call({'action': 'create_order','user_id':user_id}, ORDER_QUEUE)
+@rpc_route
+async def create_order(user_id: str):
+    response = await rabbitmq_client.call_async(CreateOrder(user_id), ORDER_QUEUE)
     return response
 
 
 
 @app.post('/batch_init/<n>/<n_items>/<n_users>/<item_price>')
-@threaded
-def batch_init_users(n: int, n_items: int, n_users: int, item_price: int):
-
-    n = int(n)
-    n_items = int(n_items)
-    n_users = int(n_users)
-    item_price = int(item_price)
-
-    def generate_entry() -> OrderValue:
-        user_id = random.randint(0, n_users - 1)
-        item1_id = random.randint(0, n_items - 1)
-        item2_id = random.randint(0, n_items - 1)
-        value = OrderValue(paid=False,
-                           items=[(f"{item1_id}", 1), (f"{item2_id}", 1)],
-                           user_id=f"{user_id}",
-                           total_cost=2*item_price)
-        return value
-
-    kv_pairs: dict[str, bytes] = {f"{i}": msgpack.encode(generate_entry())
-                                  for i in range(n)}
-
-    response = rabbitmq_client.call({'action': 'batch_init_users','kv_pairs':kv_pairs}, ORDER_QUEUE)
+@rpc_route
+async def batch_init_users(n: int, n_items: int, n_users: int, item_price: int):
+    # The order service generates and writes the orders itself, in chunks
+    response = await rabbitmq_client.call_async(BatchInitUsers(int(n), int(n_items), int(n_users), int(item_price)),
+                                                ORDER_QUEUE, time.time() + BATCH_INIT_TIMEOUT)
     return response
 
 
 @app.get('/find/<order_id>')
-@threaded
-def find_order(order_id: str):
-    response = rabbitmq_client.call({'action': 'find_order','order_id':order_id}, ORDER_QUEUE)
-    return response
+@rpc_route
+async def find_order(order_id: str):
+    return await read_cache.fetch(order_id, lambda: rabbitmq_client.call_async(
+        FindOrder(order_id), ORDER_QUEUE))
 
 
 @app.post('/addItem/<order_id>/<item_id>/<quantity>')
-@threaded
-def add_item(order_id: str, item_id: str, quantity: int):
-    
-    order_details = rabbitmq_client.call({'action': 'find_order','order_id':order_id}, ORDER_QUEUE)
-    if order_details['status'] != 200:
-        return order_details
-    order_details = order_details['data']
-
-    item_details = rabbitmq_client.call({'action':'find_item', 'item_id': item_id}, STOCK_QUEUE)
-    if item_details['status'] != 200:
-        return item_details
-    item_details = item_details['data']
-
-    order_details['items'].append((item_id, int(quantity)))
-    order_details['total_cost'] += int(quantity) * item_details['price']
-
-    response = rabbitmq_client.call({'action': 'add_item','order_id':order_id,'order_entry': order_details}, ORDER_QUEUE)
-    if response['status']!=200:
-        return response
-    response['data'] = f"Item: {item_id} added to: {order_id} price updated to: {order_details["total_cost"]}"
+@rpc_route
+async def add_item(order_id: str, item_id: str, quantity: int):
+    # The order service looks up the price and updates the order in one step
+    response = await rabbitmq_client.call_async(AddItem(order_id, item_id, int(quantity)), ORDER_QUEUE)
+    # The invalidation event may reach this worker after the reply, so a find right after sees the write
+    read_cache.invalidate([order_id])
     return response
 
 @app.post('/checkout/<order_id>')
-@threaded
-def checkout(order_id: str):
-    app.logger.debug(f"Checking out {order_id}")
-    order_details = rabbitmq_client.call({'action': 'find_order','order_id':order_id}, ORDER_QUEUE)
-    if order_details['status']!= 200:
-        return order_details
-    order_details = order_details['data']
-    
-    if not order_details['paid']:
-        item_data = {}
-        for item in order_details['items']:
-            item_data[item[0]] = item[1]
-        
-        stock_sub_response = rabbitmq_client.call({'action': 'remove_stock_bulk','data':item_data, 'order_id': order_id}, STOCK_QUEUE)
-        if stock_sub_response['status'] != 200:
-            if stock_sub_response['status'] == 500:
-                stock_add_response = rabbitmq_client.call({'action':'add_stock_bulk', 'data':item_data, 'order_id': order_id}, STOCK_QUEUE)
-            return stock_sub_response
-        
-        payment_sub_response = rabbitmq_client.call({'action': 'remove_credit','user_id':order_details['user_id'], 'amount': order_details['total_cost'], 'order_id':order_id}, PAYMENT_QUEUE)
-        if payment_sub_response['status'] != 200:
-            # Fix response
-            if payment_sub_response['status'] == 500:
-                payment_add_response = rabbitmq_client.call({'action': 'add_funds','user_id':order_details['user_id'], 'amount': order_details['total_cost'], 'order_id':order_id}, PAYMENT_QUEUE)
-            stock_add_response = rabbitmq_client.call({'action':'add_stock_bulk', 'data':item_data, 'order_id': order_id}, STOCK_QUEUE)
-            return payment_sub_response
-        order_details['paid'] = True
-    confirm_order_response = rabbitmq_client.call({'action':'confirm_order', 'order_id': order_id, 'order_entry': order_details}, ORDER_QUEUE)
-    return confirm_order_response
+@rpc_route
+async def checkout(order_id: str):
+    app.logger.debug("Checking out %s", order_id)
+    # The order service runs the whole saga, stock and payment included
+    response = await rabbitmq_client.call_async(Checkout(order_id), ORDER_QUEUE)
+    read_cache.invalidate([order_id])
+    return response
+
+@app.get('/checkout_stats')
+@rpc_route
+async def checkout_stats():
+    # Saga counters (outcomes, compensations per step) of the order service replica that answers
+    return await rabbitmq_client.call_async(CheckoutStats(), ORDER_QUEUE)
+
+@app.get('/price_cache_stats')
+@rpc_route
+async def price_cache_stats():
+    # Item price cache of the order service replica that answers
+    return await rabbitmq_client.call_async(PriceCacheStats(), ORDER_QUEUE)
+
+@app.get('/db_stats')
+@rpc_route
+async def db_stats():
+    # Redis circuit breaker and per-command latencies of the order service replica that answers
+    return await rabbitmq_client.call_async(DbStats(), ORDER_QUEUE)
+
+@app.get('/cache_stats')
+async def cache_stats():
+    # Hit/miss counters of this worker's read cache
+    return jsonify(read_cache.stats())
+
+
+@app.get('/metrics')
+async def metrics():
+    # Prometheus text format; each gunicorn worker keeps and serves its own
+    return registry.render(), 200, {"Content-Type": CONTENT_TYPE}
+
 
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=8000, debug=True)
 else:
-    gunicorn_logger = logging.getLogger('gunicorn.error')
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
+    configure_logger(app.logger, LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE, background=LOG_BACKGROUND)
@@ -0,0 +1,173 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds; from sub-millisecond Redis commands up to the RPC deadlines
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        super().__init__(name, documentation, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return self.header() + [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in values]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    '''
+    Cumulative buckets, sum and count per label set. observe() is one bisect
+    and three additions under a lock, cheap enough for every message and every
+    Redis command.
+    '''
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self.children: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            child = self.children.get(labels)
+            if child is None:
+                child = self.children[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            child[0][index] += 1
+            child[1] += value
+            child[2] += 1
+
+    def render(self) -> list[str]:
+        with self.lock:
+            children = [(key, list(counts), total, count) for key, (counts, total, count) in self.children.items()]
+        lines = self.header()
+        for key, counts, total, count in children:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Collected(Metric):
+    # Values read at scrape time from fn() -> {label values tuple: value}, for state kept elsewhere
+
+    def __init__(self, name: str, documentation: str, labels: tuple, fn, kind: str = "gauge"):
+        super().__init__(name, documentation, labels)
+        self.fn = fn
+        self.kind = kind
+
+    def render(self) -> list[str]:
+        return self.header() + [f"{self.name}{format_labels(self.labels, key)} {value}"
+                                for key, value in self.fn().items()]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        # Modules loaded twice (or re-registered collectors) replace the previous metric of that name
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def collect(self, name: str, documentation: str, labels: tuple, fn, kind: str = "gauge") -> Collected:
+        return self.register(Collected(name, documentation, labels, fn, kind))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                # A collector whose source is not ready yet (e.g. no broker connection) is left out
+                continue
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int):
+    # GET /metrics on a daemon thread, for processes without a web server of their own
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
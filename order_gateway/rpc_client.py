@@ -0,0 +1,215 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, InvalidStateError
+from contextvars import ContextVar
+
+import pika
+from msgspec import msgpack
+
+from config import *
+from metrics import registry
+from messages import Message, encode
+import tracing
+
+RPC_SECONDS = registry.histogram("rpc_seconds", "Round trip of service calls, by target queue", ("queue",))
+RPC_TIMEOUTS = registry.counter("rpc_timeouts_total", "Service calls that missed their deadline, by target queue", ("queue",))
+
+# Absolute deadline (epoch seconds) of the HTTP request being served, set by the route wrapper
+request_deadline: ContextVar[float | None] = ContextVar('request_deadline', default=None)
+
+
+def timeout_response():
+    return {"status": STATUS_GATEWAY_TIMEOUT, "data": TIMEOUT_ERROR_STR}
+
+
+class PendingCall:
+
+    def __init__(self, corr_id: str, queue: str, body: bytes, deadline: float, span):
+        self.corr_id = corr_id
+        self.queue = queue
+        self.body = body
+        self.deadline = deadline
+        self.span = span
+        self.future = Future()
+        self.connection = None
+
+
+class BrokerConnection:
+    '''
+    One pooled broker connection.
+
+    A dedicated I/O thread owns the pika connection and consumes every reply from
+    the direct reply-to pseudo queue. Other threads never touch the channel, they
+    hand publishes over with add_callback_threadsafe and wait on the future of
+    their own PendingCall, which is resolved by correlation id.
+    '''
+
+    def __init__(self, name: str, logger):
+        self.name = name
+        self.logger = logger
+        self.connection = None
+        self.channel = None
+        self.pending: dict[str, PendingCall] = {}
+        self.last_tick = 0.0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    @property
+    def healthy(self) -> bool:
+        # Connected, and the I/O loop is still turning over
+        return self.connection is not None and time.monotonic() - self.last_tick < BROKER_HEALTH_TIMEOUT
+
+    def connect(self):
+        self.logger.info("[%s] Connecting to broker...", self.name)
+        connection = pika.BlockingConnection(pika.URLParameters(os.environ['RABBITMQ_BROKER_URL']))
+        self.channel = connection.channel()
+        self.channel.queue_declare(queue=ORDER_QUEUE)
+        self.channel.queue_declare(queue=STOCK_QUEUE)
+        self.channel.queue_declare(queue=PAYMENT_QUEUE)
+        # Direct reply-to has to be consumed in no-ack mode on the publishing channel
+        self.channel.basic_consume(queue=DIRECT_REPLY_QUEUE, on_message_callback=self.on_response, auto_ack=True)
+        return connection
+
+    def run(self):
+        while True:
+            try:
+                connection = self.connect()
+                # Replies to calls published on a previous connection are lost with it,
+                # re-publish them; consumers deduplicate on the correlation id.
+                with self.lock:
+                    in_flight = list(self.pending.items())
+                    self.connection = connection
+                for _, call in in_flight:
+                    self.publish(call)
+                while True:
+                    self.last_tick = time.monotonic()
+                    connection.process_data_events(time_limit=1)
+            except Exception as e:
+                self.logger.error("[%s] %s", self.name, e)
+                with self.lock:
+                    self.connection = None
+                time.sleep(RECONNECT_DELAY)
+                self.logger.error("[%s] Reconnecting...", self.name)
+
+    def on_response(self, ch, method, props, body):
+        with self.lock:
+            call = self.pending.pop(props.correlation_id, None)
+        if call is not None:
+            try:
+                call.future.set_result(msgpack.decode(body))
+            except InvalidStateError:
+                # The caller gave up on the deadline in the meantime
+                pass
+
+    def publish(self, call: PendingCall):
+        remaining = int((call.deadline - time.time()) * 1000)
+        if remaining <= 0:
+            # Nobody is waiting for this one any more, the caller times out on its own
+            return
+        self.channel.basic_publish(
+            exchange='',
+            routing_key=call.queue,
+            properties=pika.BasicProperties(
+                reply_to=DIRECT_REPLY_QUEUE,
+                correlation_id=call.corr_id,
+                expiration=str(remaining),
+                headers=tracing.inject({DEADLINE_HEADER: int(call.deadline * 1000)}, call.span.context),
+            ),
+            body=call.body
+        )
+
+    def submit(self, call: PendingCall):
+        with self.lock:
+            self.pending[call.corr_id] = call
+            connection = self.connection
+        if connection is not None:
+            try:
+                connection.add_callback_threadsafe(lambda: self.publish(call))
+            except Exception as e:
+                # The I/O thread re-publishes everything still pending once it reconnects
+                self.logger.error("[%s] %s", self.name, e)
+
+    def cancel(self, call: PendingCall):
+        with self.lock:
+            self.pending.pop(call.corr_id, None)
+
+
+class ChannelPool:
+    '''
+    Fixed-size pool of broker connections with checkout/return semantics.
+
+    checkout hands out the healthy connection with the fewest calls checked out,
+    so concurrent requests spread over several sockets instead of serializing on
+    one. If none is healthy the least loaded one is used anyway, its calls are
+    re-published as soon as it reconnects.
+    '''
+
+    def __init__(self, size: int, logger):
+        self.connections = [BrokerConnection(f"rabbitmq-client-{i}", logger) for i in range(size)]
+        self.checked_out = [0] * size
+        self.lock = threading.Lock()
+
+    def checkout(self) -> int:
+        with self.lock:
+            candidates = [i for i, conn in enumerate(self.connections) if conn.healthy]
+            if not candidates:
+                candidates = range(len(self.connections))
+            index = min(candidates, key=lambda i: self.checked_out[i])
+            self.checked_out[index] += 1
+        return index
+
+    def checkin(self, index: int):
+        with self.lock:
+            self.checked_out[index] -= 1
+
+
+class RabbitMQClient:
+    '''
+    Thread-safe RPC client on top of the channel pool.
+
+    Every call gets its own result slot, a future keyed by correlation id, and
+    keeps its pooled connection checked out until the reply arrives. Calls carry
+    an absolute deadline, by default the one of the current HTTP request, and
+    resolve to a 504 response once it has passed.
+    '''
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.pool = ChannelPool(BROKER_POOL_SIZE, logger)
+
+    def submit(self, message: Message, queue, deadline: float | None = None) -> PendingCall:
+        if deadline is None:
+            deadline = request_deadline.get() or time.time() + RPC_TIMEOUT
+        span = tracing.start_span(f"rpc {message.action}", kind="client", queue=queue)
+        call = PendingCall(str(uuid.uuid4()), queue, encode(message), deadline, span)
+        index = self.pool.checkout()
+        call.connection = self.pool.connections[index]
+        call.future.add_done_callback(lambda _: self.pool.checkin(index))
+        call.connection.submit(call)
+        return call
+
+    def finish(self, call: PendingCall):
+        # The caller is done with the call, whether it got the reply, timed out or was cancelled:
+        # forget it, so neither a late reply nor a reconnect finds it, and return its connection.
+        # Both are no-ops once the reply arrived. Not guarded by future.done(): a cancelled
+        # call has already cancelled the future through wrap_future by now.
+        call.connection.cancel(call)
+        call.future.cancel()
+
+    async def call_async(self, message: Message, queue, deadline: float | None = None):
+        start = time.perf_counter()
+        call = self.submit(message, queue, deadline)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(call.future), max(call.deadline - time.time(), 0))
+        except asyncio.TimeoutError:
+            RPC_TIMEOUTS.inc(queue)
+            call.span.set("timeout", True)
+            return timeout_response()
+        finally:
+            self.finish(call)
+            RPC_SECONDS.observe(time.perf_counter() - start, queue)
+            call.span.end()
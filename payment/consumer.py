@@ -1,96 +1,229 @@
 import pika
+import msgspec
 from msgspec import msgpack
 
-from exceptions import RedisDBError, InsufficientCreditError, RabbitMQError
-from services import create_user_db, batch_init_db, get_user_db, add_credit_db, remove_credit_db
+from exceptions import RedisDBError, InsufficientCreditError, UserNotFoundError, OperationUndoneError, RabbitMQError
+from services import create_user_db, batch_init_db, get_user_db, add_credit_db, remove_credit_db, execute_batch, db_stats
+from messages import PAYMENT_MESSAGES, MessageDecoder, DbStats, CreateUser, PaymentBatchInit, FindUser, AddFunds, RemoveCredit
 from config import *
+from logs import configure_logger, LogSampler, log_sampled
+from metrics import registry, serve as serve_metrics
+import tracing
+from worker_pool import KeyedWorkerPool
+from batching import MessageBatcher
 import os
 import logging
 import time
 
+# Actions the micro-batching mode collects, everything else is handled one by one
+BATCH_ACTIONS = {FindUser, AddFunds, RemoveCredit}
+
+# Actions that update an entity, announced on ENTITY_EVENTS_EXCHANGE
+WRITE_ACTIONS = {AddFunds, RemoveCredit}
+
+decoder = MessageDecoder(PAYMENT_MESSAGES)
+
+# Served on METRICS_PORT; latencies run from the delivery to the reply
+MESSAGE_SECONDS = registry.histogram("consumer_message_seconds", "Time from delivery to reply, by action", ("action",))
+IN_FLIGHT = registry.gauge("consumer_in_flight", "Messages delivered and not answered yet")
+EXPIRED = registry.counter("consumer_expired_total", "Messages dropped past their deadline")
+REJECTED = registry.counter("consumer_rejected_total", "Messages refused as malformed")
+QUEUE_DEPTH = registry.gauge("broker_queue_depth", "Messages ready in the broker queue", ("queue",))
+QUEUE_CONSUMERS = registry.gauge("broker_queue_consumers", "Consumers attached to the broker queue", ("queue",))
+
 def generate_response(status, data={}):
     return {"status":status, "data":data}
 
+def is_expired(properties):
+    deadline = (properties.headers or {}).get(DEADLINE_HEADER)
+    return deadline is not None and time.time() * 1000 > deadline
+
+def success_data(msg, user_entry):
+    # Reply payload of a batchable action, shared by the single and the batched path
+    return {
+        "credit": user_entry.credit
+    }
+
+def error_response(e):
+    if isinstance(e, RedisDBError):
+        return generate_response(STATUS_SERVER_ERROR, DB_ERROR_STR)
+    elif isinstance(e, (InsufficientCreditError, UserNotFoundError, OperationUndoneError)):
+        return generate_response(STATUS_CLIENT_ERROR, REQ_ERROR_STR)
+    return generate_response(STATUS_SERVER_ERROR, SERV_ERROR_STR)
+
+def message_keys(msg):
+    user_id = getattr(msg, 'user_id', None)
+    return [user_id] if user_id is not None else []
+
 
 class RabbitMQConsumer:
 
     def declare_queues(self):
         self.channel.queue_declare(PAYMENT_QUEUE)
+        self.channel.exchange_declare(exchange=ENTITY_EVENTS_EXCHANGE, exchange_type='topic')
 
     def setup_logger(self):
-        self.logger = logging.getLogger("PaymentService")
-        self.logger.setLevel(logging.INFO)
-        handler = logging.StreamHandler()
-        handler.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handler.setFormatter(formatter)
-        self.logger.addHandler(handler)
+        self.logger = configure_logger(logging.getLogger("PaymentService"), LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE,
+                                       background=LOG_BACKGROUND)
+        self.sampler = LogSampler(LOG_SAMPLE)
 
     def connect(self):
         try:
             connection = pika.BlockingConnection(pika.URLParameters(os.environ['RABBITMQ_BROKER_URL']))
             channel = connection.channel()
+            self.connection = connection
             self.channel = channel
+            if self.batcher is not None:
+                # Unacked messages of the dropped connection come back as new deliveries
+                IN_FLIGHT.dec(amount=len(self.batcher.items))
+                self.batcher.reset()
             self.declare_queues()
         except Exception as e:
             raise RabbitMQError
 
     def __init__(self) -> None:
+        self.connection = None
         self.channel = None
         self.setup_logger()
+        self.batcher = MessageBatcher(CONSUMER_BATCH_SIZE, CONSUMER_BATCH_WAIT_MS, self.handle_batch) if CONSUMER_BATCH_SIZE > 1 else None
+        self.pool = None
+        if self.batcher is None and CONSUMER_WORKERS > 1:
+            self.pool = KeyedWorkerPool(CONSUMER_WORKERS, self.logger)
+        # Message type -> handler(properties, msg), returning the data of the success reply
+        self.handlers = {
+            CreateUser: lambda properties, msg: {"user_id": create_user_db()},
+            PaymentBatchInit: self.batch_init,
+            DbStats: lambda properties, msg: db_stats(),
+            FindUser: lambda properties, msg: success_data(msg, get_user_db(msg.user_id)),
+            AddFunds: lambda properties, msg: success_data(
+                msg, add_credit_db(msg.user_id, msg.amount, properties.correlation_id, msg.undo)),
+            RemoveCredit: lambda properties, msg: success_data(
+                msg, remove_credit_db(msg.user_id, msg.amount, properties.correlation_id)),
+        }
 
-    def callback(self, ch, method, properties, body):
-        msg = msgpack.decode(body)
-        self.logger.info(f"[{properties.reply_to}] : {msg}")
+    def threadsafe(self, fn):
+        # pika channels are not thread-safe, workers hand publishes and acks over to the I/O thread
+        if self.pool is None:
+            fn()
+        else:
+            self.connection.add_callback_threadsafe(fn)
+
+    def ack(self, ch, delivery_tag):
+        def basic_ack():
+            # Deliveries from a connection that has since dropped get redelivered by the broker
+            if ch.is_open:
+                ch.basic_ack(delivery_tag=delivery_tag)
+        self.threadsafe(basic_ack)
 
+    def callback(self, ch, method, properties, body):
+        if is_expired(properties):
+            # The caller has already given up, don't spend a Redis round trip on it
+            self.logger.warning("[%s] Dropping expired message %s", properties.reply_to, properties.correlation_id)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+            EXPIRED.inc()
+            return
         try:
-            if msg['action'] == "create_user":
-                key = create_user_db()
-                self.publish_message(properties, generate_response(STATUS_SUCCESS, {"user_id": key}))
-
-            elif msg['action'] == "batch_init":
-                batch_init_db(msg['n'], msg['starting_money'])
-                self.publish_message(properties, generate_response(STATUS_SUCCESS, {"msg": "Batch init for payment successful"}))
-
-            elif msg['action'] == "find_user":
-                user_entry = get_user_db(msg['user_id'])
-                response = {
-                    "credit": user_entry.credit,
-                    "last_upd": user_entry.last_upd
-                }
-                self.publish_message(properties, generate_response(STATUS_SUCCESS, response))
-
-            elif msg['action'] == "add_funds":
-                upd_usr = properties.correlation_id
-                user_entry = add_credit_db(msg['user_id'], msg['amount'], upd_usr)
-                response = {
-                    "credit": user_entry.credit,
-                    "last_upd": user_entry.last_upd
-                }
-                self.publish_message(properties, generate_response(STATUS_SUCCESS, response))
-
-            elif msg['action'] == "remove_credit":
-                upd_usr = properties.correlation_id
-                user_entry = remove_credit_db(msg['user_id'], msg['amount'], upd_usr)
-                response = {
-                    "credit": user_entry.credit,
-                    "last_upd": user_entry.last_upd
-                }
-                self.publish_message(properties, generate_response(STATUS_SUCCESS, response))
-
-        except RedisDBError as e:
-            self.logger.error(f"[{properties.reply_to}] { msg['action']} : {msg} {e}")
-            self.publish_message(properties, generate_response(STATUS_SERVER_ERROR, DB_ERROR_STR ))
-        except InsufficientCreditError as e:
-            self.logger.error(f"[{properties.reply_to}] { msg['action']} : {msg} {e}")
+            msg = decoder.decode(body)
+        except msgspec.DecodeError as e:
+            self.reject(ch, method, properties, e)
+            return
+        received = time.perf_counter()
+        IN_FLIGHT.inc()
+        if self.batcher is not None:
+            if type(msg) in BATCH_ACTIONS:
+                self.batcher.add(self.connection, (ch, method, properties, msg, received))
+                return
+            # Keep arrival order, whatever is already waiting goes first
+            self.batcher.flush()
+        if self.pool is None:
+            self.handle(ch, method, properties, msg, received)
+        else:
+            self.pool.submit(message_keys(msg), self.handle, ch, method, properties, msg, received)
+
+    def reject(self, ch, method, properties, error):
+        # Malformed or of another queue: nothing a retry could fix, answered and dropped before any Redis work
+        self.logger.warning("[%s] Rejecting message %s: %s", properties.reply_to, properties.correlation_id, error)
+        REJECTED.inc()
+        if properties.reply_to:
             self.publish_message(properties, generate_response(STATUS_CLIENT_ERROR, REQ_ERROR_STR))
+        self.ack(ch, method.delivery_tag)
+
+    def handle(self, ch, method, properties, msg, received):
+        with tracing.start_span(f"consume {msg.action}", tracing.extract(properties.headers), "consumer"):
+            self.process(ch, method, properties, msg)
+        self.observe(msg.action, received)
+
+    def process(self, ch, method, properties, msg):
+        log_sampled(self.logger, self.sampler, msg.action, "[%s] : %s", properties.reply_to, msg)
+
+        try:
+            data = self.handlers[type(msg)](properties, msg)
+            self.publish_message(properties, generate_response(STATUS_SUCCESS, data))
+            if type(msg) in WRITE_ACTIONS:
+                self.publish_changes(message_keys(msg))
+
         except Exception as e:
-            self.logger.error(f"[{properties.reply_to}] { msg['action']} : {msg} {e}")
-            self.publish_message(properties, generate_response(STATUS_SERVER_ERROR, SERV_ERROR_STR) )
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+            self.logger.error("[%s] %s : %s %s", properties.reply_to, msg.action, msg, e)
+            self.publish_message(properties, error_response(e))
+        self.ack(ch, method.delivery_tag)
+
+    def batch_init(self, properties, msg: PaymentBatchInit):
+        batch_init_db(msg.n, msg.starting_money, self.logger)
+        self.publish_changes(None)
+        return {"msg": "Batch init for payment successful"}
+
+    def handle_batch(self, batch):
+        """
+        Process a batch collected by the MessageBatcher with a single pipelined
+        read and write, then publish all replies and ack the whole batch at once.
+        """
+        spans = [tracing.start_span(f"consume {msg.action}", tracing.extract(properties.headers), "consumer",
+                                    batch=len(batch)) for _, _, properties, msg, _ in batch]
+        # The shared Redis round trips are traced under the first recorded message of the batch
+        traced = next((span.context for span in spans if span.context is not None and span.context.sampled), None)
+        messages = [(msg, properties.correlation_id) for _, _, properties, msg, _ in batch]
+        try:
+            results = tracing.bind(traced, execute_batch)(messages)
+        except Exception as e:
+            results = [e] * len(batch)
+        changed = []
+        for (_, _, properties, msg, received), result, span in zip(batch, results, spans):
+            with span:
+                try:
+                    if isinstance(result, Exception):
+                        raise result
+                    response = generate_response(STATUS_SUCCESS, success_data(msg, result))
+                    if type(msg) in WRITE_ACTIONS:
+                        changed.extend(message_keys(msg))
+                except Exception as e:
+                    self.logger.error("[%s] %s : %s %s", properties.reply_to, msg.action, msg, e)
+                    response = error_response(e)
+                self.publish_message(properties, response)
+            self.observe(msg.action, received)
+        if changed:
+            self.publish_changes(changed)
+        ch, method = batch[-1][0], batch[-1][1]
+        if ch.is_open:
+            ch.basic_ack(delivery_tag=method.delivery_tag, multiple=True)
+
+    def observe(self, action, received):
+        MESSAGE_SECONDS.observe(time.perf_counter() - received, action)
+        IN_FLIGHT.dec()
+
+    def poll_queue(self):
+        # Runs on the I/O thread every METRICS_QUEUE_POLL seconds for as long as the connection lasts
+        try:
+            frame = self.channel.queue_declare(PAYMENT_QUEUE, passive=True)
+        except Exception as e:
+            self.logger.warning("Queue depth poll failed: %s", e)
+            return
+        QUEUE_DEPTH.set(frame.method.message_count, PAYMENT_QUEUE)
+        QUEUE_CONSUMERS.set(frame.method.consumer_count, PAYMENT_QUEUE)
+        self.connection.call_later(METRICS_QUEUE_POLL, self.poll_queue)
 
     def start_consuming(self):
-        self.channel.basic_qos(prefetch_count=1)
+        self.poll_queue()
+        self.channel.basic_qos(prefetch_count=CONSUMER_PREFETCH)
         self.channel.basic_consume(queue=PAYMENT_QUEUE, on_message_callback=self.callback)
 
         try:
@@ -99,19 +232,29 @@ class RabbitMQConsumer:
         except Exception as e:
            raise RabbitMQError
 
+    def publish_changes(self, ids):
+        # Written entities, for the gateway read caches; None stands for all of them
+        body = msgpack.encode({'ids': ids})
+        self.threadsafe(lambda: self.channel.basic_publish(exchange=ENTITY_EVENTS_EXCHANGE, routing_key=ENTITY_EVENTS_KEY, body=body))
+
     def publish_message(self, properties, response):
-        self.logger.info(f"[{properties.reply_to}] Response: {response}")
-        self.channel.basic_publish(
+        log_sampled(self.logger, self.sampler, "response", "[%s] Response: %s", properties.reply_to, response)
+        body = msgpack.encode(response)
+        # Trace context of the span handling the request, read here rather than on the I/O thread
+        headers = tracing.inject()
+        self.threadsafe(lambda: self.channel.basic_publish(
             exchange='',
             routing_key=properties.reply_to,
             properties=pika.BasicProperties(
-                correlation_id=properties.correlation_id
+                correlation_id=properties.correlation_id,
+                headers=headers
             ),
-            body=msgpack.encode(response)
-        )
+            body=body
+        ))
 
 
 if __name__ == "__main__":
+    serve_metrics(METRICS_PORT)
     consumer = RabbitMQConsumer()
     while True:
         try:
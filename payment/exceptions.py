@@ -5,4 +5,10 @@ class InsufficientCreditError(Exception):
     pass
 
 class RabbitMQError(Exception):
+    pass
+
+class UserNotFoundError(Exception):
+    pass
+
+class OperationUndoneError(Exception):
     pass
\ No newline at end of file
@@ -0,0 +1,40 @@
+from config import IDEMPOTENCY_PREFIX, IDEMPOTENCY_TTL
+
+# Marker values: the operation was applied, or it was undone by a compensation
+# (possibly before it ever ran, in which case it must not run any more)
+APPLIED = b"1"
+UNDONE = b"0"
+
+
+class IdempotencyStore:
+    '''
+    Set of processed operation ids (the correlation id of the message that
+    carried the operation).
+
+    Every operation gets its own Redis key that expires on its own, so a
+    membership check is a single O(1) lookup that does not grow with a window
+    size, and records no longer carry the ids of the operations that touched
+    them. Writes that have to be exactly-once pass the operation key to their
+    script or MULTI and check and record it in the same atomic step.
+    '''
+
+    def __init__(self, prefix: str = IDEMPOTENCY_PREFIX, ttl: int = IDEMPOTENCY_TTL):
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def key(self, op_id: str) -> str:
+        return f"{self.prefix}{op_id}"
+
+    def seen(self, client, op_ids) -> dict[str, bool]:
+        # Recorded operations, mapped to whether they are still applied
+        op_ids = list(op_ids)
+        if not op_ids:
+            return {}
+        markers = client.mget([self.key(op_id) for op_id in op_ids])
+        return {op_id: marker == APPLIED for op_id, marker in zip(op_ids, markers) if marker is not None}
+
+    def record(self, client, op_id: str, applied: bool = True, ttl: int | None = None):
+        client.set(self.key(op_id), APPLIED if applied else UNDONE, ex=ttl or self.ttl)
+
+
+idempotency = IdempotencyStore()
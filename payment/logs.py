@@ -0,0 +1,105 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import stat
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line; the action of per-message records is its own field
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                 "message": record.getMessage()}
+        action = getattr(record, "action", None)
+        if action is not None:
+            entry["action"] = action
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class BackgroundHandler(QueueHandler):
+    '''
+    Hands records to a writer thread. A full queue drops the record rather than
+    blocking the caller.
+
+    The message is rendered on the logging thread (QueueHandler.prepare), as its
+    %-arguments may be mutable objects that change once the call returns; the
+    writer thread only adds the time, level and so on, and does the write.
+    '''
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogSampler:
+    '''
+    Per-action sampling rates of the per-message logs, from a spec such as
+    "find_item=0.01,response=0.1,*=1": a record is kept with the rate of its
+    action, or the "*" rate, 1 unless given.
+    '''
+
+    def __init__(self, spec: str = ""):
+        self.rates = {}
+        for entry in filter(None, (part.strip() for part in spec.split(','))):
+            action, _, rate = entry.partition('=')
+            self.rates[action.strip()] = float(rate)
+        self.default = self.rates.pop('*', 1.0)
+
+    def keep(self, action: str) -> bool:
+        rate = self.rates.get(action, self.default)
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+
+def can_block(handler: logging.Handler) -> bool:
+    # Writes to a pipe or socket wait for the reader, e.g. the container runtime collecting stderr
+    try:
+        mode = os.fstat(handler.stream.fileno()).st_mode
+    except (AttributeError, OSError, ValueError):
+        return False
+    return stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)
+
+
+def configure_logger(logger: logging.Logger, level: str, fmt: str, queue_size: int,
+                     handlers: list[logging.Handler] | None = None, background: str = "auto") -> logging.Logger:
+    '''
+    Route `logger` to `handlers` (stderr by default) with the "text" or "json"
+    format. With `background` "true" records go through a bounded queue and are
+    written by a background thread; "auto" does so only if a handler writes to
+    a pipe or socket. Otherwise they are written on the calling thread, which is
+    cheaper when writes never block (a file, /dev/null).
+    '''
+    formatter = JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers = handlers or [logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    if background == "true" or (background == "auto" and any(map(can_block, handlers))):
+        log_queue = queue.Queue(queue_size)
+        listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.handlers = [BackgroundHandler(log_queue)]
+    else:
+        logger.handlers = list(handlers)
+    logger.setLevel(level)
+    logger.propagate = False
+    return logger
+
+
+def log_sampled(logger: logging.Logger, sampler: LogSampler, action: str, msg: str, *args, level: int = logging.INFO):
+    # Per-message log line: skipped before any formatting when the level is off or the sample misses
+    if logger.isEnabledFor(level) and sampler.keep(action):
+        logger.log(level, msg, *args, extra={"action": action})
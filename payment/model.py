@@ -1,5 +1,41 @@
-from msgspec import Struct
+from msgspec import Struct, msgpack
 
 class UserValue(Struct):
     credit: int
-    last_upd: str
\ No newline at end of file
+
+
+# Stored records are msgpack arrays tagged with RECORD_VERSION, [1, credit], instead of
+# maps repeating the field names. Maps written before are still decoded (extra fields such
+# as last_upd are ignored) and rewritten compact on their next write or by migrate.py.
+RECORD_VERSION = 1
+
+
+class UserRecord(Struct, array_like=True, tag=RECORD_VERSION):
+    credit: int
+
+
+record_encoder = msgpack.Encoder()
+record_decoder = msgpack.Decoder(UserRecord)
+legacy_decoder = msgpack.Decoder(UserValue)
+
+
+def is_compact(raw: bytes) -> bool:
+    # fixarray or array 16/32 header, as opposed to the map of the old encoding
+    return (raw[0] & 0xf0) == 0x90 or raw[0] in (0xdc, 0xdd)
+
+
+def is_current(raw: bytes) -> bool:
+    # Records have fewer than 16 fields, so the version tag follows a one byte fixarray header
+    return (raw[0] & 0xf0) == 0x90 and raw[1] == RECORD_VERSION
+
+
+def encode_record(value: UserValue) -> bytes:
+    return record_encoder.encode(UserRecord(value.credit))
+
+
+def decode_record(raw: bytes) -> UserValue:
+    if not is_compact(raw):
+        return legacy_decoder.decode(raw)
+    record = record_decoder.decode(raw)
+    return UserValue(record.credit)
+
@@ -0,0 +1,81 @@
+# Server-side scripts, registered once and run with EVALSHA (redis-py falls back to
+# EVAL when the script cache was flushed).
+
+# Users are stored as [version, credit] arrays (see model.py); maps written before
+# the compact encoding are still read, and rewritten compact.
+USER_CODEC = """
+local function decode_user(raw)
+    local value = cmsgpack.unpack(raw)
+    if value[1] == 1 then
+        return {credit = value[2]}
+    end
+    return value
+end
+
+local function encode_user(user)
+    return cmsgpack.pack({1, user.credit})
+end
+"""
+
+# Atomically apply a signed credit change to one user.
+#
+# KEYS[1]: user id
+# KEYS[2]: idempotency key of the operation
+# KEYS[3]: for a compensation, idempotency key of the operation it undoes
+# ARGV[1]: signed amount
+# ARGV[2]: TTL of the idempotency keys in seconds
+#
+# A compensation marks the operation it undoes as undone; if that operation never
+# ran, nothing else changes and a late delivery of it is refused. Returns
+# {status, credit} with status 1 = applied, 0 = duplicate operation or nothing to
+# undo (nothing changed), -1 = user not found, -2 = credit would drop below zero,
+# -3 = operation was undone.
+ADJUST_CREDIT = USER_CODEC + """
+local raw = redis.call('GET', KEYS[1])
+if not raw then
+    return {-1, 0}
+end
+local user = decode_user(raw)
+local marker = redis.call('GET', KEYS[2])
+if marker == '0' then
+    return {-3, user.credit}
+elseif marker then
+    return {0, user.credit}
+end
+if KEYS[3] and redis.call('GET', KEYS[3]) ~= '1' then
+    redis.call('SET', KEYS[3], 0, 'EX', ARGV[2])
+    redis.call('SET', KEYS[2], 1, 'EX', ARGV[2])
+    return {0, user.credit}
+end
+local credit = user.credit + tonumber(ARGV[1])
+if credit < 0 then
+    return {-2, user.credit}
+end
+user.credit = credit
+redis.call('SET', KEYS[1], encode_user(user))
+redis.call('SET', KEYS[2], 1, 'EX', ARGV[2])
+if KEYS[3] then
+    redis.call('SET', KEYS[3], 0, 'EX', ARGV[2])
+end
+return {1, user.credit}
+"""
+
+
+# Replace records that still hold the value they were read with.
+#
+# KEYS:  record keys
+# ARGV:  per key, the value read and its replacement
+#
+# Used by migrate.py to rewrite records while the service keeps running: a record
+# written in between is left alone (it is written compact anyway). Returns the
+# number of records replaced.
+REPLACE_IF_UNCHANGED = """
+local replaced = 0
+for i = 1, #KEYS do
+    if redis.call('GET', KEYS[i]) == ARGV[2 * i - 1] then
+        redis.call('SET', KEYS[i], ARGV[2 * i], 'KEEPTTL')
+        replaced = replaced + 1
+    end
+end
+return replaced
+"""
@@ -1,110 +1,167 @@
 import redis
-import time
 import os
-import json
 import atexit
 import uuid
-from msgspec import msgpack
 from config import *
 
-from model import UserValue
-from exceptions import RedisDBError, InsufficientCreditError
+from model import UserValue, encode_record, decode_record
+from scripts import ADJUST_CREDIT
+from idempotency import idempotency
+from bulk_load import bulk_load, pipelined_mset
+from redis_client import RedisClient, create_client
+from exceptions import RedisDBError, InsufficientCreditError, UserNotFoundError, OperationUndoneError
+from messages import Message, FindUser, AddFunds, RemoveCredit
 
 def connect_redis():
-    db_conn: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST'],
-                              port=int(os.environ['REDIS_PORT']),
-                              password=os.environ['REDIS_PASSWORD'],
-                              db=int(os.environ['REDIS_DB']))
+    db_conn: RedisClient = create_client(os.environ['REDIS_HOST'], int(os.environ['REDIS_PORT']),
+                                         int(os.environ['REDIS_DB']), os.environ['REDIS_PASSWORD'])
     return db_conn
 
-def retry_connection():
-    global db 
-    for attempt in range(1, MAX_RETRIES):
-        try: 
-            db = connect_redis()
-            db.ping()
-        except redis.exceptions.ConnectionError:
-            if attempt < MAX_RETRIES:
-                time.sleep(SLEEP_TIME)
-            else:
-                raise RedisDBError
-                
 
 def close_db_connection():
     db.close()
 
 
+
+def db_stats() -> dict:
+    # Circuit breaker state and per-command latencies of this replica's Redis client
+    return db.stats()
+
+
 db = connect_redis()
 atexit.register(close_db_connection)
+adjust_credit_script = db.register_script(ADJUST_CREDIT)
 
 
 def get_user_db(user_id: str) -> UserValue | None:
     try:
         # get serialized data
         entry: bytes = db.get(user_id)
-    except redis.exceptions.ConnectionError:
-        retry_connection()
-        entry: bytes = db.get(user_id)
     except redis.exceptions.RedisError:
         raise RedisDBError(Exception)
     # deserialize data if it exists else return null
-    entry: UserValue | None = msgpack.decode(entry, type=UserValue) if entry else None
+    entry: UserValue | None = decode_record(entry) if entry else None
     return entry
 
 def create_user_db():
     key = str(uuid.uuid4())
-    value = msgpack.encode(UserValue(credit=0, last_upd="api_add"))
+    value = encode_record(UserValue(credit=0))
     try:
         db.set(key, value)
-    except redis.exceptions.ConnectionError:
-        retry_connection()
-        db.set(key, value)
     except redis.exceptions.RedisError:
         raise RedisDBError(Exception)
     return key
     
 
-def batch_init_db(n: int, starting_money: int):
-    n = int(n)
-    starting_money = int(starting_money)
-    kv_pairs: dict[str, bytes] = {f"{i}": msgpack.encode(UserValue(credit=starting_money, last_upd="api_add"))
-                                  for i in range(n)}
+def batch_init_db(n: int, starting_money: int, logger=None) -> int:
+    value = encode_record(UserValue(credit=int(starting_money)))
     try:
-        db.mset(kv_pairs)
-    except redis.exceptions.ConnectionError:
-        retry_connection()
-        db.mset(kv_pairs)
+        return bulk_load(n, lambda low, high: dict.fromkeys((f"{i}" for i in range(low, high)), value),
+                         lambda chunks: pipelined_mset(db, chunks), logger)
     except redis.exceptions.RedisError:
         raise RedisDBError(Exception)
 
 
-def add_credit_db(user_id: str, amount: int, new_upd: str) -> UserValue:
-    user_entry: UserValue =  get_user_db(user_id)
-    if user_entry.last_upd != new_upd:
-        user_entry.credit += int(amount)
-        user_entry.last_upd = new_upd
-        try:
-            db.set(user_id, msgpack.encode(user_entry))
-        except redis.exceptions.ConnectionError:
-            retry_connection()
-            db.set(user_id, msgpack.encode(user_entry))
-        except redis.exceptions.RedisError:
-            raise RedisDBError(Exception)
-    return user_entry
+def adjust_credit(user_id: str, amount: int, new_upd: str, undo: str | None = None) -> UserValue:
+    # One EVALSHA: duplicate check, non-negative check and write happen atomically.
+    # With `undo` set, the change only applies if operation `undo` did.
+    keys = [user_id, idempotency.key(new_upd)]
+    if undo is not None:
+        keys.append(idempotency.key(undo))
+    args = [amount, idempotency.ttl]
+    try:
+        status, credit = adjust_credit_script(keys=keys, args=args, client=db)
+    except redis.exceptions.RedisError:
+        raise RedisDBError(Exception)
+    if status == -1:
+        raise UserNotFoundError(Exception)
+    if status == -2:
+        raise InsufficientCreditError(Exception)
+    if status == -3:
+        raise OperationUndoneError(Exception)
+    return UserValue(credit=credit)
+
+
+def add_credit_db(user_id: str, amount: int, new_upd: str, undo: str | None = None) -> UserValue:
+    return adjust_credit(user_id, int(amount), new_upd, undo)
 
 
-def remove_credit_db(user_id: str, amount: int, new_upd: str):
-    user_entry: UserValue = get_user_db(user_id)
-    if user_entry.last_upd != new_upd:
-        user_entry.credit -= int(amount)
-        if user_entry.credit < 0:
+def remove_credit_db(user_id: str, amount: int, new_upd: str) -> UserValue:
+    return adjust_credit(user_id, -int(amount), new_upd)
+
+def apply_batch_op(users: dict, dirty: set, markers: dict, msg: Message, new_upd: str) -> UserValue | None:
+    user_entry: UserValue | None = users.get(msg.user_id)
+    if isinstance(msg, FindUser):
+        # Later messages of the batch may still change the in-memory entry
+        return UserValue(credit=user_entry.credit) if user_entry else None
+    if user_entry is None:
+        raise UserNotFoundError(Exception)
+    if new_upd in markers:
+        if not markers[new_upd]:
+            raise OperationUndoneError(Exception)
+        return user_entry
+    undo = getattr(msg, 'undo', None)
+    if undo is not None and not markers.get(undo):
+        # Compensation of an operation that never ran, make sure it never does
+        markers[undo] = False
+        markers[new_upd] = True
+        return user_entry
+    if isinstance(msg, AddFunds):
+        credit = user_entry.credit + msg.amount
+    elif isinstance(msg, RemoveCredit):
+        credit = user_entry.credit - msg.amount
+        if credit < 0:
             raise InsufficientCreditError(Exception)
+    else:
+        raise ValueError(f"{msg.action} can't be batched")
+    user_entry = UserValue(credit=credit)
+    users[msg.user_id] = user_entry
+    dirty.add(msg.user_id)
+    markers[new_upd] = True
+    if undo is not None:
+        markers[undo] = False
+    return user_entry
+
+
+def execute_batch(ops: list[tuple[Message, str]]) -> list:
+    '''
+    Execute a batch of (message, operation id) pairs with one MGET and one MULTI.
+
+    Messages are applied in order on in-memory entries, so two payments of the
+    same user in one batch see each other. The users and the idempotency keys are
+    WATCHed and a concurrent write from another replica restarts the batch from
+    fresh reads. Returns, per
+    message, its result or the exception it raised.
+    '''
+    user_ids = sorted({msg.user_id for msg, _ in ops})
+    op_ids = [new_upd for _, new_upd in ops] + [msg.undo for msg, _ in ops if getattr(msg, 'undo', None)]
+    op_keys = [idempotency.key(op_id) for op_id in op_ids]
+    for attempt in range(BATCH_MAX_RETRIES):
         try:
-            user_entry.last_upd = new_upd
-            db.set(user_id, msgpack.encode(user_entry))
-        except redis.exceptions.ConnectionError:
-            retry_connection()
-            db.set(user_id, msgpack.encode(user_entry))
+            with db.pipeline() as pipe:
+                pipe.watch(*user_ids, *op_keys)
+                entries = pipe.mget(user_ids)
+                users = {user_id: decode_record(entry) if entry else None
+                         for user_id, entry in zip(user_ids, entries)}
+                seen = idempotency.seen(pipe, op_ids)
+                markers = dict(seen)
+                dirty = set()
+                results = []
+                for msg, new_upd in ops:
+                    try:
+                        results.append(apply_batch_op(users, dirty, markers, msg, new_upd))
+                    except Exception as e:
+                        results.append(e)
+                pipe.multi()
+                if dirty:
+                    pipe.mset({user_id: encode_record(users[user_id]) for user_id in dirty})
+                for op_id, applied in markers.items():
+                    if seen.get(op_id) != applied:
+                        idempotency.record(pipe, op_id, applied)
+                pipe.execute()
+            return results
+        except redis.exceptions.WatchError:
+            continue
         except redis.exceptions.RedisError:
-            raise RedisDBError(Exception)  
-    return user_entry
+            raise RedisDBError(Exception)
+    raise RedisDBError(Exception)
@@ -0,0 +1,115 @@
+import threading
+import time
+import os
+from collections import OrderedDict
+
+import pika
+from msgspec import msgpack
+
+from config import *
+
+
+class ReadCache:
+    '''
+    Short-TTL cache of successful /find responses, keyed by entity id.
+
+    The consumers announce every write on the ENTITY_EVENTS topic exchange. A
+    listener thread drops the written ids from the cache, and the cache only
+    answers while that listener is connected: events missed during a reconnect
+    could leave stale entries, so the cache is cleared then. Keys are hashed onto
+    GENERATION_BUCKETS generation counters; invalidating a key bumps its bucket's
+    and clearing the cache bumps the epoch, and a response fetched before either
+    is not stored, while fetches of keys in other buckets are unaffected. A
+    READ_CACHE_TTL of 0 turns the cache off.
+    '''
+
+    def __init__(self, entity: str, logger, ttl: float = READ_CACHE_TTL, capacity: int = READ_CACHE_SIZE):
+        self.entity = entity
+        self.logger = logger
+        self.ttl = ttl
+        self.capacity = capacity
+        self.entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self.epoch = 0
+        self.generations = [0] * GENERATION_BUCKETS
+        self.hits = 0
+        self.misses = 0
+        self.connected = False
+        self.lock = threading.Lock()
+        if self.enabled:
+            threading.Thread(target=self.listen, name=f"{entity}-invalidations", daemon=True).start()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def get(self, key: str) -> dict | None:
+        if not self.enabled:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not self.connected or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def generation(self, key: str) -> tuple[int, int]:
+        return self.epoch, self.generations[hash(key) % GENERATION_BUCKETS]
+
+    def put(self, key: str, response: dict, generation: tuple[int, int]):
+        if not self.enabled or response['status'] != STATUS_SUCCESS:
+            return
+        with self.lock:
+            if generation != self.generation(key):
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    async def fetch(self, key: str, call):
+        # Cached response for key, else the result of awaiting call()
+        response = self.get(key)
+        if response is not None:
+            return response
+        generation = self.generation(key)
+        response = await call()
+        self.put(key, response, generation)
+        return response
+
+    def invalidate(self, keys=None):
+        # Drops the given ids, or everything
+        with self.lock:
+            if keys is None:
+                self.epoch += 1
+                self.entries.clear()
+            else:
+                for key in keys:
+                    self.generations[hash(key) % GENERATION_BUCKETS] += 1
+                    self.entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"enabled": self.enabled, "size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+    def on_event(self, ch, method, properties, body):
+        self.invalidate(msgpack.decode(body)['ids'])
+
+    def listen(self):
+        while True:
+            try:
+                connection = pika.BlockingConnection(pika.URLParameters(os.environ['RABBITMQ_BROKER_URL']))
+                channel = connection.channel()
+                channel.exchange_declare(exchange=ENTITY_EVENTS_EXCHANGE, exchange_type='topic')
+                events = channel.queue_declare(queue='', exclusive=True)
+                channel.queue_bind(queue=events.method.queue, exchange=ENTITY_EVENTS_EXCHANGE,
+                                   routing_key=f"{self.entity}.#")
+                channel.basic_consume(queue=events.method.queue, on_message_callback=self.on_event, auto_ack=True)
+                self.invalidate()
+                self.connected = True
+                channel.start_consuming()
+            except Exception as e:
+                self.logger.error("[%s-invalidations] %s", self.entity, e)
+            self.connected = False
+            self.invalidate()
+            time.sleep(RECONNECT_DELAY)
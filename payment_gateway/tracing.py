@@ -0,0 +1,222 @@
+import atexit
+import json
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextvars import ContextVar
+from typing import NamedTuple
+
+from config import *
+
+
+class SpanContext(NamedTuple):
+    trace_id: str
+    span_id: str
+    sampled: bool
+
+
+# Span the current thread or task is working under
+current: ContextVar[SpanContext | None] = ContextVar('current_span', default=None)
+
+
+def new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+def extract(headers) -> SpanContext | None:
+    # W3C traceparent "00-<trace id>-<parent span id>-<flags>" of an incoming message or request
+    value = (headers or {}).get(TRACE_HEADER)
+    if not value:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode()
+    parts = value.split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return SpanContext(parts[1], parts[2], parts[3] == "01")
+
+
+def inject(headers: dict | None = None, context: SpanContext | None = None) -> dict | None:
+    # Adds the traceparent of `context`, else of the current span, to the outgoing headers
+    context = context or current.get()
+    if context is None:
+        return headers
+    headers = {} if headers is None else headers
+    headers[TRACE_HEADER] = f"00-{context.trace_id}-{context.span_id}-{'01' if context.sampled else '00'}"
+    return headers
+
+
+class Span:
+    '''
+    One timed operation of a trace. Used as a context manager it is the current
+    span for the duration of the block and ends with it; spans that outlive the
+    code that started them (a saga, an RPC) are ended with end().
+    '''
+
+    def __init__(self, name: str, context: SpanContext, parent_id: str | None, kind: str, attributes: dict):
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = attributes
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.token = None
+        self.ended = False
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def end(self, error=None):
+        if self.ended:
+            return
+        self.ended = True
+        if self.context.sampled:
+            exporter.export({
+                "trace_id": self.context.trace_id, "span_id": self.context.span_id, "parent_id": self.parent_id,
+                "name": self.name, "kind": self.kind, "service": TRACE_SERVICE, "start": self.start,
+                "duration_ms": round((time.perf_counter() - self.started) * 1000, 3),
+                "error": None if error is None else str(error), "attributes": self.attributes})
+
+    def __enter__(self):
+        self.token = current.set(self.context)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        current.reset(self.token)
+        self.end(exc)
+
+
+class NoSpan:
+    # Stands in for a span when there is nothing to trace: no sampled parent and no sampling at the root
+    context = None
+
+    def set(self, key: str, value):
+        pass
+
+    def end(self, error=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+NO_SPAN = NoSpan()
+INHERIT = object()
+
+
+def start_span(name: str, parent=INHERIT, kind: str = "internal", **attributes) -> Span | NoSpan:
+    '''
+    Start a span under `parent`, the current span unless given. Only a root
+    span draws the sampling decision, with TRACE_SAMPLE; children follow their
+    parent, so a trace is recorded across every hop or not at all. Unsampled
+    roots still get ids, for the services downstream to follow.
+    '''
+    if parent is INHERIT:
+        parent = current.get()
+    if parent is None:
+        if TRACE_SAMPLE <= 0:
+            return NO_SPAN
+        context = SpanContext(new_id(128), new_id(64), random.random() < TRACE_SAMPLE)
+        return Span(name, context, None, kind, attributes)
+    return Span(name, SpanContext(parent.trace_id, new_id(64), parent.sampled), parent.span_id, kind, attributes)
+
+
+def child_span(name: str, kind: str = "internal", **attributes) -> Span | NoSpan:
+    # Span under the current one if that is recorded; the cheap check for hot paths such as Redis commands
+    parent = current.get()
+    if parent is None or not parent.sampled:
+        return NO_SPAN
+    return Span(name, SpanContext(parent.trace_id, new_id(64), True), parent.span_id, kind, attributes)
+
+
+def bind(context: SpanContext | None, fn):
+    # fn, run with `context` as the current span, for work handed over to another thread or callback
+    if context is None:
+        return fn
+
+    def run(*args, **kwargs):
+        token = current.set(context)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            current.reset(token)
+    return run
+
+
+class SpanExporter:
+    '''
+    Writes finished spans from a background thread, as JSON lines appended to
+    a file or POSTed as a JSON array to a collector URL. A full queue drops
+    spans rather than blocking the traced code.
+    '''
+
+    def __init__(self, target: str, queue_size: int):
+        self.target = target
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def export(self, span: dict):
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="span-exporter", daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def drain(self) -> list[dict]:
+        spans = [self.queue.get()]
+        while len(spans) < TRACE_BATCH_SIZE:
+            try:
+                spans.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return spans
+
+    def run(self):
+        while True:
+            spans = self.drain()
+            try:
+                self.write(spans)
+            except Exception:
+                self.dropped += len(spans)
+
+    def write(self, spans: list[dict]):
+        if self.target.startswith(("http://", "https://")):
+            request = urllib.request.Request(self.target, data=json.dumps(spans).encode(),
+                                             headers={"Content-Type": "application/json"})
+            urllib.request.urlopen(request, timeout=5).close()
+        else:
+            with open(self.target, "a") as f:
+                f.write("".join(json.dumps(span) + "\n" for span in spans))
+
+    def flush(self):
+        # Whatever is still queued at exit, written from the exiting thread
+        spans = []
+        while True:
+            try:
+                spans.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if spans:
+            try:
+                self.write(spans)
+            except Exception:
+                pass
+
+
+exporter = SpanExporter(TRACE_EXPORT, TRACE_QUEUE_SIZE)
@@ -0,0 +1,43 @@
+class MessageBatcher:
+    '''
+    Collects messages on the connection's I/O thread and hands them over in one
+    go, as soon as `size` messages are waiting or `wait_ms` after the first one
+    arrived, whichever comes first.
+
+    Everything runs on the I/O thread (the flush timer is a pika call_later), so
+    no locking is needed and the batch keeps delivery order.
+    '''
+
+    def __init__(self, size: int, wait_ms: int, flush_fn):
+        self.size = size
+        self.wait = wait_ms / 1000
+        self.flush_fn = flush_fn
+        self.items = []
+        self.connection = None
+        self.timer = None
+
+    def add(self, connection, item):
+        self.items.append(item)
+        if len(self.items) >= self.size:
+            self.flush()
+        elif self.timer is None:
+            self.connection = connection
+            self.timer = connection.call_later(self.wait, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        self.flush()
+
+    def flush(self):
+        if self.timer is not None:
+            self.connection.remove_timeout(self.timer)
+            self.timer = None
+        items, self.items = self.items, []
+        if items:
+            self.flush_fn(items)
+
+    def reset(self):
+        # Unacked messages of a dropped connection are redelivered by the broker
+        self.items = []
+        self.connection = None
+        self.timer = None
@@ -1,3 +1,5 @@
+import os
+
 STOCK_QUEUE= "STOCK_QUEUE"
 ORDER_QUEUE = "ORDER_QUEUE"
 PAYMENT_QUEUE="PAYMENT_QUEUE"
@@ -10,7 +12,77 @@ DB_ERROR_STR = "DB error"
 REQ_ERROR_STR = "Requests error"
 SERV_ERROR_STR = "Server error"
 
-MAX_RETRIES = 3
-SLEEP_TIME = 10
+# Redis access: a bounded pool of connections per instance, per-command retries of connection
+# errors and timeouts with jittered exponential backoff (seconds), and a circuit breaker that
+# refuses commands for REDIS_BREAKER_RESET seconds after REDIS_BREAKER_THRESHOLD consecutive failures
+REDIS_POOL_SIZE = int(os.environ.get("REDIS_POOL_SIZE", 64))
+REDIS_POOL_TIMEOUT = 1
+REDIS_SOCKET_TIMEOUT = 5
+REDIS_RETRIES = int(os.environ.get("REDIS_RETRIES", 3))
+REDIS_BACKOFF_BASE = 0.01
+REDIS_BACKOFF_CAP = 0.5
+REDIS_BREAKER_THRESHOLD = int(os.environ.get("REDIS_BREAKER_THRESHOLD", 5))
+REDIS_BREAKER_RESET = float(os.environ.get("REDIS_BREAKER_RESET", 2))
+
+# Absolute deadline of the caller (epoch ms), messages past it are dropped unprocessed
+DEADLINE_HEADER = "x-deadline"
+
+# Consumer engine: messages prefetched from the broker and worker threads handling them.
+# With more than one worker, messages for different keys are processed in parallel.
+CONSUMER_PREFETCH = int(os.environ.get("CONSUMER_PREFETCH", 1))
+CONSUMER_WORKERS = int(os.environ.get("CONSUMER_WORKERS", 1))
+
+# Micro-batching: with a batch size above one, read/update messages are collected for up
+# to CONSUMER_BATCH_WAIT_MS and executed with one pipelined read and one MULTI. Batching
+# takes precedence over the worker pool.
+CONSUMER_BATCH_SIZE = int(os.environ.get("CONSUMER_BATCH_SIZE", 1))
+CONSUMER_BATCH_WAIT_MS = int(os.environ.get("CONSUMER_BATCH_WAIT_MS", 5))
+BATCH_MAX_RETRIES = 5
+
+# Processed operation ids are kept as their own keys, each expiring after its TTL (seconds)
+IDEMPOTENCY_PREFIX = "op:"
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", 24 * 60 * 60))
+
+# Fanout exchange on which the stock service announces created and re-initialized items
+ITEM_EVENTS_EXCHANGE = "ITEM_EVENTS"
+
+# Topic exchange on which writes are announced, so gateway read caches can drop the entities
+ENTITY_EVENTS_EXCHANGE = "ENTITY_EVENTS"
+ENTITY_EVENTS_KEY = "stock.changed"
+
+# Points per shard on the consistent hashing ring. Shards themselves come from STOCK_SHARDS,
+# "host:port/db" entries separated by commas, defaulting to the single REDIS_HOST instance.
+SHARD_VNODES = 160
+
+# Batch init streams keys in MSETs of BATCH_INIT_CHUNK keys, BATCH_INIT_PIPELINE of them per
+# round trip, over BATCH_INIT_WORKERS threads writing disjoint key ranges
+BATCH_INIT_CHUNK = int(os.environ.get("BATCH_INIT_CHUNK", 1000))
+BATCH_INIT_PIPELINE = 8
+BATCH_INIT_WORKERS = int(os.environ.get("BATCH_INIT_WORKERS", 1))
+BATCH_INIT_LOG_EVERY = 100000
+
+# Logging: level, "text" or "json" lines, and sampling rates of the per-message logs by action
+# ("find_item=0.01,response=0.1,*=1"). Where stderr can block (a pipe or socket, LOG_BACKGROUND
+# "auto") or with LOG_BACKGROUND "true", records are written by a background thread; when
+# LOG_QUEUE_SIZE records are waiting, new ones are dropped.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_SAMPLE = os.environ.get("LOG_SAMPLE", "")
+LOG_QUEUE_SIZE = 10000
+LOG_BACKGROUND = os.environ.get("LOG_BACKGROUND", "auto").lower()
+
+# Prometheus metrics, served at :METRICS_PORT/metrics by a thread of the consumer. The
+# depth of the service queue is read from the broker every METRICS_QUEUE_POLL seconds.
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+METRICS_QUEUE_POLL = 5
 
-LAST_UPD_LIMIT = 25
\ No newline at end of file
+# Tracing: share of requests without a trace context that start a recorded trace (0 turns
+# tracing off); downstream hops follow the decision carried in the W3C TRACE_HEADER. Spans
+# are written by a background thread to TRACE_EXPORT, a file of JSON lines or the URL of a
+# collector taking POSTed JSON arrays, at most TRACE_BATCH_SIZE per write.
+TRACE_SAMPLE = float(os.environ.get("TRACE_SAMPLE", 0))
+TRACE_EXPORT = os.environ.get("TRACE_EXPORT", "/tmp/spans.jsonl")
+TRACE_SERVICE = "stock"
+TRACE_HEADER = "traceparent"
+TRACE_QUEUE_SIZE = 10000
+TRACE_BATCH_SIZE = 500
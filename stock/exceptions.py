@@ -7,5 +7,8 @@ class InsufficientStockError(Exception):
 class ItemNotFoundError(Exception):
 	pass
 
+class OperationUndoneError(Exception):
+	pass
+
 class RabbitMQError(Exception):
     pass
\ No newline at end of file
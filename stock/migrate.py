@@ -0,0 +1,63 @@
+'''
+Rewrites records stored in an older encoding in the current compact one (see model.py).
+
+    python migrate.py [--dry-run]
+
+Reads the same REDIS_* and STOCK_SHARDS environment as the consumer and migrates
+every shard. It can run while the service is up: a record is only replaced if it did not change since it was read.
+'''
+import argparse
+
+from config import *
+from model import is_current, decode_record, encode_record
+from scripts import REPLACE_IF_UNCHANGED
+from services import db
+
+SCAN_COUNT = 1000
+
+
+def migrate(client, dry_run: bool = False) -> dict[str, int]:
+    replace = client.register_script(REPLACE_IF_UNCHANGED)
+    stats = {"records": 0, "legacy": 0, "migrated": 0, "bytes_before": 0, "bytes_after": 0}
+    prefix = IDEMPOTENCY_PREFIX.encode()
+    batch = []
+
+    def flush():
+        keys = [key for key in batch if not key.startswith(prefix)]
+        batch.clear()
+        if not keys:
+            return
+        args = []
+        legacy = []
+        for key, raw in zip(keys, client.mget(keys)):
+            if raw is None:
+                continue
+            stats["records"] += 1
+            compact = raw if is_current(raw) else encode_record(decode_record(raw))
+            stats["bytes_before"] += len(raw)
+            stats["bytes_after"] += len(compact)
+            if compact is not raw:
+                legacy.append(key)
+                args += [raw, compact]
+        stats["legacy"] += len(legacy)
+        if legacy and not dry_run:
+            stats["migrated"] += replace(keys=legacy, args=args)
+
+    for key in client.scan_iter(count=SCAN_COUNT):
+        batch.append(key)
+        if len(batch) == SCAN_COUNT:
+            flush()
+    flush()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rewrite stored records in the compact encoding")
+    parser.add_argument("--dry-run", action="store_true", help="only count the records and their sizes")
+    args = parser.parse_args()
+    for name, client in db.clients.items():
+        print(name, migrate(client, args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+'''
+Moves stock items to the shards that own them under a new STOCK_SHARDS list.
+
+    python rebalance.py <old STOCK_SHARDS> <new STOCK_SHARDS> [--dry-run]
+
+Every item whose owner changes is copied with DUMP/RESTORE (keeping its TTL)
+and deleted from its old shard. An operation is recorded on each shard that held
+one of its items, so a replay finds its marker where the items are now: the
+idempotency markers of a shard are copied to the shards that received items
+from it, and only those.
+
+Markers do not say which items their operation touched, so all of a shard's
+markers go to each of those shards. The cost is markers x receiving shards per
+source shard. With consistent hashing, adding one shard moves items from every
+old shard to the new one only, so each marker is copied once. Markers expire
+after IDEMPOTENCY_TTL, which bounds their number by the operations of that
+period. --dry-run reports both counts.
+
+Run it with the stock consumers stopped, then restart them with the new list.
+'''
+import argparse
+import os
+
+from config import *
+from sharding import ShardedRedis, parse_shards
+
+SCAN_COUNT = 1000
+
+
+def scan_batches(client, match=None):
+    batch = []
+    for key in client.scan_iter(match=match, count=SCAN_COUNT):
+        batch.append(key)
+        if len(batch) == SCAN_COUNT:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def copy_keys(source, target, keys: list, replace: bool = True):
+    with source.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.dump(key)
+            pipe.pttl(key)
+        dumped = pipe.execute()
+    with target.pipeline(transaction=False) as pipe:
+        for key, value, ttl in zip(keys, dumped[::2], dumped[1::2]):
+            if value is not None:
+                pipe.restore(key, max(ttl, 0), value, replace=replace)
+        pipe.execute(raise_on_error=replace)
+
+
+def rebalance(old: ShardedRedis, new: ShardedRedis, dry_run: bool = False) -> dict[str, int]:
+    moved = 0
+    markers = 0
+    prefix = IDEMPOTENCY_PREFIX.encode()
+    for name, source in old.clients.items():
+        # Shards that received items from this one
+        targets = set()
+        for keys in scan_batches(source):
+            items = [key for key in keys if not key.startswith(prefix)]
+            for target_name, target_keys in new.group([key.decode() for key in items]).items():
+                if target_name == name:
+                    continue
+                targets.add(target_name)
+                moved += len(target_keys)
+                if not dry_run:
+                    copy_keys(source, new.clients[target_name], target_keys)
+                    source.delete(*target_keys)
+        if not targets:
+            continue
+        for ops in scan_batches(source, match=IDEMPOTENCY_PREFIX + "*"):
+            markers += len(ops) * len(targets)
+            if not dry_run:
+                for target_name in targets:
+                    copy_keys(source, new.clients[target_name], ops, replace=False)
+    return {"moved": moved, "markers": markers}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebalance the stock keyspace onto a new list of shards")
+    parser.add_argument("old", help="current STOCK_SHARDS")
+    parser.add_argument("new", help="new STOCK_SHARDS")
+    parser.add_argument("--dry-run", action="store_true", help="only count the keys that would move")
+    args = parser.parse_args()
+    password = os.environ.get('REDIS_PASSWORD')
+    old = ShardedRedis(parse_shards(args.old), password, SHARD_VNODES)
+    new = ShardedRedis(parse_shards(args.new), password, SHARD_VNODES)
+    print(rebalance(old, new, args.dry_run))
+    old.close()
+    new.close()
+
+
+if __name__ == "__main__":
+    main()
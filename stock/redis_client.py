@@ -0,0 +1,188 @@
+import threading
+import time
+
+import redis
+from redis.backoff import EqualJitterBackoff
+from redis.retry import Retry
+
+from config import *
+from metrics import registry
+import tracing
+
+FAILURES = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+
+COMMAND_SECONDS = registry.histogram("redis_command_seconds", "Redis command latency, by command", ("command",))
+COMMAND_ERRORS = registry.counter("redis_command_errors_total", "Redis commands that failed, by command", ("command",))
+
+# Breaker of each instance's current client, "host:port/db" -> CircuitBreaker, for the metrics below
+BREAKERS: dict = {}
+
+
+class CircuitOpenError(redis.exceptions.ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    '''
+    Fails commands fast while a Redis instance is down.
+
+    After `threshold` consecutive failed commands the circuit opens and every
+    command is refused without touching the network. Once `reset_time` seconds
+    have passed a single command is let through: its success closes the circuit,
+    its failure opens it again.
+    '''
+
+    def __init__(self, threshold: int, reset_time: float):
+        self.threshold = threshold
+        self.reset_time = reset_time
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.probing else "open"
+
+    def allow(self):
+        if self.opened_at is None:
+            return
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.probing or time.monotonic() - self.opened_at < self.reset_time:
+                raise CircuitOpenError("Redis circuit open")
+            self.probing = True
+
+    def success(self):
+        if self.failures == 0 and self.opened_at is None:
+            return
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    self.trips += 1
+                self.opened_at = time.monotonic()
+
+
+class LatencyStats:
+    # Count, errors, total and worst latency per command name
+
+    def __init__(self):
+        self.commands: dict[str, list] = {}
+        self.lock = threading.Lock()
+
+    def record(self, name: str, seconds: float, error: bool):
+        with self.lock:
+            entry = self.commands.get(name)
+            if entry is None:
+                entry = self.commands[name] = [0, 0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += error
+            entry[2] += seconds
+            entry[3] = max(entry[3], seconds)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {name: {"count": count, "errors": errors, "mean_ms": round(total / count * 1000, 3),
+                           "max_ms": round(worst * 1000, 3)}
+                    for name, (count, errors, total, worst) in self.commands.items()}
+
+
+class RedisClient(redis.Redis):
+    '''
+    Redis client guarded by a circuit breaker and timing every command.
+
+    Connection errors and timeouts are retried by the connection itself, with
+    jittered exponential backoff, REDIS_RETRIES times; only a command that still
+    fails counts against the breaker. Retrying writes is safe here because every
+    write is either idempotent or deduplicated on its operation id.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.breaker = CircuitBreaker(REDIS_BREAKER_THRESHOLD, REDIS_BREAKER_RESET)
+        self.latency = LatencyStats()
+
+    def guarded(self, name: str, fn, *args, **kwargs):
+        self.breaker.allow()
+        span = tracing.child_span(f"redis {name}", "client")
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except FAILURES as e:
+            self.record(name, time.perf_counter() - start, True)
+            self.breaker.failure()
+            span.end(e)
+            raise
+        except Exception as e:
+            # Redis answered, with an error of the command itself
+            self.record(name, time.perf_counter() - start, True)
+            self.breaker.success()
+            span.end(e)
+            raise
+        self.record(name, time.perf_counter() - start, False)
+        self.breaker.success()
+        span.end()
+        return result
+
+    def record(self, name: str, seconds: float, error: bool):
+        self.latency.record(name, seconds, error)
+        COMMAND_SECONDS.observe(seconds, name)
+        if error:
+            COMMAND_ERRORS.inc(name)
+
+    def execute_command(self, *args, **options):
+        return self.guarded(str(args[0]).upper(), super().execute_command, *args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return GuardedPipeline(self, self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+    def stats(self) -> dict:
+        return {"breaker": {"state": self.breaker.state, "trips": self.breaker.trips},
+                "commands": self.latency.snapshot()}
+
+
+class GuardedPipeline(redis.client.Pipeline):
+    # Pipelines of a RedisClient: commands run while WATCHing, and the pipeline as a whole, are guarded
+
+    def __init__(self, client: RedisClient, *args):
+        super().__init__(*args)
+        self.client = client
+
+    def immediate_execute_command(self, *args, **options):
+        return self.client.guarded(str(args[0]).upper(), super().immediate_execute_command, *args, **options)
+
+    def execute(self, raise_on_error: bool = True):
+        name = "MULTI" if self.transaction else "PIPELINE"
+        return self.client.guarded(name, super().execute, raise_on_error)
+
+
+def create_client(host: str, port: int, db: int, password: str) -> RedisClient:
+    # Bounded pool shared by the consumer's threads; a thread waits up to REDIS_POOL_TIMEOUT for a connection
+    pool = redis.BlockingConnectionPool(
+        host=host, port=port, db=db, password=password,
+        max_connections=REDIS_POOL_SIZE, timeout=REDIS_POOL_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT, socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+        retry=Retry(EqualJitterBackoff(REDIS_BACKOFF_CAP, REDIS_BACKOFF_BASE), REDIS_RETRIES),
+        retry_on_error=list(FAILURES))
+    client = RedisClient(connection_pool=pool)
+    BREAKERS[f"{host}:{port}/{db}"] = client.breaker
+    return client
+
+
+registry.collect("redis_breaker_open", "1 while the circuit breaker of the instance refuses commands", ("instance",),
+                 lambda: {(instance,): int(breaker.state != "closed") for instance, breaker in list(BREAKERS.items())})
+registry.collect("redis_breaker_trips_total", "Times the circuit breaker of the instance opened", ("instance",),
+                 lambda: {(instance,): breaker.trips for instance, breaker in list(BREAKERS.items())}, "counter")
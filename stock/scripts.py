@@ -0,0 +1,103 @@
+# Server-side scripts, registered once and run with EVALSHA (redis-py falls back to
+# EVAL when the script cache was flushed).
+
+# Items are stored as [version, stock, price] arrays (see model.py); maps written
+# before the compact encoding are still read, and rewritten compact.
+ITEM_CODEC = """
+local function decode_item(raw)
+    local value = cmsgpack.unpack(raw)
+    if value[1] == 1 then
+        return {stock = value[2], price = value[3]}
+    end
+    return value
+end
+
+local function encode_item(item)
+    return cmsgpack.pack({1, item.stock, item.price})
+end
+"""
+
+# Atomically apply signed stock changes to a set of items.
+#
+# KEYS:      item ids, the idempotency key of the operation and, for a compensation,
+#            the idempotency key of the operation it undoes
+# ARGV[1]:   TTL of the idempotency keys in seconds
+# ARGV[2]:   number of items
+# ARGV[3..]: signed amount per item, in KEYS order
+#
+# Nothing is written unless every item exists, the operation was not applied before
+# and no stock would drop below zero. A compensation marks the operation it undoes as
+# undone; if that operation never ran, nothing else changes and a late delivery of it
+# is refused. Returns {status, stock of every item...} with status 1 = applied,
+# 0 = duplicate operation or nothing to undo (stocks unchanged), or {status, key index}
+# with -1 = item not found, -2 = insufficient stock, -3 = operation was undone.
+ADJUST_STOCK = ITEM_CODEC + """
+local n = tonumber(ARGV[2])
+local undo = KEYS[n + 2]
+local items = {}
+
+for i = 1, n do
+    local raw = redis.call('GET', KEYS[i])
+    if not raw then
+        return {-1, i}
+    end
+    items[i] = decode_item(raw)
+end
+
+local stocks = {0}
+for i = 1, n do
+    stocks[i + 1] = items[i].stock
+end
+
+local marker = redis.call('GET', KEYS[n + 1])
+if marker == '0' then
+    return {-3, 0}
+elseif marker then
+    return stocks
+end
+
+if undo and redis.call('GET', undo) ~= '1' then
+    redis.call('SET', undo, 0, 'EX', ARGV[1])
+    redis.call('SET', KEYS[n + 1], 1, 'EX', ARGV[1])
+    return stocks
+end
+
+for i = 1, n do
+    local stock = items[i].stock + tonumber(ARGV[i + 2])
+    if stock < 0 then
+        return {-2, i}
+    end
+    items[i].stock = stock
+end
+
+stocks[1] = 1
+for i = 1, n do
+    redis.call('SET', KEYS[i], encode_item(items[i]))
+    stocks[i + 1] = items[i].stock
+end
+redis.call('SET', KEYS[n + 1], 1, 'EX', ARGV[1])
+if undo then
+    redis.call('SET', undo, 0, 'EX', ARGV[1])
+end
+return stocks
+"""
+
+
+# Replace records that still hold the value they were read with.
+#
+# KEYS:  record keys
+# ARGV:  per key, the value read and its replacement
+#
+# Used by migrate.py to rewrite records while the service keeps running: a record
+# written in between is left alone (it is written compact anyway). Returns the
+# number of records replaced.
+REPLACE_IF_UNCHANGED = """
+local replaced = 0
+for i = 1, #KEYS do
+    if redis.call('GET', KEYS[i]) == ARGV[2 * i - 1] then
+        redis.call('SET', KEYS[i], ARGV[2 * i], 'KEEPTTL')
+        replaced = replaced + 1
+    end
+end
+return replaced
+"""
@@ -1,193 +1,289 @@
 import os
-import time
 import atexit
 import uuid
 import redis
-from msgspec import msgpack
 from config import *
 
-from model import StockValue
-from exceptions import RedisDBError, ItemNotFoundError, InsufficientStockError
+from model import StockValue, encode_record, decode_record
+from scripts import ADJUST_STOCK
+from sharding import ShardedRedis, parse_shards
+from idempotency import idempotency
+from bulk_load import bulk_load, pipelined_mset
+from exceptions import RedisDBError, ItemNotFoundError, InsufficientStockError, OperationUndoneError
+from messages import Message, FindItem, AddStock, RemoveStock, RemoveStockBulk, AddStockBulk
+import tracing
 
 
 def connect_redis():
-    db_conn: redis.Redis = redis.Redis(host=os.environ['REDIS_HOST'],
-                                       port=int(os.environ['REDIS_PORT']),
-                                       password=os.environ['REDIS_PASSWORD'],
-                                       db=int(os.environ['REDIS_DB']))
+    # One client per shard, items are spread over them by consistent hashing of their id
+    spec = os.environ.get('STOCK_SHARDS') or f"{os.environ['REDIS_HOST']}:{os.environ['REDIS_PORT']}/{os.environ['REDIS_DB']}"
+    db_conn = ShardedRedis(parse_shards(spec), os.environ['REDIS_PASSWORD'], SHARD_VNODES)
     return db_conn
 
 
-def retry_connection():
-    global db
-    for attempt in range(1, MAX_RETRIES):
-        try:
-            db = connect_redis()
-            db.ping()
-        except redis.exceptions.ConnectionError:
-            if attempt < MAX_RETRIES:
-                time.sleep(SLEEP_TIME)
-            else:
-                raise RedisDBError
 
 
 def close_db_connection():
     db.close()
 
 
-db = connect_redis()
-atexit.register(close_db_connection)
 
+def db_stats() -> dict:
+    # Circuit breaker state and per-command latencies of this replica's Redis client
+    return db.stats()
 
-def set_updated_str(last_upd_str: str, new_upd: str):
-    if len(last_upd_str.split(',')) < LAST_UPD_LIMIT:
-        return f"{last_upd_str},{new_upd}"
-    else:
-        last_upd_str = ','.join(last_upd_str.split(',')[1:])
-        return f"{last_upd_str},{new_upd}"
 
-
-def is_duplicate_operation(last_upd_str: str, new_upd: str):
-    if new_upd in last_upd_str:
-        return True
-    else:
-        return False
+db = connect_redis()
+atexit.register(close_db_connection)
+# Called with client= the shard's client; EVALSHA loads it on a shard that does not have it yet
+adjust_stock_script = db.register_script(ADJUST_STOCK)
 
 
 def get_item(item_id: str) -> str:
     try:
-        entry = db.get(item_id)
-    except redis.exceptions.ConnectionError:
-        retry_connection()
-        entry = db.get(item_id)
+        entry = db.client(item_id).get(item_id)
     except redis.exceptions.RedisError:
         raise RedisDBError
-    entry: StockValue | None = msgpack.decode(entry, type=StockValue) if entry else None
+    entry: StockValue | None = decode_record(entry) if entry else None
     if entry is None:
         raise ItemNotFoundError
     return entry
 
 
-def get_item_bulk(item_ids: list) -> list:
+def get_item_bulk(item_ids: list) -> dict:
+    # One MGET per shard, in parallel; items that do not exist are left out
     try:
-        entries = db.mget(item_ids)
-    except redis.exceptions.ConnectionError:
-        retry_connection()
-        entries = db.mget(item_ids)
+        results = db.run(item_ids, lambda client, keys: client.mget(keys))
     except redis.exceptions.RedisError:
         raise RedisDBError
-    return entries
+    return {item_id: decode_record(entry)
+            for keys, entries in results for item_id, entry in zip(keys, entries) if entry}
 
 
 def set_new_item(value: int):
     key = str(uuid.uuid4())
-    value = msgpack.encode(StockValue(stock=0, price=int(value), last_upd='admin_add'))
+    value = encode_record(StockValue(stock=0, price=int(value)))
     try:
-        db.set(key, value)
-    except redis.exceptions.ConnectionError:
-        retry_connection()
-        db.set(key, value)
+        db.client(key).set(key, value)
     except redis.exceptions.RedisError:
         raise RedisDBError
     return key
 
 
 # Check functionality: We are setting same price and stock amount for each item??
-def set_users(n: int, starting_stock: int, item_price: int, item_upd: str = 'admin_add'):
-    n = int(n)
-    starting_stock = int(starting_stock)
-    item_price = int(item_price)
-    kv_pairs: dict[str, bytes] = {
-        f"{i}": msgpack.encode(StockValue(stock=starting_stock, price=item_price, last_upd=item_upd))
-        for i in range(n)}
+def set_users(n: int, starting_stock: int, item_price: int, logger=None) -> int:
+    value = encode_record(StockValue(stock=int(starting_stock), price=int(item_price)))
+
+    def write(chunks: list[dict]):
+        # The chunks' keys split per shard, each shard written in one round trip, in parallel
+        keys = [key for chunk in chunks for key in chunk]
+        db.run(keys, lambda client, shard_keys: pipelined_mset(
+            client, [dict.fromkeys(shard_keys[i:i + BATCH_INIT_CHUNK], value)
+                     for i in range(0, len(shard_keys), BATCH_INIT_CHUNK)]))
+
     try:
-        db.mset(kv_pairs)
-    except redis.exceptions.ConnectionError:
-        retry_connection()
-        db.mset(kv_pairs)
+        return bulk_load(n, lambda low, high: dict.fromkeys((f"{i}" for i in range(low, high)), value), write, logger)
     except redis.exceptions.RedisError:
         raise RedisDBError
 
 
+def run_adjust_stock(client, amounts: dict, new_upd: str, sign: int, undo: str | None) -> list:
+    # One EVALSHA on one shard: checks every item and the idempotency marker, then applies all or nothing.
+    # With `undo` set, the change only applies if operation `undo` did.
+    item_ids = list(amounts.keys())
+    keys = item_ids + [idempotency.key(new_upd)]
+    if undo is not None:
+        keys.append(idempotency.key(undo))
+    args = [idempotency.ttl, len(item_ids)] + [sign * int(amounts[item_id]) for item_id in item_ids]
+    return adjust_stock_script(keys=keys, args=args, client=client)
+
+
+def adjust_stock(amounts: dict, new_upd: str, sign: int, undo: str | None = None) -> list[int]:
+    '''
+    Apply signed stock changes to a set of items, all or nothing.
+
+    Items on different shards are changed by one script per shard, run in
+    parallel, each recording the operation on its own shard. If one shard
+    refuses, the shards that did apply are rolled back, which also marks the
+    operation as undone there, so a redelivery cannot apply half of it.
+    '''
+    adjust = lambda client, keys: run_adjust_stock(client, {key: amounts[key] for key in keys}, new_upd, sign, undo)
+    try:
+        results = db.run(list(amounts.keys()), adjust)
+    except redis.exceptions.RedisError:
+        raise RedisDBError
+    failed = [result[0] for _, result in results if result[0] < 0]
+    if failed and len(results) > 1 and undo is None:
+        rollback = lambda client, keys: run_adjust_stock(client, {key: amounts[key] for key in keys},
+                                                         f"{new_upd}:rollback", -sign, new_upd)
+        for keys, result in results:
+            if result[0] >= 0:
+                try:
+                    rollback(db.client(keys[0]), keys)
+                except redis.exceptions.RedisError:
+                    raise RedisDBError
+    if -1 in failed:
+        raise ItemNotFoundError
+    if -2 in failed:
+        raise InsufficientStockError
+    if -3 in failed:
+        raise OperationUndoneError
+    stocks = {key: stock for keys, result in results for key, stock in zip(keys, result[1:])}
+    return [stocks[item_id] for item_id in amounts]
+
+
 def add_amount(item_id: str, amount: int, new_upd: str):
-    item_entry: StockValue = get_item(item_id)
-    if not is_duplicate_operation(item_entry.last_upd, new_upd):
-        item_entry.stock += int(amount)
-        item_entry.last_upd = set_updated_str(item_entry.last_upd, new_upd)
-        try:
-            db.set(item_id, msgpack.encode(item_entry))
-        except redis.exceptions.ConnectionError:
-            retry_connection()
-            db.set(item_id, msgpack.encode(item_entry))
-        except redis.exceptions.RedisError:
-            raise RedisDBError
-    return item_entry.stock
+    return adjust_stock({item_id: amount}, new_upd, 1)[0]
 
 
 def remove_amount(item_id: str, amount: int, new_upd: str):
-    item_entry: StockValue = get_item(item_id)
-    if not is_duplicate_operation(item_entry.last_upd, new_upd):
-        item_entry.stock -= int(amount)
-        if item_entry.stock < 0:
+    return adjust_stock({item_id: amount}, new_upd, -1)[0]
+
+
+def add_amount_bulk(message: dict, new_upd: str, undo: str | None = None):
+    adjust_stock(message, new_upd, 1, undo)
+
+
+def remove_amount_bulk(stock_remove: dict, new_upd: str):
+    adjust_stock(stock_remove, new_upd, -1)
+
+def batch_item_ids(msg: Message) -> list:
+    if isinstance(msg, (FindItem, AddStock, RemoveStock)):
+        return [msg.item_id]
+    return list(getattr(msg, 'data', ()))
+
+
+def apply_amount_bulk(items: dict, dirty: set, amounts: dict, sign: int):
+    updated = dict()
+    for item_id, amount in amounts.items():
+        item: StockValue | None = items.get(item_id)
+        if item is None:
+            raise ItemNotFoundError
+        stock = item.stock + sign * int(amount)
+        if stock < 0:
             raise InsufficientStockError
+        updated[item_id] = StockValue(stock=stock, price=item.price)
+    items.update(updated)
+    dirty.update(updated)
+
+
+def is_duplicate(markers: dict, new_upd: str) -> bool:
+    if new_upd not in markers:
+        return False
+    if not markers[new_upd]:
+        raise OperationUndoneError
+    return True
+
+
+def apply_batch_op(items: dict, dirty: set, markers: dict, msg: Message, new_upd: str):
+    if isinstance(msg, (FindItem, AddStock, RemoveStock)):
+        item: StockValue | None = items.get(msg.item_id)
+        if item is None:
+            raise ItemNotFoundError
+        if isinstance(msg, FindItem):
+            # Later messages of the batch may still change the in-memory entry
+            return StockValue(stock=item.stock, price=item.price)
+        if is_duplicate(markers, new_upd):
+            return item.stock
+        sign = 1 if isinstance(msg, AddStock) else -1
+        stock = item.stock + sign * msg.amount
+        if stock < 0:
+            raise InsufficientStockError
+        items[msg.item_id] = StockValue(stock=stock, price=item.price)
+        dirty.add(msg.item_id)
+        markers[new_upd] = True
+        return stock
+    elif isinstance(msg, (RemoveStockBulk, AddStockBulk)):
+        if is_duplicate(markers, new_upd):
+            return
+        undo = getattr(msg, 'undo', None)
+        if undo is not None and not markers.get(undo):
+            # Compensation of an operation that never ran, make sure it never does
+            markers[undo] = False
+            markers[new_upd] = True
+            return
+        apply_amount_bulk(items, dirty, msg.data, -1 if isinstance(msg, RemoveStockBulk) else 1)
+        markers[new_upd] = True
+        if undo is not None:
+            markers[undo] = False
+    else:
+        raise ValueError(f"{msg.action} can't be batched")
+
+
+def execute_shard_batch(shard: str, ops: list[tuple[Message, str]]) -> list:
+    item_ids = sorted({item_id for msg, _ in ops for item_id in batch_item_ids(msg)})
+    op_ids = [new_upd for _, new_upd in ops] + [msg.undo for msg, _ in ops if getattr(msg, 'undo', None)]
+    op_keys = [idempotency.key(op_id) for op_id in op_ids]
+    for attempt in range(BATCH_MAX_RETRIES):
         try:
-            item_entry.last_upd = set_updated_str(item_entry.last_upd, new_upd)
-            db.set(item_id, msgpack.encode(item_entry))
-        except redis.exceptions.ConnectionError:
-            retry_connection()
-            db.set(item_id, msgpack.encode(item_entry))
-        except redis.exceptions.RedisError:
-            raise RedisDBError
-    return item_entry.stock
-
-
-def add_amount_bulk(message: dict, new_upd: str):
-    item_ids = list(message.keys())
-    items = get_item_bulk(item_ids)
-    stocks_upd = dict()
-    retry_flag = False
-    for i in range(len(items)):
-        item: StockValue | None = msgpack.decode(items[i], type=StockValue) if items[i] else None
-        if is_duplicate_operation(item.last_upd, new_upd):
-            retry_flag = True
-            break
-        item.stock += int(message[item_ids[i]])
-        stocks_upd[item_ids[i]] = msgpack.encode(
-            StockValue(stock=item.stock,
-                       price=item.price,
-                       last_upd=set_updated_str(item.last_upd, new_upd)))
-    if not retry_flag:
-        try:
-            db.mset(stocks_upd)
-        except redis.exceptions.ConnectionError:
-            retry_connection()
-            db.mset(stocks_upd)
+            with db.clients[shard].pipeline() as pipe:
+                pipe.watch(*item_ids, *op_keys)
+                entries = pipe.mget(item_ids) if item_ids else []
+                items = {item_id: decode_record(entry) if entry else None
+                         for item_id, entry in zip(item_ids, entries)}
+                seen = idempotency.seen(pipe, op_ids)
+                markers = dict(seen)
+                dirty = set()
+                results = []
+                for msg, new_upd in ops:
+                    try:
+                        results.append(apply_batch_op(items, dirty, markers, msg, new_upd))
+                    except Exception as e:
+                        results.append(e)
+                pipe.multi()
+                if dirty:
+                    pipe.mset({item_id: encode_record(items[item_id]) for item_id in dirty})
+                for op_id, applied in markers.items():
+                    if seen.get(op_id) != applied:
+                        idempotency.record(pipe, op_id, applied)
+                pipe.execute()
+            return results
+        except redis.exceptions.WatchError:
+            continue
         except redis.exceptions.RedisError:
             raise RedisDBError
+    raise RedisDBError
 
 
-def remove_amount_bulk(stock_remove: dict, new_upd: str):
-    item_ids = list(stock_remove.keys())
-    items = get_item_bulk(item_ids)
-    stocks_upd = dict()
-    retry_flag = False
-    for i in range(len(items)):
-        item: StockValue | None = msgpack.decode(items[i], type=StockValue) if items[i] else None
-        if is_duplicate_operation(item.last_upd, new_upd):
-            retry_flag = True
-            break
-        item.stock -= int(stock_remove[item_ids[i]])
-        if item.stock < 0:
-            raise InsufficientStockError
-        stocks_upd[item_ids[i]] = msgpack.encode(
-            StockValue(stock=item.stock,
-                       price=item.price,
-                       last_upd=set_updated_str(item.last_upd, new_upd)))
-    if not retry_flag:
+def execute_single(msg: Message, new_upd: str):
+    if isinstance(msg, RemoveStockBulk):
+        return remove_amount_bulk(msg.data, new_upd)
+    elif isinstance(msg, AddStockBulk):
+        return add_amount_bulk(msg.data, new_upd, msg.undo)
+    raise ValueError(f"{msg.action} can't be batched")
+
+
+def execute_batch(ops: list[tuple[Message, str]]) -> list:
+    '''
+    Execute a batch of (message, operation id) pairs with one MGET and one MULTI
+    per shard, the shards in parallel.
+
+    The rules of the single-message functions above are applied in message order
+    on in-memory entries, so later messages see the effect of earlier ones. The
+    items and the idempotency keys are WATCHed: a concurrent write from another
+    replica restarts the shard's batch from fresh reads. Bulk messages whose
+    items live on several shards go through adjust_stock instead. Returns, per
+    message, its result or the exception it raised.
+    '''
+    results = [None] * len(ops)
+    per_shard: dict[str, list[int]] = {}
+    spanning = []
+    for index, (msg, _) in enumerate(ops):
+        shards = {db.name(item_id) for item_id in batch_item_ids(msg)} or {next(iter(db.clients))}
+        if len(shards) == 1:
+            per_shard.setdefault(shards.pop(), []).append(index)
+        else:
+            spanning.append(index)
+    run_shard_batch = tracing.bind(tracing.current.get(), execute_shard_batch)
+    futures = {name: db.executor.submit(run_shard_batch, name, [ops[i] for i in indices])
+               for name, indices in per_shard.items()}
+    for index in spanning:
         try:
-            db.mset(stocks_upd)
-        except redis.exceptions.ConnectionError:
-            retry_connection()
-            db.mset(stocks_upd)
-        except redis.exceptions.RedisError:
-            raise RedisDBError
\ No newline at end of file
+            results[index] = execute_single(*ops[index])
+        except Exception as e:
+            results[index] = e
+    for name, future in futures.items():
+        shard_results = future.result()
+        for index, result in zip(per_shard[name], shard_results):
+            results[index] = result
+    return results
@@ -0,0 +1,100 @@
+import bisect
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+from redis_client import RedisClient, create_client
+
+
+def parse_shards(spec: str) -> list[tuple[str, int, int]]:
+    # "host:port/db,host:port/db" -> [(host, port, db), ...]
+    shards = []
+    for entry in spec.split(','):
+        address, _, db = entry.strip().partition('/')
+        host, _, port = address.partition(':')
+        shards.append((host, int(port or 6379), int(db or 0)))
+    return shards
+
+
+def shard_name(host: str, port: int, db: int) -> str:
+    return f"{host}:{port}/{db}"
+
+
+def ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    '''
+    Consistent hashing of keys onto shard names.
+
+    Every shard owns `vnodes` points on the ring and a key belongs to the first
+    point at or after its hash. Adding a shard only moves the keys that land on
+    its points, roughly 1/N of them, which is what makes rebalancing cheap.
+    '''
+
+    def __init__(self, names: list[str], vnodes: int):
+        points = sorted((ring_hash(f"{name}#{i}"), name) for name in names for i in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.names = [name for _, name in points]
+
+    def node_for(self, key: str) -> str:
+        index = bisect.bisect(self.hashes, ring_hash(key)) % len(self.hashes)
+        return self.names[index]
+
+
+class ShardedRedis:
+    '''
+    Redis clients for a keyspace spread over several instances.
+
+    `client(key)` picks the instance that owns a key; `run` splits a set of keys
+    per instance and runs one call per instance, in parallel when there is more
+    than one.
+    '''
+
+    def __init__(self, shards: list[tuple[str, int, int]], password: str, vnodes: int):
+        self.clients = {shard_name(*shard): create_client(*shard, password) for shard in shards}
+        self.ring = HashRing(list(self.clients), vnodes)
+        self.executor = ThreadPoolExecutor(max_workers=4 * len(self.clients), thread_name_prefix="redis-shard")
+
+    def __len__(self):
+        return len(self.clients)
+
+    def name(self, key: str) -> str:
+        return self.ring.node_for(str(key))
+
+    def client(self, key: str) -> RedisClient:
+        return self.clients[self.name(key)]
+
+    def group(self, keys) -> dict[str, list]:
+        groups: dict[str, list] = {}
+        for key in keys:
+            groups.setdefault(self.name(key), []).append(key)
+        return groups
+
+    def run(self, keys, fn) -> list[tuple[list, object]]:
+        # fn(client, keys of that client) per shard; returns (keys, result) pairs
+        groups = self.group(keys)
+        if len(groups) == 1:
+            name, shard_keys = next(iter(groups.items()))
+            return [(shard_keys, fn(self.clients[name], shard_keys))]
+        # The shard threads trace their commands under the caller's span
+        fn = tracing.bind(tracing.current.get(), fn)
+        futures = [(shard_keys, self.executor.submit(fn, self.clients[name], shard_keys))
+                   for name, shard_keys in groups.items()]
+        return [(shard_keys, future.result()) for shard_keys, future in futures]
+
+    def register_script(self, script: str):
+        return next(iter(self.clients.values())).register_script(script)
+
+    def stats(self) -> dict:
+        return {name: client.stats() for name, client in self.clients.items()}
+
+    def ping(self):
+        for client in self.clients.values():
+            client.ping()
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        self.executor.shutdown(wait=False)
@@ -1,116 +1,74 @@
+import asyncio
+import functools
 import logging
-import uuid
-import pika
-import os
-from threading import Thread
+import time
 from msgspec import msgpack, Struct
-from flask import Flask, jsonify, abort, Response, request
+from quart import Quart, jsonify, abort, request
 from datetime import datetime
 from config import *
-import time
+from rpc_client import RabbitMQClient, request_deadline
+from read_cache import ReadCache
+from logs import configure_logger, LogSampler, log_sampled
+from metrics import registry, CONTENT_TYPE
+from messages import DbStats, CreateItem, StockBatchInit, FindItem, AddStock, RemoveStock
+import tracing
 DB_ERROR_STR = "DB error"
 
-app = Flask("stock-gateway")
+app = Quart("stock-gateway")
 
 
-class RabbitMQClient:
+rabbitmq_client = RabbitMQClient(app.logger)
+read_cache = ReadCache("stock", app.logger)
 
-    def connect(self):
-        app.logger.info("Connecting to broker...")
-        self.connection = pika.BlockingConnection(pika.URLParameters(os.environ['RABBITMQ_BROKER_URL']))
-        self.channel = self.connection.channel()
-        self.channel.queue_declare(queue=ORDER_QUEUE)
-        self.channel.queue_declare(queue=STOCK_QUEUE)
-        self.channel.queue_declare(queue=PAYMENT_QUEUE)
+inflight = asyncio.Semaphore(GATEWAY_MAX_INFLIGHT)
+log_sampler = LogSampler(LOG_SAMPLE)
 
-    def __init__(self):
-        self.connect()
+# Metrics of this worker process, served at /metrics
+REQUEST_SECONDS = registry.histogram("gateway_request_seconds", "Time to answer a request, by endpoint and status",
+                                     ("endpoint", "status"))
+IN_FLIGHT = registry.gauge("gateway_requests_in_flight", "Requests being served")
+registry.collect("gateway_read_cache_requests_total", "Read cache lookups by result", ("result",),
+                 lambda: {("hit",): read_cache.stats()["hits"], ("miss",): read_cache.stats()["misses"]}, "counter")
 
 
-    def call(self, message, queue, is_message_sent = False, retry_queue = None, retry_corr_id = None):
-        corr_id = None
-        response_queue = None
-        try:
-            if is_message_sent:
-                corr_id = retry_corr_id
-                response_queue = retry_queue
-            else:
-                corr_id = str(uuid.uuid4())
-                response_queue = self.channel.queue_declare(queue='', exclusive=True).method.queue
-            
-            def on_response(ch, method, props, body):
-                if corr_id == props.correlation_id:
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
-                    self.response = msgpack.decode(body)
-                    ch.stop_consuming()
-
-            self.channel.basic_consume(queue=response_queue, on_message_callback=on_response, auto_ack=False)
-            self.response = None
-            if not is_message_sent:
-                self.channel.basic_publish(
-                    exchange='',
-                    routing_key=queue,
-                    properties=pika.BasicProperties(
-                        reply_to=response_queue,
-                        correlation_id=corr_id,
-                    ),
-                    body=msgpack.encode(message)
-                )
-                is_message_sent = True
-
-            while self.response is None:
-                self.connection.process_data_events(time_limit=None)
-
-            return self.response
-        except Exception as e:
-            app.logger.error(e)
-            while True:
-                try:
-                    self.connect()
-                    if is_message_sent:
-                        return self.call(message, queue, is_message_sent, response_queue, corr_id)
-                    else:
-                        return self.call(message, queue)
-                except Exception as e:
-                    time.sleep(5)
-                    app.logger.error("Reconnecting...")
-
-rabbitmq_client = RabbitMQClient()
-
-class ThreadWithReturnValue(Thread):
-    
-    def __init__(self, group=None, target=None, name=None,
-                 args=(), kwargs={}, Verbose=None):
-        Thread.__init__(self, group, target, name, args, kwargs)
-        self._return = None
-
-    def run(self):
-        if self._target is not None:
-            self._return = self._target(*self._args,
-                                                **self._kwargs)
-    def join(self, *args):
-        Thread.join(self, *args)
-        return self._return
-
-
-def threaded(fn):
-    def wrapper(*args, **kwargs):
+def rpc_route(fn):
+    '''
+    Run a route as a coroutine on the event loop.
+
+    At most GATEWAY_MAX_INFLIGHT requests per process wait on the broker at once,
+    the rest queue on the semaphore. Every RPC made by the route shares one
+    deadline, RPC_TIMEOUT seconds after the request arrived, and a missed deadline
+    comes back as a 504. The RPC response dict is mapped onto jsonify/abort exactly
+    like the old thread-per-request wrapper did. Each request is timed in the
+    metrics and is the server span of its trace.
+    '''
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
         endpoint = request.endpoint
-        request_data = request.get_json() if request.is_json else request.values.to_dict()
-        timestamp = datetime.now()
-        app.logger.info(f"[{timestamp}] API: {endpoint} | {request_data}")
-            
-        def callback():
-                
-            try:
-                return fn(*args, **kwargs)
-            except Exception as e:
-                app.logger.error(f"Error in thread: {e}")
-        
-        thread = ThreadWithReturnValue(target=callback)
-        thread.start()
-        response = thread.join()
-        app.logger.info(f"Response: {response}")
+        if app.logger.isEnabledFor(logging.INFO) and log_sampler.keep(endpoint):
+            # The body is only read for the log line
+            request_data = await request.get_json() if request.is_json else (await request.values).to_dict()
+            app.logger.info("[%s] API: %s | %s", datetime.now(), endpoint, request_data, extra={"action": endpoint})
+
+        start = time.perf_counter()
+        IN_FLIGHT.inc()
+        request_deadline.set(time.time() + RPC_TIMEOUT)
+        try:
+            # A trace started by the client or the proxy is continued, else this is the root span
+            with tracing.start_span(endpoint, tracing.extract(request.headers), "server") as span:
+                async with inflight:
+                    try:
+                        response = await fn(*args, **kwargs)
+                    except Exception as e:
+                        app.logger.error("Error in request: %s", e)
+                        response = None
+                status = response['status'] if response is not None else 500
+                span.set("status", status)
+        finally:
+            # Also when the client goes away and the request is cancelled
+            IN_FLIGHT.dec()
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint, status)
+        log_sampled(app.logger, log_sampler, "response", "Response: %s", response)
         if response is not None:
             if response['status'] == STATUS_SUCCESS:
                 return jsonify(response['data'])
@@ -118,49 +76,69 @@ def threaded(fn):
                 return abort(response['status'], response['data'] )
         else:
             return abort(500, SERV_ERROR_STR)
-    wrapper.__name__ = f"{fn.__name__}_wrapper"
+
     return wrapper
 
 
 @app.post('/item/create/<price>')
-@threaded
-def create_item(price: int):
-    response = rabbitmq_client.call({'action': 'create_item', 'price': price}, STOCK_QUEUE)
+@rpc_route
+async def create_item(price: int):
+    response = await rabbitmq_client.call_async(CreateItem(int(price)), STOCK_QUEUE)
     return response
 
 
 @app.post('/batch_init/<n>/<starting_stock>/<item_price>')
-@threaded
-def batch_init_users(n: int, starting_stock: int, item_price: int):
-    response = rabbitmq_client.call(
-        {'action': 'batch_init', 'n': n, 'starting_stock': starting_stock, 'item_price': item_price}, STOCK_QUEUE)
+@rpc_route
+async def batch_init_users(n: int, starting_stock: int, item_price: int):
+    response = await rabbitmq_client.call_async(
+        StockBatchInit(int(n), int(starting_stock), int(item_price)), STOCK_QUEUE, time.time() + BATCH_INIT_TIMEOUT)
     return response
 
 
 @app.get('/find/<item_id>')
-@threaded
-def find_item(item_id: str):
-    response = rabbitmq_client.call({'action': 'find_item', 'item_id': item_id}, STOCK_QUEUE)
-    return response
+@rpc_route
+async def find_item(item_id: str):
+    return await read_cache.fetch(item_id, lambda: rabbitmq_client.call_async(
+        FindItem(item_id), STOCK_QUEUE))
 
 
 @app.post('/add/<item_id>/<amount>')
-@threaded
-def add_stock(item_id: str, amount: int):
-    response = rabbitmq_client.call({'action': 'add_stock', 'item_id': item_id, 'amount': amount}, STOCK_QUEUE)
+@rpc_route
+async def add_stock(item_id: str, amount: int):
+    response = await rabbitmq_client.call_async(AddStock(item_id, int(amount)), STOCK_QUEUE)
+    # The invalidation event may reach this worker after the reply, so a find right after sees the write
+    read_cache.invalidate([item_id])
     return response
 
 
 @app.post('/subtract/<item_id>/<amount>')
-@threaded
-def remove_stock(item_id: str, amount: int):
-    response = rabbitmq_client.call({'action': 'remove_stock', 'item_id': item_id, 'amount': amount}, STOCK_QUEUE)
+@rpc_route
+async def remove_stock(item_id: str, amount: int):
+    response = await rabbitmq_client.call_async(RemoveStock(item_id, int(amount)), STOCK_QUEUE)
+    read_cache.invalidate([item_id])
     return response
 
 
+@app.get('/db_stats')
+@rpc_route
+async def db_stats():
+    # Redis circuit breaker and per-command latencies of the stock service replica that answers
+    return await rabbitmq_client.call_async(DbStats(), STOCK_QUEUE)
+
+
+@app.get('/cache_stats')
+async def cache_stats():
+    # Hit/miss counters of this worker's read cache
+    return jsonify(read_cache.stats())
+
+
+@app.get('/metrics')
+async def metrics():
+    # Prometheus text format; each gunicorn worker keeps and serves its own
+    return registry.render(), 200, {"Content-Type": CONTENT_TYPE}
+
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=8000, debug=True)
 else:
-    gunicorn_logger = logging.getLogger('gunicorn.error')
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
+    configure_logger(app.logger, LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE, background=LOG_BACKGROUND)
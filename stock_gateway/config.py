@@ -1,3 +1,5 @@
+import os
+
 STOCK_QUEUE= "STOCK_QUEUE"
 ORDER_QUEUE = "ORDER_QUEUE"
 PAYMENT_QUEUE="PAYMENT_QUEUE"
@@ -5,7 +7,56 @@ PAYMENT_QUEUE="PAYMENT_QUEUE"
 STATUS_SUCCESS = 200
 STATUS_CLIENT_ERROR = 400
 STATUS_SERVER_ERROR = 500
+STATUS_GATEWAY_TIMEOUT = 504
 
 DB_ERROR_STR = "DB error"
 REQ_ERROR_STR = "Requests error"
-SERV_ERROR_STR = "Server error"
\ No newline at end of file
+SERV_ERROR_STR = "Server error"
+TIMEOUT_ERROR_STR = "Deadline exceeded"
+
+DIRECT_REPLY_QUEUE = "amq.rabbitmq.reply-to"
+RECONNECT_DELAY = 5
+
+# Maximum number of requests per gateway process waiting on the broker at once
+GATEWAY_MAX_INFLIGHT = int(os.environ.get("GATEWAY_MAX_INFLIGHT", 1024))
+
+# Broker connections per gateway process, and how long an I/O loop may stall before
+# its connection is considered unhealthy
+BROKER_POOL_SIZE = int(os.environ.get("BROKER_POOL_SIZE", 4))
+BROKER_HEALTH_TIMEOUT = 5
+
+# Seconds an HTTP request may spend waiting on the services before it fails with 504.
+# The absolute deadline travels with every message in the DEADLINE_HEADER (epoch ms).
+RPC_TIMEOUT = float(os.environ.get("RPC_TIMEOUT", 10))
+# batch_init loads a whole dataset in one request, and gets this many seconds instead
+BATCH_INIT_TIMEOUT = float(os.environ.get("BATCH_INIT_TIMEOUT", 300))
+DEADLINE_HEADER = "x-deadline"
+
+# Read cache for /find responses: seconds an entry is served (0 turns it off) and entries
+# kept. Entries are dropped early on the write events consumers publish to ENTITY_EVENTS.
+READ_CACHE_TTL = float(os.environ.get("READ_CACHE_TTL", 0))
+READ_CACHE_SIZE = int(os.environ.get("READ_CACHE_SIZE", 100_000))
+# Invalidations only discard in-flight fetches of keys that share their generation bucket
+GENERATION_BUCKETS = 4096
+ENTITY_EVENTS_EXCHANGE = "ENTITY_EVENTS"
+
+# Logging: level, "text" or "json" lines, and sampling rates of the per-message logs by action
+# ("find_item=0.01,response=0.1,*=1"). Where stderr can block (a pipe or socket, LOG_BACKGROUND
+# "auto") or with LOG_BACKGROUND "true", records are written by a background thread; when
+# LOG_QUEUE_SIZE records are waiting, new ones are dropped.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+LOG_SAMPLE = os.environ.get("LOG_SAMPLE", "")
+LOG_QUEUE_SIZE = 10000
+LOG_BACKGROUND = os.environ.get("LOG_BACKGROUND", "auto").lower()
+
+# Tracing: share of requests without a trace context that start a recorded trace (0 turns
+# tracing off); downstream hops follow the decision carried in the W3C TRACE_HEADER. Spans
+# are written by a background thread to TRACE_EXPORT, a file of JSON lines or the URL of a
+# collector taking POSTed JSON arrays, at most TRACE_BATCH_SIZE per write.
+TRACE_SAMPLE = float(os.environ.get("TRACE_SAMPLE", 0))
+TRACE_EXPORT = os.environ.get("TRACE_EXPORT", "/tmp/spans.jsonl")
+TRACE_SERVICE = "stock-gateway"
+TRACE_HEADER = "traceparent"
+TRACE_QUEUE_SIZE = 10000
+TRACE_BATCH_SIZE = 500
@@ -0,0 +1,198 @@
+from typing import ClassVar, Union
+
+import msgspec
+from msgspec import Struct, msgpack
+
+
+# Requests to the stock, payment and order consumers. On the wire each is a msgpack array
+# [action code, field, ...], decoded straight into its Struct with every field checked, so a
+# consumer dispatches on the type and never touches Redis for a message it cannot handle.
+# Codes are never reused; 1-9 are shared by all queues, then tens per queue: stock,
+# payment, order. New optional fields go at the end, with a default.
+
+
+# Messages never take part in reference cycles, so the garbage collector need not track them
+class Message(Struct, array_like=True, gc=False):
+    # Name of the action in logs, metrics and span names, and in the maps sent before these types
+    action: ClassVar[str]
+
+
+class DbStats(Message, tag=1):
+    action: ClassVar[str] = "db_stats"
+
+
+class CreateItem(Message, tag=10):
+    action: ClassVar[str] = "create_item"
+    price: int
+
+
+class StockBatchInit(Message, tag=11):
+    action: ClassVar[str] = "batch_init"
+    n: int
+    starting_stock: int
+    item_price: int
+
+
+class FindItem(Message, tag=12):
+    action: ClassVar[str] = "find_item"
+    item_id: str
+
+
+class FindItemBulk(Message, tag=13):
+    action: ClassVar[str] = "find_item_bulk"
+    item_ids: list[str]
+
+
+class AddStock(Message, tag=14):
+    action: ClassVar[str] = "add_stock"
+    item_id: str
+    amount: int
+
+
+class RemoveStock(Message, tag=15):
+    action: ClassVar[str] = "remove_stock"
+    item_id: str
+    amount: int
+
+
+class RemoveStockBulk(Message, tag=16):
+    action: ClassVar[str] = "remove_stock_bulk"
+    # Quantity per item, all removed or none
+    data: dict[str, int]
+    order_id: str
+
+
+class AddStockBulk(Message, tag=17):
+    action: ClassVar[str] = "add_stock_bulk"
+    data: dict[str, int]
+    order_id: str
+    # Operation id this one compensates. Applied only if that operation was; if it never ran, a
+    # tombstone is recorded instead of the stock, and the operation is refused should it still arrive
+    undo: str | None = None
+
+
+class CreateUser(Message, tag=20):
+    action: ClassVar[str] = "create_user"
+
+
+class PaymentBatchInit(Message, tag=21):
+    action: ClassVar[str] = "batch_init"
+    n: int
+    starting_money: int
+
+
+class FindUser(Message, tag=22):
+    action: ClassVar[str] = "find_user"
+    user_id: str
+
+
+class AddFunds(Message, tag=23):
+    action: ClassVar[str] = "add_funds"
+    user_id: str
+    amount: int
+    order_id: str | None = None
+    undo: str | None = None
+
+
+class RemoveCredit(Message, tag=24):
+    action: ClassVar[str] = "remove_credit"
+    user_id: str
+    amount: int
+    order_id: str | None = None
+
+
+class CreateOrder(Message, tag=30):
+    action: ClassVar[str] = "create_order"
+    user_id: str
+
+
+class BatchInitUsers(Message, tag=31):
+    action: ClassVar[str] = "batch_init_users"
+    n: int
+    n_items: int
+    n_users: int
+    item_price: int
+
+
+class FindOrder(Message, tag=32):
+    action: ClassVar[str] = "find_order"
+    order_id: str
+
+
+class AddItem(Message, tag=33):
+    action: ClassVar[str] = "add_item"
+    order_id: str
+    item_id: str
+    quantity: int
+
+
+class Checkout(Message, tag=34):
+    action: ClassVar[str] = "checkout"
+    order_id: str
+
+
+class ConfirmOrder(Message, tag=35):
+    action: ClassVar[str] = "confirm_order"
+    order_id: str
+    # The order as the order service stores it, see OrderValue
+    order_entry: dict
+
+
+class CheckoutStats(Message, tag=36):
+    action: ClassVar[str] = "checkout_stats"
+
+
+class PriceCacheStats(Message, tag=37):
+    action: ClassVar[str] = "price_cache_stats"
+
+
+STOCK_MESSAGES = (DbStats, CreateItem, StockBatchInit, FindItem, FindItemBulk, AddStock, RemoveStock,
+                  RemoveStockBulk, AddStockBulk)
+PAYMENT_MESSAGES = (DbStats, CreateUser, PaymentBatchInit, FindUser, AddFunds, RemoveCredit)
+ORDER_MESSAGES = (DbStats, CreateOrder, BatchInitUsers, FindOrder, AddItem, Checkout, ConfirmOrder, CheckoutStats,
+                  PriceCacheStats)
+
+encoder = msgpack.Encoder()
+
+
+def encode(msg: Message) -> bytes:
+    return encoder.encode(msg)
+
+
+class MessageDecoder:
+    '''
+    Decodes the messages of one queue, `types` being the Message types it takes.
+    Anything else, malformed msgpack, an unknown action code or a missing or
+    mistyped field, raises a msgspec.DecodeError (ValidationError for the
+    latter three).
+
+    Maps with an 'action' name, as sent before these types, are still accepted,
+    loosely typed like the services used to read them ("5" for 5), for as long
+    as old gateways may still be around during a rolling upgrade.
+    '''
+
+    def __init__(self, types: tuple):
+        # Maps come out as dicts from the same single pass, arrays as the Message of their tag
+        self.decoder = msgpack.Decoder(Union[types + (dict,)])
+        self.types = {t.action: (t, msgspec.structs.fields(t)) for t in types}
+
+    def decode(self, raw: bytes) -> Message:
+        msg = self.decoder.decode(raw)
+        if type(msg) is dict:
+            return self.decode_legacy(msg)
+        return msg
+
+    def decode_legacy(self, fields: dict) -> Message:
+        action = fields.get('action')
+        if not isinstance(action, str) or action not in self.types:
+            raise msgspec.ValidationError(f"Unknown action {action!r}")
+        t, struct_fields = self.types[action]
+        values = [t.__struct_config__.tag]
+        for field in struct_fields:
+            if field.name in fields:
+                values.append(fields[field.name])
+            elif field.required:
+                raise msgspec.ValidationError(f"Object missing required field `{field.name}`")
+            else:
+                values.append(field.default)
+        return msgspec.convert(values, t, strict=False)
@@ -0,0 +1,136 @@
+"""
+Microbenchmarks of the consumers' per-message path, without RabbitMQ or Redis:
+the stock, payment and order consumers run in this process on the stand-ins
+of standins.py (an in-memory broker and fakeredis).
+
+    python bench_consumers.py [--messages 2000] [--actions find_item,checkout]
+                              [--redis localhost:6379 --password redis]
+
+Per action it reports messages per second, sending --messages messages and
+then delivering them one after another, and the memory the path allocates:
+the peak traced by tracemalloc above what was allocated before a message, the
+mean over --sampled messages, and the blocks still allocated afterwards per
+message, which includes what the message left in fakeredis. checkout is end to
+end, its stock and payment calls included.
+
+The times include the stand-ins, fakeredis above all, so they are for comparing
+runs of this script against each other, e.g. before and after a change to the
+hot path, not for sizing a deployment.
+"""
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+
+from standins import ORDER_QUEUE, PAYMENT_QUEUE, STOCK_QUEUE, System, messages
+
+ITEMS = 1000
+USERS = 1000
+ITEM_PRICE = 1
+# Enough that no run sells out or runs out of credit
+STARTING_STOCK = 10 ** 9
+STARTING_MONEY = 10 ** 9
+WARMUP = 100
+
+
+def item(i: int) -> str:
+    return str(i % ITEMS)
+
+
+def user(i: int) -> str:
+    return str(i % USERS)
+
+
+# action -> (queue, message i of the run); orders are seeded one per message, see seed()
+ACTIONS = {
+    "find_item": (STOCK_QUEUE, lambda i: messages.FindItem(item(i))),
+    "add_stock": (STOCK_QUEUE, lambda i: messages.AddStock(item(i), 1)),
+    "remove_stock": (STOCK_QUEUE, lambda i: messages.RemoveStock(item(i), 1)),
+    "add_stock_bulk": (STOCK_QUEUE, lambda i: messages.AddStockBulk({item(i): 1, item(i + 1): 2}, str(i))),
+    "remove_stock_bulk": (STOCK_QUEUE, lambda i: messages.RemoveStockBulk({item(i): 1, item(i + 1): 2}, str(i))),
+    "find_user": (PAYMENT_QUEUE, lambda i: messages.FindUser(user(i))),
+    "add_funds": (PAYMENT_QUEUE, lambda i: messages.AddFunds(user(i), 1)),
+    "remove_credit": (PAYMENT_QUEUE, lambda i: messages.RemoveCredit(user(i), 1)),
+    "find_order": (ORDER_QUEUE, lambda i: messages.FindOrder(str(i))),
+    "create_order": (ORDER_QUEUE, lambda i: messages.CreateOrder(user(i))),
+    "add_item": (ORDER_QUEUE, lambda i: messages.AddItem(str(i), item(i), 1)),
+    "checkout": (ORDER_QUEUE, lambda i: messages.Checkout(str(i))),
+}
+
+
+def seed(system: System, orders: int):
+    for queue_name, message in (
+            (STOCK_QUEUE, messages.StockBatchInit(ITEMS, STARTING_STOCK, ITEM_PRICE)),
+            (PAYMENT_QUEUE, messages.PaymentBatchInit(USERS, STARTING_MONEY)),
+            (ORDER_QUEUE, messages.BatchInitUsers(orders, ITEMS, USERS, ITEM_PRICE))):
+        response = system.call(queue_name, message)
+        if response['status'] != 200:
+            raise SystemExit(f"seeding {message.action} failed: {response}")
+
+
+def check(action: str, responses: list[dict]):
+    failed = [response for response in responses if response['status'] != 200]
+    if failed:
+        raise SystemExit(f"{action}: {len(failed)} of {len(responses)} messages failed, e.g. {failed[0]}")
+
+
+def throughput(system: System, action: str, first: int, n: int) -> float:
+    queue_name, message = ACTIONS[action]
+    messages = [message(i) for i in range(first, first + n)]
+    start = time.perf_counter()
+    futures = [system.send(queue_name, msg) for msg in messages]
+    responses = system.wait(futures)
+    elapsed = time.perf_counter() - start
+    check(action, responses)
+    return n / elapsed
+
+
+def allocations(system: System, action: str, first: int, n: int) -> tuple[float, float]:
+    # Mean tracemalloc peak per message in bytes, and allocated blocks left behind per message
+    queue_name, message = ACTIONS[action]
+    messages = [message(i) for i in range(first, first + n)]
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    peaks = 0
+    tracemalloc.start()
+    try:
+        for msg in messages:
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            check(action, [system.call(queue_name, msg)])
+            peaks += tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+    gc.collect()
+    return peaks / n, (sys.getallocatedblocks() - blocks) / n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--sampled", type=int, default=200)
+    parser.add_argument("--actions", default=",".join(ACTIONS))
+    parser.add_argument("--redis", default=None, help="host:port of a Redis to use instead of fakeredis")
+    parser.add_argument("--password", default="")
+    args = parser.parse_args()
+
+    actions = [action.strip() for action in args.actions.split(',') if action.strip()]
+    unknown = [action for action in actions if action not in ACTIONS]
+    if unknown:
+        raise SystemExit(f"unknown actions {unknown}, choose from {', '.join(ACTIONS)}")
+
+    system = System(args.redis, args.password)
+    # Every run of an action gets message numbers of its own, so checkouts never see a paid order
+    orders = WARMUP + args.messages + args.sampled
+    seed(system, orders)
+    print(f"{'action':<18} {'msgs/s':>9} {'us/msg':>8} {'peak KiB/msg':>13} {'blocks kept/msg':>16}")
+    for action in actions:
+        throughput(system, action, 0, WARMUP)
+        rate = throughput(system, action, WARMUP, args.messages)
+        peak, kept = allocations(system, action, WARMUP + args.messages, args.sampled)
+        print(f"{action:<18} {rate:>9.0f} {1e6 / rate:>8.1f} {peak / 1024:>13.1f} {kept:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Stored record encodings: bytes per record and encode/decode throughput of the
+old msgpack maps against the compact arrays of each service's model.py. Then
+the same for the messages the consumers take, the old maps with an 'action'
+name against the tagged arrays of messages.py, decoded as the consumers do.
+
+    python bench_encoding.py [records]
+"""
+import importlib.util
+import os
+import sys
+import time
+
+from msgspec import msgpack
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_model(service: str, name: str = "model"):
+    spec = importlib.util.spec_from_file_location(f"{service}_{name}", os.path.join(ROOT, service, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def rate(fn, values) -> float:
+    start = time.perf_counter()
+    for value in values:
+        fn(value)
+    return len(values) / (time.perf_counter() - start)
+
+
+def bench(name: str, model, values: list, legacy: list):
+    compact = [model.encode_record(value) for value in values]
+    legacy_size = sum(len(raw) for raw in legacy) / len(legacy)
+    compact_size = sum(len(raw) for raw in compact) / len(compact)
+    print(f"{name:<8} bytes/record  legacy {legacy_size:7.1f}  compact {compact_size:7.1f}"
+          f"  ({100 * (1 - compact_size / legacy_size):.0f}% smaller)")
+    print(f"{'':<8} encode/s      legacy {rate(msgpack.encode, values):>11,.0f}"
+          f"  compact {rate(model.encode_record, values):>11,.0f}")
+    print(f"{'':<8} decode/s      legacy {rate(model.decode_record, legacy):>11,.0f}"
+          f"  compact {rate(model.decode_record, compact):>11,.0f}")
+
+
+def as_map(msg) -> dict:
+    # A message the way it was sent before messages.py, a map with the action name
+    return {'action': msg.action, **{field: getattr(msg, field) for field in msg.__struct_fields__}}
+
+
+def bench_messages(name: str, m, types: tuple, messages: list):
+    decoder = m.MessageDecoder(types)
+    legacy = [msgpack.encode(as_map(msg)) for msg in messages]
+    compact = [m.encode(msg) for msg in messages]
+    legacy_size = sum(len(raw) for raw in legacy) / len(legacy)
+    compact_size = sum(len(raw) for raw in compact) / len(compact)
+    print(f"{name:<8} bytes/message legacy {legacy_size:7.1f}  typed   {compact_size:7.1f}"
+          f"  ({100 * (1 - compact_size / legacy_size):.0f}% smaller)")
+    print(f"{'':<8} encode/s      legacy {rate(msgpack.encode, [as_map(msg) for msg in messages]):>11,.0f}"
+          f"  typed   {rate(m.encode, messages):>11,.0f}")
+    # The old consumers decoded into a dict and checked the fields as they used them
+    print(f"{'':<8} decode/s      legacy {rate(msgpack.decode, legacy):>11,.0f}"
+          f"  typed   {rate(decoder.decode, compact):>11,.0f}  (old maps now {rate(decoder.decode, legacy):,.0f})")
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    stock = load_model("stock")
+    items = [stock.StockValue(stock=100, price=i % 1000) for i in range(n)]
+    # Records written before the compact encoding still carry their last operation id
+    bench("stock", stock, items, [msgpack.encode({"stock": v.stock, "price": v.price,
+                                                  "last_upd": "3f2b9c1e-8d4a-4c6e-9b1f-0a7d5e2c4b8f"})
+                                  for v in items])
+    payment = load_model("payment")
+    users = [payment.UserValue(credit=i % 100000) for i in range(n)]
+    bench("payment", payment, users, [msgpack.encode(v) for v in users])
+    order = load_model("order")
+    orders = [order.OrderValue(paid=False, items={f"{i % 997}": 1, f"{i % 991}": 1},
+                               user_id=f"{i % 1000}", total_cost=20) for i in range(n)]
+    # Old order maps held items as (item id, quantity) lines
+    bench("order", order, orders, [msgpack.encode({"paid": v.paid, "items": list(v.items.items()), "user_id": v.user_id,
+                                                   "total_cost": v.total_cost}) for v in orders])
+
+    m = load_model("stock", "messages")
+    stock_messages = [m.FindItem(f"{i % 1000}") if i % 2 else m.RemoveStock(f"{i % 1000}", 1) for i in range(n)]
+    bench_messages("stock", m, m.STOCK_MESSAGES, stock_messages)
+    bench_messages("payment", m, m.PAYMENT_MESSAGES, [m.RemoveCredit(f"{i % 1000}", 20, f"{i}") for i in range(n)])
+    bench_messages("order", m, m.ORDER_MESSAGES, [m.AddItem(f"{i}", f"{i % 1000}", 1) for i in range(n)])
+
+
+if __name__ == "__main__":
+    main()
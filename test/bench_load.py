@@ -0,0 +1,265 @@
+"""
+Load generator for the whole system: seeds users, items and orders through
+the batch_init endpoints, drives checkout, addItem and find requests at fixed
+rates for a while, then reports throughput and latency per endpoint and checks
+that stock and credit were conserved.
+
+    python bench_load.py [--url http://127.0.0.1:8000] [--duration 30]
+                         [--rates checkout=100,add_item=50,find=200]
+                         [--items 1000] [--users 1000] [--orders 20000]
+                         [--hot-items 5] [--hot-share 0.2] [--workers 64]
+                         [--in-process]
+
+Requests are sent open loop: request i of a workload is due at i / rate
+seconds and its latency is counted from then, so a slow system shows up as
+latency rather than as a lower request rate. --hot-share of the added items
+come from the first --hot-items items, to see checkouts contend on them.
+With --in-process the requests go to the consumers running in this process on
+the stand-ins of standins.py instead of a deployment.
+
+Orders are taken from the seeded ones; an order is checked out at most once
+and never gets items added while a checkout of it may be running, so every
+paid order holds exactly what was sold. After --settle seconds the stock left
+plus the items of paid orders has to equal the seeded stock, and the credit
+left plus what paid orders cost the seeded credit.
+"""
+import argparse
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+STARTING_STOCK = 100
+STARTING_MONEY = 1000
+ITEM_PRICE = 1
+
+
+class HttpTarget:
+    # The gateway of a running deployment, e.g. docker-compose on port 8000
+
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+        self.local = threading.local()
+
+    def request(self, method: str, path: str) -> tuple[int, object]:
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        response = session.request(method, self.url + path, timeout=60)
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, None
+
+
+class Recorder:
+    # Latencies and status codes per endpoint
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.lock = threading.Lock()
+
+    def record(self, endpoint: str, seconds: float, status: int):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            self.statuses[endpoint][status] += 1
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class OrderPool:
+    '''
+    Seeded orders not checked out yet. add_item and checkout take an order out
+    while they use it; add_item puts it back afterwards, checkout never does.
+    '''
+
+    def __init__(self, n: int):
+        self.free = [str(i) for i in range(n)]
+        random.shuffle(self.free)
+        self.checked_out = []
+        self.lock = threading.Lock()
+
+    def take(self) -> str | None:
+        with self.lock:
+            return self.free.pop() if self.free else None
+
+    def give_back(self, order_id: str):
+        with self.lock:
+            self.free.insert(random.randrange(len(self.free) + 1), order_id)
+
+    def checkout(self, order_id: str):
+        with self.lock:
+            self.checked_out.append(order_id)
+
+
+class Load:
+    # The request functions of the workloads; each returns (endpoint, status) or None when it has nothing to do
+
+    def __init__(self, target, args):
+        self.target = target
+        self.args = args
+        self.orders = OrderPool(args.orders)
+
+    def item(self) -> str:
+        if self.args.hot_items and random.random() < self.args.hot_share:
+            return str(random.randrange(self.args.hot_items))
+        return str(random.randrange(self.args.items))
+
+    def checkout(self):
+        order_id = self.orders.take()
+        if order_id is None:
+            return None
+        self.orders.checkout(order_id)
+        status, _ = self.target.request("POST", f"/orders/checkout/{order_id}")
+        return "checkout", status
+
+    def add_item(self):
+        order_id = self.orders.take()
+        if order_id is None:
+            return None
+        try:
+            status, _ = self.target.request("POST", f"/orders/addItem/{order_id}/{self.item()}/1")
+        finally:
+            self.orders.give_back(order_id)
+        return "add_item", status
+
+    def find(self):
+        kind = random.randrange(3)
+        if kind == 0:
+            status, _ = self.target.request("GET", f"/stock/find/{self.item()}")
+            return "find_item", status
+        if kind == 1:
+            status, _ = self.target.request("GET", f"/payment/find_user/{random.randrange(self.args.users)}")
+            return "find_user", status
+        status, _ = self.target.request("GET", f"/orders/find/{random.randrange(self.args.orders)}")
+        return "find_order", status
+
+
+def pace(name: str, fn, rate: float, duration: float, executor: ThreadPoolExecutor, recorder: Recorder):
+    # Submits fn at `rate` per second for `duration` seconds; latency runs from when each request was due
+    start = time.perf_counter()
+    for i in range(int(rate * duration)):
+        due = start + i / rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+        def run(due=due):
+            try:
+                result = fn()
+            except (requests.RequestException, TimeoutError):
+                result = name, 0
+            if result is not None:
+                recorder.record(result[0], time.perf_counter() - due, result[1])
+        executor.submit(run)
+
+
+def seed(target, args):
+    for path in (f"/stock/batch_init/{args.items}/{STARTING_STOCK}/{ITEM_PRICE}",
+                 f"/payment/batch_init/{args.users}/{STARTING_MONEY}",
+                 f"/orders/batch_init/{args.orders}/{args.items}/{args.users}/{ITEM_PRICE}"):
+        status, body = target.request("POST", path)
+        if status != 200:
+            raise SystemExit(f"seeding {path} failed: {status} {body}")
+
+
+def fetch_all(target, paths: list[str], workers: int) -> list:
+    def fetch(path):
+        status, body = target.request("GET", path)
+        if status != 200:
+            raise SystemExit(f"{path} failed: {status} {body}")
+        return body
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fetch, paths))
+
+
+def check_consistency(target, args, checked_out: list[str]) -> bool:
+    stock = sum(item['stock'] for item in fetch_all(target, [f"/stock/find/{i}" for i in range(args.items)], args.workers))
+    credit = sum(user['credit'] for user in fetch_all(target, [f"/payment/find_user/{i}" for i in range(args.users)],
+                                                      args.workers))
+    orders = [order for order in fetch_all(target, [f"/orders/find/{i}" for i in checked_out], args.workers) if order['paid']]
+    sold = sum(quantity for order in orders for _, quantity in order['items'])
+    spent = sum(order['total_cost'] for order in orders)
+    seeded_stock, seeded_credit = args.items * STARTING_STOCK, args.users * STARTING_MONEY
+    print(f"paid orders {len(orders)} of {len(checked_out)} checked out")
+    print(f"stock   seeded {seeded_stock:>10}  left {stock:>10}  sold  {sold:>8}  "
+          f"{'ok' if stock + sold == seeded_stock else 'MISMATCH'}")
+    print(f"credit  seeded {seeded_credit:>10}  left {credit:>10}  spent {spent:>8}  "
+          f"{'ok' if credit + spent == seeded_credit else 'MISMATCH'}")
+    return stock + sold == seeded_stock and credit + spent == seeded_credit
+
+
+def report(recorder: Recorder, duration: float):
+    print(f"{'endpoint':<12} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  statuses")
+    for endpoint in sorted(recorder.latencies):
+        latencies = recorder.latencies[endpoint]
+        statuses = " ".join(f"{status}:{count}" for status, count in sorted(recorder.statuses[endpoint].items()))
+        print(f"{endpoint:<12} {len(latencies):>9} {len(latencies) / duration:>8.1f} "
+              f"{percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.95) * 1000:>8.1f} "
+              f"{percentile(latencies, 0.99) * 1000:>8.1f}  {statuses}")
+
+
+def parse_rates(spec: str) -> dict[str, float]:
+    return {name.strip(): float(rate) for name, _, rate in (entry.partition('=') for entry in spec.split(',') if entry)}
+
+
+def run(target, args) -> bool:
+    if not args.no_seed:
+        print("seeding...")
+        seed(target, args)
+    load = Load(target, args)
+    recorder = Recorder()
+    rates = parse_rates(args.rates)
+    print(f"running {args.duration:g}s at {', '.join(f'{name} {rate:g}/s' for name, rate in rates.items())}")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        pacers = [threading.Thread(target=pace, args=(name, getattr(load, name), rate, args.duration, executor, recorder))
+                  for name, rate in rates.items()]
+        for pacer in pacers:
+            pacer.start()
+        for pacer in pacers:
+            pacer.join()
+    report(recorder, time.perf_counter() - start)
+    # Checkouts whose HTTP request gave up may still be finishing
+    time.sleep(args.settle)
+    return check_consistency(target, args, load.orders.checked_out)
+
+
+def arguments(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--rates", default="checkout=100,add_item=50,find=200")
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--orders", type=int, default=20000)
+    parser.add_argument("--hot-items", type=int, default=5)
+    parser.add_argument("--hot-share", type=float, default=0.2)
+    parser.add_argument("--workers", type=int, default=64)
+    parser.add_argument("--settle", type=float, default=5)
+    parser.add_argument("--no-seed", action="store_true")
+    parser.add_argument("--in-process", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = arguments()
+    if args.in_process:
+        from standins import InProcessTarget, System
+        system = System()
+        system.start()
+        target = InProcessTarget(system)
+    else:
+        target = HttpTarget(args.url)
+    raise SystemExit(0 if run(target, args) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Per-message logging overhead of a consumer: the request and response lines each
+message logs, under the old synchronous f-string logging and the logging of
+logs.py, written on the handling thread or by the background writer, with
+logging off, text, JSON and sampled.
+
+    python bench_logging.py [messages]
+
+Reports the time the handling thread spends per message and, for the background
+pipeline, the time until the writer thread has drained everything. The second
+run makes every write block for WRITE_DELAY seconds, like a stderr pipe that the
+container runtime reads slower than it is written.
+"""
+import importlib.util
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+spec = importlib.util.spec_from_file_location("logs", os.path.join(ROOT, "stock", "logs.py"))
+logs = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(logs)
+
+MESSAGE = {'action': 'remove_stock_bulk', 'data': {f"{i}": 1 for i in range(5)}, 'order_id': "3f2b9c1e-8d4a-4c6e"}
+RESPONSE = {'status': 200, 'data': {'order_id': "3f2b9c1e-8d4a-4c6e", 'paid': True, 'total_cost': 50}}
+
+
+WRITE_DELAY = 50e-6
+
+
+class SlowStream:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.stream = open(os.devnull, "w")
+
+    def write(self, text: str):
+        if self.delay:
+            time.sleep(self.delay)
+        self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def sink(delay: float) -> logging.Handler:
+    return logging.StreamHandler(SlowStream(delay))
+
+
+def old_style(logger, n: int):
+    for _ in range(n):
+        logger.info(f"[amq.rabbitmq.reply-to] : {MESSAGE}")
+        logger.info(f"[amq.rabbitmq.reply-to] Response: {RESPONSE}")
+
+
+def new_style(logger, sampler, n: int):
+    for _ in range(n):
+        logs.log_sampled(logger, sampler, MESSAGE['action'], "[%s] : %s", "amq.rabbitmq.reply-to", MESSAGE)
+        logs.log_sampled(logger, sampler, "response", "[%s] Response: %s", "amq.rabbitmq.reply-to", RESPONSE)
+
+
+def drain(logger):
+    handler = logger.handlers[0]
+    while isinstance(handler, logs.BackgroundHandler) and not handler.queue.empty():
+        time.sleep(0.001)
+
+
+def report(name: str, n: int, handling: float, total: float | None = None):
+    line = f"{name:<22} {handling / n * 1e6:8.2f} us/message"
+    if total is not None:
+        line += f"  {total / n * 1e6:8.2f} us/message until written"
+    print(line)
+
+
+def run(n: int, delay: float):
+    logger = logging.getLogger(f"bench.sync.{delay}")
+    logger.addHandler(sink(delay))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    start = time.perf_counter()
+    old_style(logger, n)
+    report("sync f-string", n, time.perf_counter() - start)
+
+    cases = [("sync text", "INFO", "text", "", "false"),
+             ("background off", "WARNING", "text", "", "true"),
+             ("background text", "INFO", "text", "", "true"),
+             ("background json", "INFO", "json", "", "true"),
+             ("background text 1%", "INFO", "text", "*=0.01", "true")]
+    for name, level, fmt, sample, background in cases:
+        logger = logs.configure_logger(logging.getLogger(f"bench.{name}.{delay}"), level, fmt, n * 2 + 1, [sink(delay)],
+                                       background)
+        sampler = logs.LogSampler(sample)
+        start = time.perf_counter()
+        new_style(logger, sampler, n)
+        handling = time.perf_counter() - start
+        drain(logger)
+        report(name, n, handling, time.perf_counter() - start)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    print("writes to /dev/null")
+    run(n, 0)
+    print(f"writes blocking {WRITE_DELAY * 1e6:.0f} us")
+    run(n, WRITE_DELAY)
+
+
+if __name__ == "__main__":
+    main()
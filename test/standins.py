@@ -0,0 +1,393 @@
+"""
+In-process stand-ins for RabbitMQ and Redis, to run the stock, payment and
+order consumers in one process without the docker stack.
+
+    system = System()            # the three consumers on fakeredis
+    system = System(redis="localhost:6379", password="redis")   # or on a real Redis
+    system.start()               # the broker thread, for concurrent callers
+    system.call(STOCK_QUEUE, messages.FindItem('1'))
+
+The consumer modules are loaded unchanged. Their pika module is swapped for a
+Broker connection whose channels capture basic_publish/basic_ack, and their
+Redis clients (RedisClient, with its breaker, metrics and tracing) are
+created on fakeredis servers. Needs fakeredis and lupa.
+"""
+import heapq
+import importlib
+import importlib.util
+import itertools
+import os
+import queue
+import sys
+import threading
+import time
+import types
+from concurrent.futures import Future
+
+import msgspec
+import pika
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STOCK_QUEUE = "STOCK_QUEUE"
+PAYMENT_QUEUE = "PAYMENT_QUEUE"
+ORDER_QUEUE = "ORDER_QUEUE"
+DIRECT_REPLY_QUEUE = "amq.rabbitmq.reply-to"
+DEADLINE_HEADER = "x-deadline"
+RPC_TIMEOUT = 10
+
+
+def load_messages():
+    # The message types, from the copy of messages.py every service and gateway carries
+    spec = importlib.util.spec_from_file_location("standin_messages", os.path.join(ROOT, "stock", "messages.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+messages = load_messages()
+
+
+class Channel:
+    '''
+    The channel API the consumers use. Publishes and acks are handed to the
+    broker; the last ones are kept for inspection.
+    '''
+
+    def __init__(self, broker: "Broker", number: int):
+        self.broker = broker
+        self.number = number
+        self.is_open = True
+        self.delivery_tags = itertools.count(1)
+        self.published = 0
+        self.acked = 0
+
+    def queue_declare(self, queue: str = '', passive: bool = False, exclusive: bool = False, **kwargs):
+        name = self.broker.declare(queue or f"amq.gen-{self.number}-{next(self.broker.ids)}")
+        return types.SimpleNamespace(method=types.SimpleNamespace(
+            queue=name, message_count=0, consumer_count=int(name in self.broker.consumers)))
+
+    def exchange_declare(self, exchange: str, exchange_type: str = 'direct', **kwargs):
+        self.broker.bindings.setdefault(exchange, set())
+
+    def queue_bind(self, queue: str, exchange: str, routing_key: str | None = None, **kwargs):
+        self.broker.bindings.setdefault(exchange, set()).add(queue)
+
+    def basic_qos(self, prefetch_count: int = 0, **kwargs):
+        pass
+
+    def basic_consume(self, queue: str, on_message_callback, auto_ack: bool = False, **kwargs):
+        if queue == DIRECT_REPLY_QUEUE:
+            queue = self.reply_queue
+        self.broker.consumers[queue] = (self, on_message_callback)
+
+    def start_consuming(self):
+        pass
+
+    @property
+    def reply_queue(self) -> str:
+        # What RabbitMQ turns reply_to=DIRECT_REPLY_QUEUE into: a name that routes back to this channel
+        return f"{DIRECT_REPLY_QUEUE}.{self.number}"
+
+    def basic_publish(self, exchange: str, routing_key: str, body: bytes, properties=None, **kwargs):
+        self.published += 1
+        if properties is not None and properties.reply_to == DIRECT_REPLY_QUEUE:
+            properties = pika.BasicProperties(reply_to=self.reply_queue, correlation_id=properties.correlation_id,
+                                              expiration=properties.expiration, headers=properties.headers)
+        queues = self.broker.bindings.get(exchange, ()) if exchange else (routing_key,)
+        for name in queues:
+            self.broker.publish(name, properties, body)
+
+    def basic_ack(self, delivery_tag: int, multiple: bool = False):
+        self.acked += 1
+
+
+class Connection:
+    # The BlockingConnection API the consumers use; callbacks and timers run on the broker thread
+
+    def __init__(self, broker: "Broker"):
+        self.broker = broker
+        self.is_open = True
+
+    def channel(self) -> Channel:
+        return Channel(self.broker, next(self.broker.ids))
+
+    def add_callback_threadsafe(self, fn):
+        self.broker.events.put(fn)
+
+    def call_later(self, delay: float, fn):
+        return self.broker.call_later(delay, fn)
+
+    def remove_timeout(self, timer):
+        timer[2] = None
+
+
+class Broker:
+    '''
+    Every consumer's I/O thread in one: published messages are delivered to
+    the consumer of their queue in order, one at a time, together with the
+    threadsafe callbacks and due timers. Messages to queues nobody consumes
+    (the gateway read cache events) are dropped.
+
+    pump() runs everything pending on the calling thread, which is what the
+    microbenchmarks do; start() runs it on a thread of its own instead.
+    '''
+
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.consumers: dict[str, tuple[Channel, object]] = {}
+        self.bindings: dict[str, set] = {}
+        self.events = queue.SimpleQueue()
+        self.timers = []
+        self.timer_ids = itertools.count()
+        self.thread = None
+
+    def connection(self, parameters=None) -> Connection:
+        return Connection(self)
+
+    def declare(self, name: str) -> str:
+        return name
+
+    def publish(self, queue_name: str, properties, body: bytes):
+        self.events.put((queue_name, properties, body))
+
+    def call_later(self, delay: float, fn):
+        timer = [time.monotonic() + delay, next(self.timer_ids), fn]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def run_timers(self) -> float | None:
+        # Runs the due timers, returns the seconds until the next one
+        while self.timers:
+            due, _, fn = self.timers[0]
+            wait = due - time.monotonic()
+            if wait > 0:
+                return wait
+            heapq.heappop(self.timers)
+            if fn is not None:
+                fn()
+        return None
+
+    def handle(self, event):
+        if callable(event):
+            event()
+            return
+        queue_name, properties, body = event
+        consumer = self.consumers.get(queue_name)
+        if consumer is not None:
+            channel, callback = consumer
+            method = types.SimpleNamespace(delivery_tag=next(channel.delivery_tags), routing_key=queue_name)
+            callback(channel, method, properties, body)
+
+    def pump(self):
+        while True:
+            self.run_timers()
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                return
+            self.handle(event)
+
+    def run(self):
+        while True:
+            wait = self.run_timers()
+            try:
+                event = self.events.get(timeout=0.05 if wait is None else min(wait, 0.05))
+            except queue.Empty:
+                continue
+            self.handle(event)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="broker", daemon=True)
+        self.thread.start()
+
+
+def install_cmsgpack(client):
+    '''
+    fakeredis runs Lua scripts without the cmsgpack library the record codecs
+    use (see scripts.py); this adds pack/unpack backed by msgspec to the Lua
+    runtime of the client's server. It relies on fakeredis internals: the
+    per-server runtime and the set of globals scripts may not add to.
+    '''
+    client.eval("return 1", 0)
+    server = client.connection_pool.connection_kwargs["server"]
+    lua = server._lua_runtime
+    lua_type = sys.modules[type(lua).__module__].lua_type
+
+    def to_python(value):
+        # cmsgpack packs integral numbers as integers and strings as msgpack str
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        if isinstance(value, bytes):
+            try:
+                return value.decode()
+            except UnicodeDecodeError:
+                return value
+        if lua_type(value) != "table":
+            return value
+        items = dict(value.items())
+        if all(isinstance(key, (int, float)) for key in items) and sorted(items) == list(range(1, len(items) + 1)):
+            return [to_python(items[i]) for i in range(1, len(items) + 1)]
+        return {to_python(key): to_python(item) for key, item in items.items()}
+
+    def to_lua(value):
+        if isinstance(value, str):
+            return value.encode()
+        if isinstance(value, list):
+            return lua.table_from([to_lua(item) for item in value])
+        if isinstance(value, dict):
+            return lua.table_from({to_lua(key): to_lua(item) for key, item in value.items()})
+        return value
+
+    def pack(value):
+        return msgspec.msgpack.encode(to_python(value))
+
+    def unpack(raw):
+        return to_lua(msgspec.msgpack.decode(raw))
+
+    lua.globals()[b"cmsgpack"] = lua.table_from({b"pack": pack, b"unpack": unpack})
+    server._lua_expected_globals.add(b"cmsgpack")
+
+
+def fake_create_client(redis_client):
+    # create_client of a service, on one fakeredis server per host
+    import fakeredis
+    servers = {}
+
+    def create_client(host: str, port: int, db: int, password: str):
+        server = servers.get(host)
+        if server is None:
+            server = servers[host] = fakeredis.FakeServer()
+        pool = redis_client.redis.ConnectionPool(connection_class=fakeredis.FakeConnection, server=server, db=db)
+        client = redis_client.RedisClient(connection_pool=pool)
+        install_cmsgpack(client)
+        return client
+    return create_client
+
+
+def load_service(name: str, broker: Broker, env: dict, fake_redis: bool):
+    '''
+    Import the consumer module of service `name` from its directory. The
+    service modules share names (config, services, ...), so those of one
+    service are taken out of sys.modules again once it is loaded; the loaded
+    modules keep referring to each other.
+    '''
+    directory = os.path.join(ROOT, name)
+    os.environ.update(env)
+    before = set(sys.modules)
+    sys.path.insert(0, directory)
+    try:
+        redis_client = importlib.import_module("redis_client")
+        if fake_redis:
+            redis_client.create_client = fake_create_client(redis_client)
+        consumer = importlib.import_module("consumer")
+    finally:
+        sys.path.remove(directory)
+        for module in set(sys.modules) - before:
+            if os.path.dirname(getattr(sys.modules[module], "__file__", None) or "") == directory:
+                del sys.modules[module]
+    consumer.pika = types.SimpleNamespace(BlockingConnection=broker.connection, URLParameters=lambda url: url,
+                                          BasicProperties=pika.BasicProperties)
+    return consumer
+
+
+class System:
+    '''
+    The three consumers, connected to one Broker and each on its own Redis,
+    fakeredis servers unless `redis` ("host:port") names a real one, where
+    they use databases 0, 1 and 2. call() plays the gateway. `env` is added to
+    the environment the services read their config from, e.g. CONSUMER_WORKERS.
+    '''
+
+    def __init__(self, redis: str | None = None, password: str = "", log_level: str = "WARNING",
+                 env: dict | None = None):
+        self.broker = Broker()
+        host, _, port = (redis or "").partition(':')
+        self.services = {}
+        self.consumers = {}
+        for db, (name, queue_name) in enumerate((("stock", STOCK_QUEUE), ("payment", PAYMENT_QUEUE),
+                                                  ("order", ORDER_QUEUE))):
+            env = {"RABBITMQ_BROKER_URL": "amqp://in-process", "LOG_LEVEL": log_level, "TRACE_SAMPLE": "0",
+                   "REDIS_HOST": host or name, "REDIS_PORT": port or "6379", "REDIS_DB": str(db if redis else 0),
+                   "REDIS_PASSWORD": password, "STOCK_SHARDS": "", **(env or {})}
+            module = load_service(name, self.broker, env, redis is None)
+            consumer = module.RabbitMQConsumer()
+            consumer.connect()
+            consumer.start_consuming()
+            self.services[name] = module
+            self.consumers[queue_name] = consumer
+        self.client = self.broker.connection().channel()
+        self.pending: dict[str, Future] = {}
+        self.client.basic_consume(DIRECT_REPLY_QUEUE, self.on_reply, auto_ack=True)
+        self.correlation_ids = itertools.count()
+        self.broker.pump()
+
+    def start(self):
+        self.broker.start()
+
+    def on_reply(self, ch, method, properties, body):
+        future = self.pending.pop(properties.correlation_id, None)
+        if future is not None:
+            future.set_result(msgspec.msgpack.decode(body))
+
+    def send(self, queue_name: str, message, correlation_id: str | None = None,
+             deadline: float | None = None) -> Future:
+        # Publishes like the gateway's RPC client, the reply resolves the future. `message` is a
+        # Struct of messages.py, or a dict for the maps sent before those; deadline is absolute,
+        # RPC_TIMEOUT from now by default
+        correlation_id = correlation_id or f"in-process-{next(self.correlation_ids)}"
+        future = Future()
+        self.pending[correlation_id] = future
+        deadline = deadline or time.time() + RPC_TIMEOUT
+        properties = pika.BasicProperties(reply_to=DIRECT_REPLY_QUEUE, correlation_id=correlation_id,
+                                          headers={DEADLINE_HEADER: int(deadline * 1000)})
+        body = msgspec.msgpack.encode(message)
+        self.broker.events.put(lambda: self.client.basic_publish('', queue_name, body, properties))
+        return future
+
+    def wait(self, futures: list[Future]) -> list[dict]:
+        # Without the broker thread the caller pumps, until consumers with worker threads are done too
+        if self.broker.thread is None:
+            deadline = time.monotonic() + RPC_TIMEOUT
+            while not all(future.done() for future in futures) and time.monotonic() < deadline:
+                self.broker.pump()
+                if not all(future.done() for future in futures):
+                    time.sleep(0.0005)
+        return [future.result(timeout=RPC_TIMEOUT) for future in futures]
+
+    def call(self, queue_name: str, message, correlation_id: str | None = None) -> dict:
+        return self.wait([self.send(queue_name, message, correlation_id)])[0]
+
+
+class InProcessTarget:
+    # The HTTP routes of the three gateways, as bench_load.py sends them, mapped onto System.call
+
+    def __init__(self, system: System):
+        self.system = system
+
+    def message(self, path: str) -> tuple[str, object]:
+        service, route, *params = path.strip('/').split('/')
+        if service == "stock":
+            if route == "batch_init":
+                return STOCK_QUEUE, messages.StockBatchInit(int(params[0]), int(params[1]), int(params[2]))
+            if route == "find":
+                return STOCK_QUEUE, messages.FindItem(params[0])
+        elif service == "payment":
+            if route == "batch_init":
+                return PAYMENT_QUEUE, messages.PaymentBatchInit(int(params[0]), int(params[1]))
+            if route == "find_user":
+                return PAYMENT_QUEUE, messages.FindUser(params[0])
+        elif service == "orders":
+            if route == "batch_init":
+                return ORDER_QUEUE, messages.BatchInitUsers(*(int(param) for param in params))
+            if route == "find":
+                return ORDER_QUEUE, messages.FindOrder(params[0])
+            if route == "addItem":
+                return ORDER_QUEUE, messages.AddItem(params[0], params[1], int(params[2]))
+            if route == "checkout":
+                return ORDER_QUEUE, messages.Checkout(params[0])
+        raise ValueError(f"no in-process route for {path}")
+
+    def request(self, method: str, path: str) -> tuple[int, object]:
+        response = self.system.call(*self.message(path))
+        return response['status'], response['data'] if response['status'] == 200 else None
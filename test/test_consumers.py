@@ -0,0 +1,226 @@
+"""
+Regression tests of the checkout saga and the idempotency of the stock, payment
+and order consumers, run in this process on the stand-ins of standins.py, so
+without the docker stack. Every scenario runs with each consumer mode: one
+message at a time, the keyed worker pool and micro-batches.
+"""
+import time
+import unittest
+from contextlib import contextmanager
+
+import msgspec
+
+from standins import ORDER_QUEUE, PAYMENT_QUEUE, STOCK_QUEUE, System, messages
+
+# Short enough that lost messages are retried or time out within a test
+SAGA_ENV = {"COMPENSATION_TIMEOUT": "0.5", "COMPENSATION_RETRY_DELAY": "0.05"}
+
+
+class ConsumerScenarios:
+    ENV: dict
+
+    @classmethod
+    def setUpClass(cls):
+        cls.system = System(env={**SAGA_ENV, **cls.ENV})
+
+    def call(self, queue_name: str, message, correlation_id: str | None = None) -> dict:
+        return self.system.call(queue_name, message, correlation_id)
+
+    def create_item(self, price: int, stock: int) -> str:
+        item_id = self.call(STOCK_QUEUE, messages.CreateItem(price))['data']['item_id']
+        self.assertEqual(self.call(STOCK_QUEUE, messages.AddStock(item_id, stock))['status'], 200)
+        return item_id
+
+    def create_user(self, credit: int) -> str:
+        user_id = self.call(PAYMENT_QUEUE, messages.CreateUser())['data']['user_id']
+        self.assertEqual(self.call(PAYMENT_QUEUE, messages.AddFunds(user_id, credit))['status'], 200)
+        return user_id
+
+    def create_order(self, user_id: str, *lines: tuple[str, int]) -> str:
+        order_id = self.call(ORDER_QUEUE, messages.CreateOrder(user_id))['data']['order_id']
+        for item_id, quantity in lines:
+            self.assertEqual(self.call(ORDER_QUEUE, messages.AddItem(order_id, item_id, quantity))['status'], 200)
+        return order_id
+
+    def stock(self, item_id: str) -> int:
+        return self.call(STOCK_QUEUE, messages.FindItem(item_id))['data']['stock']
+
+    def credit(self, user_id: str) -> int:
+        return self.call(PAYMENT_QUEUE, messages.FindUser(user_id))['data']['credit']
+
+    def order(self, order_id: str) -> dict:
+        return self.call(ORDER_QUEUE, messages.FindOrder(order_id))['data']
+
+    def saga_stats(self) -> dict:
+        return self.call(ORDER_QUEUE, messages.CheckoutStats())['data']
+
+    @contextmanager
+    def dropped(self, queue_name: str, message_type, count: int = 1):
+        # The next `count` messages of message_type published to queue_name are lost
+        broker = self.system.broker
+        publish = broker.publish
+        tag = message_type.__struct_config__.tag
+        left = [count]
+
+        def lossy_publish(name, properties, body):
+            if name == queue_name and left[0] > 0 and msgspec.msgpack.decode(body)[0] == tag:
+                left[0] -= 1
+                return
+            publish(name, properties, body)
+
+        broker.publish = lossy_publish
+        try:
+            yield left
+        finally:
+            broker.publish = publish
+
+    def test_checkout_charges_once(self):
+        item_id = self.create_item(5, 10)
+        user_id = self.create_user(100)
+        order_id = self.create_order(user_id, (item_id, 2))
+
+        self.assertEqual(self.call(ORDER_QUEUE, messages.Checkout(order_id))['status'], 200)
+        self.assertTrue(self.order(order_id)['paid'])
+        self.assertEqual(self.stock(item_id), 8)
+        self.assertEqual(self.credit(user_id), 90)
+
+        # Checking out a paid order again changes nothing
+        self.assertEqual(self.call(ORDER_QUEUE, messages.Checkout(order_id))['status'], 200)
+        self.assertEqual(self.stock(item_id), 8)
+        self.assertEqual(self.credit(user_id), 90)
+
+    def test_failed_payment_returns_stock(self):
+        item_id = self.create_item(5, 10)
+        user_id = self.create_user(4)
+        order_id = self.create_order(user_id, (item_id, 1))
+
+        self.assertEqual(self.call(ORDER_QUEUE, messages.Checkout(order_id))['status'], 400)
+        # Compensated before the checkout was answered
+        self.assertEqual(self.stock(item_id), 10)
+        self.assertEqual(self.credit(user_id), 4)
+        self.assertFalse(self.order(order_id)['paid'])
+
+    def test_failed_stock_refunds_credit(self):
+        item_id = self.create_item(5, 1)
+        user_id = self.create_user(100)
+        order_id = self.create_order(user_id, (item_id, 2))
+
+        self.assertEqual(self.call(ORDER_QUEUE, messages.Checkout(order_id))['status'], 400)
+        self.assertEqual(self.stock(item_id), 1)
+        self.assertEqual(self.credit(user_id), 100)
+        self.assertFalse(self.order(order_id)['paid'])
+
+    def test_lost_compensation_is_retried(self):
+        item_id = self.create_item(5, 10)
+        user_id = self.create_user(4)
+        order_id = self.create_order(user_id, (item_id, 1))
+        retried = self.saga_stats().get("compensations_retried", 0)
+
+        with self.dropped(STOCK_QUEUE, messages.AddStockBulk) as left:
+            self.assertEqual(self.call(ORDER_QUEUE, messages.Checkout(order_id))['status'], 400)
+        self.assertEqual(left, [0])
+        self.assertEqual(self.stock(item_id), 10)
+        self.assertEqual(self.saga_stats()["compensations_retried"], retried + 1)
+
+    def test_step_past_deadline_times_out(self):
+        item_id = self.create_item(5, 10)
+        user_id = self.create_user(100)
+        order_id = self.create_order(user_id, (item_id, 1))
+
+        with self.dropped(STOCK_QUEUE, messages.RemoveStockBulk):
+            future = self.system.send(ORDER_QUEUE, messages.Checkout(order_id), deadline=time.time() + 0.5)
+            response = self.system.wait([future])[0]
+        self.assertEqual(response['status'], 504)
+        # The stock step may or may not have run, both steps are undone
+        self.assertEqual(self.stock(item_id), 10)
+        self.assertEqual(self.credit(user_id), 100)
+        self.assertFalse(self.order(order_id)['paid'])
+
+    def test_expired_message_is_dropped(self):
+        item_id = self.create_item(5, 10)
+        future = self.system.send(STOCK_QUEUE, messages.AddStock(item_id, 5), deadline=time.time() - 1)
+        self.system.broker.pump()
+        time.sleep(0.05)
+        self.system.broker.pump()
+        self.assertFalse(future.done())
+        self.assertEqual(self.stock(item_id), 10)
+
+    def test_redelivered_operation_applied_once(self):
+        item_id = self.create_item(5, 10)
+        user_id = self.create_user(100)
+        for _ in range(2):
+            self.assertEqual(self.call(STOCK_QUEUE, messages.RemoveStockBulk({item_id: 3}, "o"), "op-stock")['status'],
+                             200)
+            self.assertEqual(self.call(PAYMENT_QUEUE, messages.RemoveCredit(user_id, 30, "o"), "op-credit")['status'],
+                             200)
+        self.assertEqual(self.stock(item_id), 7)
+        self.assertEqual(self.credit(user_id), 70)
+
+    def test_undo_of_unapplied_operation_leaves_tombstone(self):
+        item_id = self.create_item(5, 10)
+        user_id = self.create_user(100)
+
+        # Compensations that arrive before the operation they undo change nothing...
+        self.assertEqual(self.call(STOCK_QUEUE, messages.AddStockBulk({item_id: 3}, "o", "op-late-stock"))['status'],
+                         200)
+        self.assertEqual(self.call(PAYMENT_QUEUE, messages.AddFunds(user_id, 30, "o", "op-late-credit"))['status'],
+                         200)
+        self.assertEqual(self.stock(item_id), 10)
+        self.assertEqual(self.credit(user_id), 100)
+
+        # ...and the operation is refused when it shows up after all
+        self.assertEqual(
+            self.call(STOCK_QUEUE, messages.RemoveStockBulk({item_id: 3}, "o"), "op-late-stock")['status'], 400)
+        self.assertEqual(
+            self.call(PAYMENT_QUEUE, messages.RemoveCredit(user_id, 30, "o"), "op-late-credit")['status'], 400)
+        self.assertEqual(self.stock(item_id), 10)
+        self.assertEqual(self.credit(user_id), 100)
+
+    def test_add_item_merges_quantities(self):
+        item_id = self.create_item(5, 10)
+        other_id = self.create_item(7, 10)
+        order_id = self.create_order(self.create_user(0), (item_id, 1), (other_id, 1))
+        for _ in range(2):
+            # Redelivered with the same correlation id, added once
+            self.assertEqual(self.call(ORDER_QUEUE, messages.AddItem(order_id, item_id, 2), "op-add")['status'], 200)
+
+        order = self.order(order_id)
+        self.assertEqual(sorted(map(tuple, order['items'])), sorted([(item_id, 3), (other_id, 1)]))
+        self.assertEqual(order['total_cost'], 3 * 5 + 7)
+
+    def test_item_added_during_checkout_fails_it(self):
+        item_id = self.create_item(5, 10)
+        user_id = self.create_user(100)
+        order_id = self.create_order(user_id, (item_id, 1))
+
+        checkout = self.system.send(ORDER_QUEUE, messages.Checkout(order_id))
+        add_item = self.system.send(ORDER_QUEUE, messages.AddItem(order_id, item_id, 2))
+        checkout_response, add_item_response = self.system.wait([checkout, add_item])
+        self.assertEqual(add_item_response['status'], 200)
+        # The added item was neither reserved nor charged, the order must not be marked paid
+        self.assertEqual(checkout_response['status'], 400)
+        self.assertFalse(self.order(order_id)['paid'])
+        self.assertEqual(self.stock(item_id), 10)
+        self.assertEqual(self.credit(user_id), 100)
+
+        # Checking out again charges the order as it now stands
+        self.assertEqual(self.call(ORDER_QUEUE, messages.Checkout(order_id))['status'], 200)
+        self.assertEqual(self.stock(item_id), 7)
+        self.assertEqual(self.credit(user_id), 85)
+
+
+class TestSerialConsumers(ConsumerScenarios, unittest.TestCase):
+    ENV = {"CONSUMER_WORKERS": "1", "CONSUMER_PREFETCH": "1", "CONSUMER_BATCH_SIZE": "1"}
+
+
+class TestPooledConsumers(ConsumerScenarios, unittest.TestCase):
+    ENV = {"CONSUMER_WORKERS": "4", "CONSUMER_PREFETCH": "32", "CONSUMER_BATCH_SIZE": "1"}
+
+
+class TestBatchedConsumers(ConsumerScenarios, unittest.TestCase):
+    ENV = {"CONSUMER_WORKERS": "1", "CONSUMER_PREFETCH": "32", "CONSUMER_BATCH_SIZE": "8",
+           "CONSUMER_BATCH_WAIT_MS": "2"}
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+Per-hop breakdown of traced requests, from the span files the services export
+(TRACE_EXPORT, one JSON span per line).
+
+    python trace_report.py spans.jsonl [more.jsonl ...] [--root checkout] [--quantile 0.99]
+
+For the traces whose root span is named --root, prints the end-to-end latency
+at the median and the quantile, then per hop (service and span name) its own
+time, i.e. the span's duration minus that of its children: the median over all
+traces and the mean over the traces at or above the quantile. The time of a
+call span not covered by the span of the service answering it is the broker
+hop, the queueing and the network in between.
+"""
+import argparse
+import json
+from collections import defaultdict
+
+
+def load(paths: list[str]) -> dict[str, list[dict]]:
+    traces = defaultdict(list)
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    span = json.loads(line)
+                    traces[span["trace_id"]].append(span)
+    return traces
+
+
+def quantile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def self_times(spans: list[dict]) -> dict[str, float]:
+    # Own time per hop of one trace, summed over the spans of that hop
+    children = defaultdict(float)
+    for span in spans:
+        if span["parent_id"] is not None:
+            children[span["parent_id"]] += span["duration_ms"]
+    hops = defaultdict(float)
+    for span in spans:
+        hops[f"{span['service']} {span['name']}"] += max(span["duration_ms"] - children[span["span_id"]], 0.0)
+    return hops
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--root", default="checkout")
+    parser.add_argument("--quantile", type=float, default=0.99)
+    args = parser.parse_args()
+
+    rows = []
+    for spans in load(args.paths).values():
+        ids = {span["span_id"] for span in spans}
+        roots = [span for span in spans if span["parent_id"] not in ids and span["name"] == args.root]
+        if len(roots) == 1:
+            rows.append((roots[0]["duration_ms"], self_times(spans)))
+    if not rows:
+        print(f"no complete traces with a {args.root!r} root span")
+        return
+
+    totals = [total for total, _ in rows]
+    cutoff = quantile(totals, args.quantile)
+    print(f"{len(rows)} traces of {args.root}: p50 {quantile(totals, 0.5):.2f} ms, "
+          f"p{args.quantile * 100:g} {cutoff:.2f} ms")
+    slow = [hops for total, hops in rows if total >= cutoff]
+    names = sorted({name for _, hops in rows for name in hops})
+    print(f"{'hop':<48} {'p50 own ms':>11} {'slowest own ms':>15}")
+    for name in sorted(names, key=lambda name: -sum(hops.get(name, 0.0) for hops in slow)):
+        own = [hops.get(name, 0.0) for _, hops in rows]
+        print(f"{name:<48} {quantile(own, 0.5):11.2f} {sum(hops.get(name, 0.0) for hops in slow) / len(slow):15.2f}")
+
+
+if __name__ == "__main__":
+    main()